@@ -0,0 +1,502 @@
+import hashlib
+import inspect
+import json
+import os
+import re
+import sys
+import sysconfig
+import types
+import unittest
+import functools
+import multiprocessing
+from contextlib import contextmanager
+
+import amaranth
+from amaranth import *
+from amaranth.hdl.ast import ShapeCastable, SignalDict, SignalSet, Switch
+from amaranth.hdl.ir import Fragment
+from amaranth.back import rtlil
+
+
+_root = os.path.dirname(os.path.abspath(__file__))
+# Code below these directories is covered by sourceHash, the amaranth version and the Python version
+_covered = tuple(os.path.dirname(os.path.abspath(p)) + os.sep for p in (__file__, amaranth.__file__)) + (os.path.abspath(sysconfig.get_paths()["stdlib"]) + os.sep,)
+# Functions being described, so that recursive ones end
+_describing = set()
+
+
+def _isCovered(obj):
+    f = getattr(sys.modules.get(obj.__module__), "__file__", None)
+    return f is None or os.path.abspath(f).startswith(_covered)
+
+
+def _codeNames(code):
+    names = set(code.co_names)
+    for c in code.co_consts:
+        if isinstance(c, types.CodeType):
+            names |= _codeNames(c)
+    return names
+
+
+# The module level names a function uses change it just as much as its closure does
+def _globalsOf(fn):
+    res = {}
+    for n in _codeNames(fn.__code__):
+        if n not in fn.__globals__:
+            continue
+        v = fn.__globals__[n]
+        if isinstance(v, types.ModuleType):
+            res[n] = f"module({v.__name__},{getattr(v, '__version__', None)})"
+        else:
+            res[n] = v
+    return res
+
+
+# Stable, process independent description of the parameters returned by pureIdentifier,
+# so that they can be used as keys for a cache that lives on disk.
+# Raises TypeError for objects that can only be identified by their address.
+def describe(obj) -> str:
+    if obj is None or isinstance(obj, (bool, int, float, str, bytes)):
+        return repr(obj)
+    if isinstance(obj, (tuple, list)):
+        return "(" + ",".join(describe(o) for o in obj) + ")"
+    if isinstance(obj, (set, frozenset)):
+        return "{" + ",".join(sorted(describe(o) for o in obj)) + "}"
+    if isinstance(obj, dict):
+        return "{" + ",".join(sorted(f"{describe(k)}:{describe(v)}" for k, v in obj.items())) + "}"
+    if isinstance(obj, slice):
+        return f"slice({describe(obj.start)},{describe(obj.stop)},{describe(obj.step)})"
+    if isinstance(obj, type):
+        if _isCovered(obj):
+            return f"{obj.__module__}.{obj.__qualname__}"
+        try:
+            source = inspect.getsource(obj)
+        except (OSError, TypeError):
+            raise TypeError(f"{obj} has no source to describe it by")
+        return f"{obj.__module__}.{obj.__qualname__}:{hashlib.sha256(source.encode()).hexdigest()}"
+    if isinstance(obj, functools.partial):
+        return f"partial({describe(obj.func)},{describe(obj.args)},{describe(obj.keywords)})"
+    if isinstance(obj, types.CodeType):
+        consts = tuple(c for c in obj.co_consts if not isinstance(c, types.CodeType))
+        codes = tuple(c for c in obj.co_consts if isinstance(c, types.CodeType))
+        return "code(" + ",".join([hashlib.sha256(obj.co_code).hexdigest(), describe(consts), describe(obj.co_names), *(describe(c) for c in codes)]) + ")"
+    if isinstance(obj, types.FunctionType):
+        if obj in _describing:
+            return f"function({obj.__module__}.{obj.__qualname__})"
+        _describing.add(obj)
+        try:
+            closure = tuple(c.cell_contents for c in obj.__closure__) if obj.__closure__ else ()
+            return f"function({obj.__module__}.{obj.__qualname__},{describe(obj.__code__)},{describe(obj.__defaults__)},{describe(closure)},{describe(_globalsOf(obj))})"
+        finally:
+            _describing.discard(obj)
+    if isinstance(obj, (types.BuiltinFunctionType, types.MethodType)):
+        return f"method({describe(getattr(obj, '__self__', None))}.{obj.__name__})"
+    if isinstance(obj, (Shape, ShapeCastable, Const)):
+        return repr(obj)
+    r = repr(obj)
+    if " at 0x" in r or " object at " in r:
+        raise TypeError(f"{r} has no stable description")
+    return f"{type(obj).__module__}.{type(obj).__qualname__}:{r}"
+
+
+# Any change to the package source, its data files such as SortingNetworks.txt, amaranth or Python invalidates every cached module
+@functools.lru_cache(maxsize=None)
+def sourceHash() -> str:
+    h = hashlib.sha256()
+    h.update(f"amaranth {amaranth.__version__} python {sys.version}".encode())
+    for f in sorted(os.listdir(_root)):
+        if f.endswith((".py", ".txt")):
+            h.update(f.encode())
+            with open(os.path.join(_root, f), "rb") as src:
+                h.update(src.read())
+    return h.hexdigest()
+
+
+def identifierKey(*identifier) -> str:
+    return hashlib.sha256((sourceHash() + describe(identifier)).encode()).hexdigest()
+
+
+class ElaborationCache:
+    """Content addressed on-disk store of generated RTLIL.
+
+    Entries are keyed on the same parameter tuples that the modules return from
+    ``pureIdentifier`` together with a hash of the package source, so a new
+    process can load an earlier generated netlist instead of elaborating it again.
+
+    Parameters
+    ----------
+    directory : str
+        Where to keep the entries. Defaults to ``$MY_AMARANTH_CACHE`` or
+        ``~/.cache/my_amaranth_modules``.
+    """
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = os.environ.get("MY_AMARANTH_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "my_amaranth_modules"))
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".json")
+
+    def get(self, key):
+        try:
+            with open(self.path(key), "r") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so parallel builds never see half an entry
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp, path)
+
+    def clear(self):
+        for d, _, files in os.walk(self.directory):
+            for f in files:
+                if f.endswith(".json"):
+                    os.remove(os.path.join(d, f))
+
+
+def _platformKey(platform):
+    return platform if isinstance(platform, str) or platform is None else type(platform)
+
+
+# Module bodies generated by @pure, by identifier key. Shared by everything elaborated in this process.
+_registry = {}
+_byName = {}
+_cache = None
+_dedup = False
+_profiler = None
+
+
+@contextmanager
+def dedup(enabled=True):
+    """Elaborate @pure modules to Instances of shared bodies inside the block, as ``convert`` and
+    ``generateParallel`` do. The Instances are only complete with the bodies ``convert`` adds,
+    everywhere else (``rtlil.convert``, ``platform.build``, pysim) modules elaborate inline."""
+    global _dedup
+    old, _dedup = _dedup, enabled
+    try:
+        yield
+    finally:
+        _dedup = old
+
+
+def clearRegistry():
+    _registry.clear()
+    _byName.clear()
+
+
+def _register(key, entry):
+    _registry[key] = entry
+    _byName[entry["name"]] = entry
+
+
+def _count(statements):
+    signals = SignalSet()
+    count = 0
+    pending = list(statements)
+    while pending:
+        stmt = pending.pop()
+        count += 1
+        signals |= stmt._lhs_signals() | stmt._rhs_signals()
+        if isinstance(stmt, Switch):
+            pending.extend(s for case in stmt.cases.values() for s in case)
+    return len(signals), count
+
+
+def _generate(self, gen, args, platform, ports, name):
+    module = gen(self, *args)
+    fragment = Fragment.get(module, platform).prepare(ports=ports)
+    text, name_map = rtlil.convert_fragment(fragment, name)
+    # Only the real top level may carry the top attribute
+    text = text.replace("attribute \\top 1\n", "", 1)
+
+    index = SignalDict((p, i) for i, p in enumerate(ports))
+    clocks = SignalDict()
+    for domain in fragment.domains.values():
+        clocks[domain.clk] = ("clk", domain.name)
+        if domain.rst is not None:
+            clocks[domain.rst] = ("rst", domain.name)
+
+    entry_ports = []
+    for signal, direction in fragment.ports.items():
+        wire = name_map[signal][-1]
+        if signal in index:
+            entry_ports.append([wire, direction, "port", index[signal]])
+        else:
+            kind, domain = clocks[signal]
+            entry_ports.append([wire, direction, kind, domain])
+
+    entry = {"name": name, "rtlil": text, "ports": entry_ports}
+    if _profiler is not None:
+        _profiler.count(*_count(fragment.statements))
+    return entry
+
+
+def _instance(entry, ports):
+    connections = {}
+    for wire, direction, kind, target in entry["ports"]:
+        if kind == "port":
+            value = ports[target]
+        elif kind == "clk":
+            value = ClockSignal(target)
+        else:
+            value = ResetSignal(target)
+        connections[f"{direction}_{wire}"] = value
+    return Instance(entry["name"], **connections)
+
+
+def _elaborate(self, gen, outputs, args):
+    platform = args[0] if args else None
+    if not _dedup or platform == "formal":
+        return gen(self, *args), "inline"
+    try:
+        key = identifierKey(_platformKey(platform), self.pureIdentifier())
+    except TypeError:
+        return gen(self, *args), "inline"
+
+    ports = self.ports()
+    how = "hit"
+    entry = _registry.get(key)
+    if entry is None and _cache is not None:
+        entry = _cache.get(key)
+        if entry is not None:
+            how = "disk"
+            _register(key, entry)
+    if entry is None:
+        how = "miss"
+        entry = _generate(self, gen, args, platform, ports, f"{type(self).__name__}_{key[:12]}")
+        entry["outputs"] = {o: getattr(self, o) for o in outputs}
+        _register(key, entry)
+        if _cache is not None:
+            _cache.put(key, entry)
+
+    for o, value in entry["outputs"].items():
+        setattr(self, o, value)
+
+    return _instance(entry, ports), how
+
+
+def pure(outputs=()):
+    """Decorator for ``elaborate`` (or any ``(self, *args) -> Module`` generator) of
+    modules whose elaboration only depends on ``self.pureIdentifier()``.
+
+    Inside ``dedup()``, which ``convert`` and ``generateParallel`` enter, the first module
+    with a given identifier is converted to its own RTLIL module, and every module with
+    that identifier, including the first, elaborates to an ``Instance`` of it. Elsewhere
+    the module elaborates inline.
+    Attributes named in ``outputs`` are set by elaboration and are copied to the
+    modules that reuse the body. Port order is taken from ``self.ports()``.
+    """
+    def decorator(gen):
+        @functools.wraps(gen)
+        def wrapper(self, *args):
+            if _profiler is None:
+                return _elaborate(self, gen, outputs, args)[0]
+            _profiler.enter(self)
+            how = "error"
+            try:
+                result, how = _elaborate(self, gen, outputs, args)
+                if how == "inline" and isinstance(result, Module):
+                    if args:
+                        # Elaborate the submodules now, so that they are profiled as children of this one,
+                        # and keep their fragments in place of them so that they are not elaborated again
+                        submodules = result._named_submodules
+                        for name, sub in submodules.items():
+                            submodules[name] = Fragment.get(sub, args[0])
+                        result._anon_submodules = [Fragment.get(sub, args[0]) for sub in result._anon_submodules]
+                    _profiler.count(*_count(result._statements))
+                return result
+            finally:
+                _profiler.exit(how)
+        return wrapper
+    return decorator
+
+
+# Callables for the current wave of generateParallel, inherited by the forked workers
+_tasks = []
+
+
+def _runTask(i):
+    known = set(_registry)
+    _tasks[i]()
+    return {k: e for k, e in _registry.items() if k not in known}
+
+
+def generateParallel(waves, processes=None, cache=None):
+    """Run the generators in ``waves`` on a pool of forked processes.
+
+    Every generator of a wave may only depend on @pure modules generated by it or by
+    earlier waves. The workers of a wave inherit the registry of everything generated
+    before, and send the modules they generated back to this process, where a later
+    ``convert`` picks them up.
+    Runs serially when ``processes`` is 1 or fork is not available.
+    """
+    global _tasks, _cache
+    if processes == 1 or "fork" not in multiprocessing.get_all_start_methods():
+        old, _cache = _cache, cache
+        try:
+            with dedup():
+                for wave in waves:
+                    for task in wave:
+                        task()
+        finally:
+            _cache = old
+        return
+
+    ctx = multiprocessing.get_context("fork")
+    old, _cache = _cache, cache
+    try:
+        with dedup():
+            for wave in waves:
+                _tasks = list(wave)
+                # A new pool per wave, so that the workers are forked with the results of the previous one
+                with ctx.Pool(min(processes or os.cpu_count(), len(_tasks))) as pool:
+                    for entries in pool.imap_unordered(_runTask, range(len(_tasks))):
+                        for key, entry in entries.items():
+                            _register(key, entry)
+    finally:
+        _tasks = []
+        _cache = old
+
+
+def _withBodies(text):
+    # Append the body of every deduplicated module that is instantiated, directly or through other ones
+    needed = []
+    pending = [text]
+    while pending:
+        for name in re.findall(r"^\s*cell \\(\S+) ", pending.pop(), re.MULTILINE):
+            entry = _byName.get(name)
+            if entry is not None and entry not in needed:
+                needed.append(entry)
+                pending.append(entry["rtlil"])
+    return text + "".join(entry["rtlil"] for entry in needed)
+
+
+def convert(elaboratable, name="top", platform=None, *, ports=None, identifier=None, cache=None, **kwargs):
+    """rtlil.convert, including the bodies of all modules deduplicated with @pure.
+
+    With a ``cache`` the result is loaded from disk when the same parameterization has
+    been converted before, and the bodies of deduplicated modules are shared between
+    processes. ``identifier`` defaults to ``elaboratable.pureIdentifier()``."""
+    global _cache
+    if ports is None:
+        ports = elaboratable.ports()
+
+    key = None
+    if cache is not None:
+        if identifier is None:
+            identifier = elaboratable.pureIdentifier()
+        try:
+            key = identifierKey(name, _platformKey(platform), identifier, tuple(p.name for p in ports), kwargs)
+        except TypeError:
+            pass
+
+    if key is not None:
+        entry = cache.get(key)
+        if entry is not None:
+            elaboratable._MustUse__used = True
+            return entry["rtlil"]
+
+    emit_src = kwargs.pop("emit_src", True)
+    old, _cache = _cache, cache
+    try:
+        with dedup():
+            fragment = Fragment.get(elaboratable, platform)
+        if isinstance(fragment, Instance):
+            # A deduplicated top level still needs a module of its own
+            top, fragment = fragment, Fragment()
+            fragment.add_subfragment(top)
+        text, _ = rtlil.convert_fragment(fragment.prepare(ports=ports, **kwargs), name, emit_src=emit_src)
+        text = _withBodies(text)
+    finally:
+        _cache = old
+
+    if key is not None:
+        cache.put(key, {"name": name, "rtlil": text})
+    return text
+
+
+class ElaborationCacheTest(unittest.TestCase):
+    def test_key_follows_globals(self):
+        namespace = {}
+        exec("limit = 4\ndef helper(a, b):\n    return a < b\ndef comp(a, b):\n    return helper(a, b) & (a < limit)", namespace)
+        key = identifierKey(namespace["comp"])
+        self.assertEqual(key, identifierKey(namespace["comp"]))
+        exec("def helper(a, b):\n    return a > b", namespace)
+        changedHelper = identifierKey(namespace["comp"])
+        self.assertNotEqual(key, changedHelper)
+        namespace["limit"] = 5
+        self.assertNotEqual(changedHelper, identifierKey(namespace["comp"]))
+
+    def test_data_files(self):
+        import tempfile
+        from unittest import mock
+        # Regenerating the network table changes the generated comparators, so it has to change the key as well
+        with tempfile.TemporaryDirectory() as directory, mock.patch.object(sys.modules[__name__], "_root", directory):
+            keys = []
+            for table in ["2 1 0,1\n", "2 1 1,0\n"]:
+                with open(os.path.join(directory, "SortingNetworks.txt"), "w") as f:
+                    f.write(table)
+                sourceHash.cache_clear()
+                keys.append(identifierKey("SortingNet"))
+        sourceHash.cache_clear()
+        self.assertNotEqual(keys[0], keys[1])
+
+    def test_unstable_key(self):
+        namespace = {"unknown": object()}
+        exec("def comp(a, b):\n    return unknown", namespace)
+        with self.assertRaises(TypeError):
+            identifierKey(namespace["comp"])
+
+    def test_dedup(self):
+        import operator
+        from Algorithms import SortingNet
+        # The registry the modules use, also when this file is imported under the package name
+        from ElabCache import convert, clearRegistry
+        clearRegistry()
+        text = convert(SortingNet(operator.lt, 8, 4))
+        modules = re.findall(r"^module \\(\S+)$", text, re.MULTILINE)
+        self.assertEqual(len(modules), len(set(modules)))
+        # Every comparator of the network is an instance of one shared body
+        self.assertEqual(len([m for m in modules if m.startswith("Swap2_")]), 1)
+        self.assertGreater(len(re.findall(r"^\s*cell \\Swap2_", text, re.MULTILINE)), 1)
+        cells = re.findall(r"^\s*cell \\(\S+) ", text, re.MULTILINE)
+        self.assertTrue(set(cells) <= set(modules))
+
+    def test_inline(self):
+        import operator
+        from amaranth.back import rtlil
+        from Algorithms import SortingNet
+        # Outside of convert every comparator is elaborated in place, so stock amaranth gets a complete design
+        net = SortingNet(operator.lt, 8, 4)
+        text = rtlil.convert(net, ports=net.ports())
+        modules = re.findall(r"^module \\(\S+)$", text, re.MULTILINE)
+        cells = re.findall(r"^\s*cell \\(\S+) ", text, re.MULTILINE)
+        self.assertFalse([c for c in cells if c.startswith("Swap2_")])
+        self.assertTrue(set(cells) <= set(modules))
+
+    def test_second_process(self):
+        import subprocess
+        import tempfile
+        script = "\n".join([
+            "import operator, sys",
+            "from ElabCache import ElaborationCache, convert",
+            "from Algorithms import Swap2",
+            "cache = ElaborationCache(sys.argv[1])",
+            "convert(Swap2(operator.lt, 8, 1), cache=cache)",
+            "print(cache.hits, cache.misses)"
+        ])
+        with tempfile.TemporaryDirectory() as directory:
+            runs = [subprocess.run([sys.executable, "-c", script, directory], cwd=_root, capture_output=True, text=True, check=True).stdout.split() for _ in range(2)]
+        # The first process stores the top level and the body of Swap2, the second one loads the top level
+        self.assertEqual(runs, [["0", "2"], ["1", "0"]])
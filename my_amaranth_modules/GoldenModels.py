@@ -0,0 +1,294 @@
+import unittest
+
+import numpy as np
+
+from SortingNetworks import perfectSortings, sortingNetwork, sortedMergingNetwork, omegaNet
+from utils import cl2
+
+
+# Reference models of the networks in Algorithms and StreamCompaction, evaluated with NumPy
+# on a whole batch of input vectors at once. Inputs are (batch, N) arrays, one row per vector,
+# that are transposed internally so that every lane is contiguous.
+
+def _layerIndexes(layer):
+    I, J, D = (np.array(c) for c in zip(*layer))
+    return I, J, D.astype(bool)[:, None]
+
+
+def _directionGroups(net):
+    try:
+        return net._directionGroups
+    except AttributeError:
+        net._directionGroups = [[(d, np.array([i for i, j, dd in layer if dd == d]), np.array([j for i, j, dd in layer if dd == d]))
+                                 for d in (0, 1) if any(dd == d for _, _, dd in layer)] for layer in net.layers]
+        return net._directionGroups
+
+
+def evaluateSortingNet(net, keys, valid=None, comp=np.less, invalid_max=False):
+    """Output of SortingNet (or any ComparatorNetwork) for a batch of inputs.
+
+    Mirrors Swap2: lanes swap when ``comp(key0, key1) == d`` and both are valid, and
+    invalid lanes are moved towards index 0 when ``d`` is 0 and away from it otherwise,
+    the other way around with ``invalid_max``.
+    Returns the keys and valid bits of the output lanes, ``net.outputs``. Keys of invalid
+    lanes are 0 for integer keys compared with np.less.
+    """
+    outputs = list(net.outputs)
+    keys = np.ascontiguousarray(np.transpose(keys))
+    valid = np.ones(keys.shape, dtype=bool) if valid is None else np.ascontiguousarray(np.transpose(valid), dtype=bool)
+    if comp is np.less and np.issubdtype(keys.dtype, np.integer) and keys.size:
+        # Invalid lanes behave like keys below (or above) every valid one, so min/max on a shifted key is enough
+        low = int(keys.min())
+        x = np.where(valid, keys.astype(np.int64) - low + 1, 0)
+        invalid = int(x.max()) + 1 if invalid_max else 0
+        x[~valid] = invalid
+        if x.max() < (1 << 31):
+            x = x.astype(np.int32)
+        groups = _directionGroups(net)
+        # In chunks that stay in the cache
+        for start in range(0, x.shape[1], 4096):
+            c = x[:, start:start+4096]
+            for layer in groups:
+                for d, I, J in layer:
+                    a, b = c[I], c[J]
+                    lo, hi = np.minimum(a, b), np.maximum(a, b)
+                    c[I], c[J] = (hi, lo) if d else (lo, hi)
+        valid = x != invalid
+        return np.where(valid, x + (low - 1), 0).astype(keys.dtype)[outputs].T, valid[outputs].T
+    for layer in net.layers:
+        I, J, D = _layerIndexes(layer)
+        k0, k1, v0, v1 = keys[I], keys[J], valid[I], valid[J]
+        swap = ((comp(k0, k1) == D) & v0 & v1) | np.where(D != invalid_max, v1 & ~v0, v0 & ~v1)
+        keys[I], keys[J] = np.where(swap, k1, k0), np.where(swap, k0, k1)
+        valid[I], valid[J] = np.where(swap, v1, v0), np.where(swap, v0, v1)
+    return keys[outputs].T, valid[outputs].T
+
+
+def evaluateMergeNet(net, keys, valid=None, comp=np.less, eq=np.equal):
+    """Output of MergeNet for a batch of inputs.
+
+    Equal valid keys that meet in a comparator are merged into one lane, and ``count``
+    tells how many input lanes were merged into each output lane, which is what
+    dummyMerge adds together. Returns keys, valid bits and counts of the output lanes.
+    """
+    keys = np.ascontiguousarray(np.transpose(keys))
+    valid = np.ones(keys.shape, dtype=bool) if valid is None else np.ascontiguousarray(np.transpose(valid), dtype=bool)
+    count = valid.astype(np.int64)
+    for layer in net.layers:
+        I, J, D = _layerIndexes(layer)
+        k0, k1, v0, v1, c0, c1 = keys[I], keys[J], valid[I], valid[J], count[I], count[J]
+        e = eq(k0, k1) & v0 & v1
+        nv0, nv1 = v0 | e, v1 & ~e
+        nc0 = np.where(e, c0 + c1, c0)
+        swap = np.where(D, (comp(k0, k1) & v0 & v1) | (nv0 & ~nv1), (comp(k1, k0) & v0 & v1) | (nv1 & ~nv0))
+        keys[I], keys[J] = np.where(swap, k1, k0), np.where(swap, k0, k1)
+        valid[I], valid[J] = np.where(swap, nv1, nv0), np.where(swap, nv0, nv1)
+        count[I], count[J] = np.where(swap, c1, nc0), np.where(swap, nc0, c1)
+    return keys.T, valid.T, count.T
+
+
+def evaluateCompaction(N, dir, valid, stable=False, passNV=False):
+    """valid_o and indexes of CompactionIndexes (index_in=True when stable, indexes_in[i] = i).
+
+    Indexes of lanes that are not valid are 0 unless passNV is set.
+    """
+    valid = np.transpose(np.array(valid, dtype=bool))
+    batch = valid.shape[1]
+    pad = (1 << cl2(N, min1=False)) - N if N > max(perfectSortings.keys()) else 0
+    valid = np.concatenate([valid, np.zeros((pad, batch), dtype=bool)])
+    index = np.zeros(valid.shape, dtype=np.int64)
+    index[:N] = np.arange(N)[:, None]
+    net = sortingNetwork(N + pad, d=dir)
+    for layer in net.layers:
+        I, J, D = _layerIndexes(layer)
+        vu, vv, eu, ev = valid[I], valid[J], index[I], index[J]
+        if not passNV:
+            eu, ev = np.where(vu, eu, 0), np.where(vv, ev, 0)
+        both, onlyV, anyValid = vu & vv, vv & ~vu, vu | vv
+        if stable:
+            bothI, bothJ = np.minimum(eu, ev), np.maximum(eu, ev)
+        else:
+            bothI, bothJ = np.where(D, ev, eu), np.where(D, eu, ev)
+        # With d the valid lane goes to j, otherwise to i
+        nI = np.select([both, onlyV], [bothI, np.where(D, eu, ev)], np.where(D, ev, eu))
+        nJ = np.select([both, onlyV], [bothJ, np.where(D, ev, eu)], np.where(D, eu, ev))
+        vI = both | (~D & anyValid)
+        vJ = both | (D & anyValid)
+        index[I], index[J] = nI, nJ
+        valid[I], valid[J] = vI, vJ
+    if dir:
+        valid, index = valid[pad:], index[pad:]
+    else:
+        valid, index = valid[:N], index[:N]
+    return valid.T, index.T
+
+
+def _lanes(N, start, stop):
+    # Bit k of lane i is bit i of input vector start+k, packed 8 vectors to a byte
+    idx = np.arange(start, stop, dtype=np.uint64)
+    return [np.packbits(((idx >> np.uint64(i)) & np.uint64(1)).astype(bool)) for i in range(N)]
+
+
+def zeroOneCheck(net, chunk=1 << 20):
+    """Runs every one of the 2^N 0-1 vectors through the network, 8 vectors per byte.
+
+    By the 0-1 principle the network sorts every input if it sorts all of these.
+    Returns the first input vector (as a list of bits, lane 0 first) that is not sorted,
+    or None. Practical up to N of about 24. A network with fewer outputs than lanes is
+    compared to the full sorter on its outputs.
+    """
+    N = net.N
+    if N <= 1:
+        return None
+    reference = sortingNetwork(N, d=net.d) if len(net.outputs) < N else None
+    total = 1 << N
+    for start in range(0, total, chunk):
+        stop = min(total, start + chunk)
+        lanes = _lanes(N, start, stop)
+        expected = list(lanes)
+        for n, l in ((net, lanes), (reference, expected)) if reference else ((net, lanes),):
+            for layer in n.layers:
+                for i, j, d in layer:
+                    lo, hi = l[i] & l[j], l[i] | l[j]
+                    l[i], l[j] = (hi, lo) if d else (lo, hi)
+        bad = np.zeros_like(lanes[0])
+        if reference:
+            for i in net.outputs:
+                bad |= lanes[i] ^ expected[i]
+        else:
+            for i in range(N-1):
+                bad |= (lanes[i+1] & ~lanes[i]) if net.d else (lanes[i] & ~lanes[i+1])
+        if bad.any():
+            first = start + int(np.unpackbits(bad)[:stop-start].nonzero()[0][0])
+            return [(first >> i) & 1 for i in range(N)]
+    return None
+
+
+def distributionRouting(nrOfInputs, nrOfOutputs):
+    """Which outputs of a DistributionNet every input can reach, as a (nrOfInputs, nrOfOutputs) bool array.
+
+    Follows the routers of omegaNet the same way DistributionNet connects them.
+    A StreamJoin passes any of its inputs to its output, a StreamDistribute_2to2 to any of its outputs.
+    """
+    layers = omegaNet(nrOfInputs, nrOfOutputs)
+    reach = np.eye(nrOfInputs, dtype=bool)
+    active = [(2*j, 2*j+1) for j in range(nrOfInputs//2)]
+    for i in range(len(layers)-1):
+        routerInputs = [[] for _ in layers[i+1]]
+        for j, (kind, a, b) in enumerate(layers[i]):
+            if kind == 1:
+                routerInputs[a if layers[i+1][a][0] != 0 else b].append(active[j][0])
+            elif kind == 2:
+                routerInputs[a].append(active[j][0])
+                routerInputs[b].append(active[j][1])
+        columns = []
+        newActive = []
+        for r, (kind, _, _) in enumerate(layers[i+1]):
+            streams = []
+            for _ in range(kind):
+                streams.append(len(columns))
+                columns.append(reach[:, routerInputs[r]].any(axis=1))
+            newActive.append(tuple(streams))
+        reach = np.stack(columns, axis=1) if columns else np.zeros((nrOfInputs, 0), dtype=bool)
+        active = newActive
+    return reach
+
+
+class GoldenModelTest(unittest.TestCase):
+    def test_zero_one(self):
+        for N in range(1, 21):
+            for useOptimal in [True, False]:
+                for d in [0, 1]:
+                    self.assertIsNone(zeroOneCheck(sortingNetwork(N, useOptimal, d=d)), f"N={N} useOptimal={useOptimal} d={d}")
+            for policy in ["size", "pareto"]:
+                self.assertIsNone(zeroOneCheck(sortingNetwork(N, policy=policy)), f"N={N} policy={policy}")
+            for network in ["oddeven", "pairwise"]:
+                for d in [0, 1]:
+                    self.assertIsNone(zeroOneCheck(sortingNetwork(N, False, d=d, network=network)), f"N={N} network={network} d={d}")
+
+    def test_top_k(self):
+        for N in range(2, 19):
+            for K in [1, 2, 3, N//2, N-1]:
+                for d in [0, 1]:
+                    self.assertIsNone(zeroOneCheck(sortingNetwork(N, d=d, top_k=K)), f"N={N} K={K} d={d}")
+                    self.assertIsNone(zeroOneCheck(sortingNetwork(N, False, d=d, network="oddeven", top_k=K)), f"N={N} K={K} d={d} oddeven")
+        rng = np.random.default_rng(2)
+        for N, K in [(64, 4), (100, 8), (128, 1)]:
+            keys = rng.integers(0, 1 << 16, (2000, N))
+            net = sortingNetwork(N, top_k=K)
+            k, v = evaluateSortingNet(net, keys)
+            self.assertTrue((k == -np.sort(-keys, axis=1)[:, :K]).all())
+            self.assertLess(net.depth, sortingNetwork(N).depth)
+            self.assertLess(net.size, sortingNetwork(N).size)
+        # Selecting the smallest K of partially valid inputs needs invalid lanes above the valid ones
+        for N, K in [(3, 1), (20, 4), (64, 8)]:
+            keys = rng.integers(0, 16, (2000, N))
+            valid = rng.random((2000, N)) < 0.5
+            net = sortingNetwork(N, d=0, top_k=K)
+            expected = np.sort(np.where(valid, keys, 1 << 16), axis=1)[:, :K]
+            for comp in [np.less, lambda a, b: a < b]:
+                k, v = evaluateSortingNet(net, keys, valid, comp=comp, invalid_max=True)
+                self.assertTrue((v == (expected < (1 << 16))).all())
+                self.assertTrue(((k == expected) | ~v).all())
+
+    def test_sorting_net(self):
+        rng = np.random.default_rng(0)
+        for N, options in [(3, {}), (8, {}), (17, {"policy": "size"}), (32, {}), (33, {"policy": "pareto"}), (48, {"policy": "size"}), (64, {}),
+                           (100, {"policy": "size"}), (100, {"network": "oddeven"}), (128, {"network": "pairwise"})]:
+            keys = rng.integers(0, 16, (2000, N))
+            valid = rng.random((2000, N)) < 0.8
+            net = sortingNetwork(N, **options)
+            k, v = evaluateSortingNet(net, keys, valid)
+            self.assertTrue((v[:, :-1] >= v[:, 1:]).all())
+            self.assertTrue(((k[:, :-1] >= k[:, 1:]) | ~v[:, 1:]).all())
+            self.assertTrue((v.sum(axis=1) == valid.sum(axis=1)).all())
+            # The general path, taken for any other comparison, agrees with the min/max one
+            k2, v2 = evaluateSortingNet(net, keys, valid, comp=lambda a, b: a < b)
+            self.assertTrue((v2 == v).all())
+            self.assertTrue(((k2 == k) | ~v).all())
+
+    def test_sorted_merge(self):
+        rng = np.random.default_rng(3)
+        for A, B in [(1, 1), (1, 4), (3, 5), (8, 8), (7, 2), (16, 9)]:
+            for d in [0, 1]:
+                keys = np.concatenate([np.sort(rng.integers(0, 32, (2000, A)), axis=1), np.sort(rng.integers(0, 32, (2000, B)), axis=1)], axis=1)
+                if d:
+                    keys = np.concatenate([keys[:, A-1::-1], keys[:, :A-1:-1]], axis=1)
+                k, _ = evaluateSortingNet(sortedMergingNetwork(A, B, d=d), keys)
+                self.assertTrue((k == (-np.sort(-keys, axis=1) if d else np.sort(keys, axis=1))).all(), f"A={A} B={B} d={d}")
+
+    def test_merge_net(self):
+        rng = np.random.default_rng(1)
+        for N in [2, 4, 8, 16]:
+            keys = rng.integers(0, 6, (2000, N))
+            k, v, c = evaluateMergeNet(sortingNetwork(N), keys)
+            self.assertTrue((np.where(v, c, 0).sum(axis=1) == N).all())
+            # Not every pair of equal keys meets in a comparator, so a key can be left in more than one lane
+            for row in range(len(keys)):
+                unique, counts = np.unique(keys[row], return_counts=True)
+                merged = {key: 0 for key in unique}
+                for key, n in zip(k[row][v[row]], c[row][v[row]]):
+                    merged[key] += n
+                self.assertEqual(list(merged.values()), list(counts))
+
+    def test_compaction(self):
+        for N in [1, 2, 5, 8, 13]:
+            valid = (np.arange(1 << N)[:, None] >> np.arange(N)) & 1
+            for dir in [0, 1]:
+                for stable in [False, True]:
+                    v, index = evaluateCompaction(N, dir, valid, stable)
+                    n = valid.sum(axis=1)
+                    expected = (np.arange(N) < n[:, None]) if dir == 0 else (np.arange(N) >= N - n[:, None])
+                    self.assertTrue((v == expected).all())
+                    for row in range(len(valid)):
+                        got = index[row][v[row]]
+                        self.assertEqual(sorted(got), list(np.nonzero(valid[row])[0]))
+                        if stable:
+                            self.assertEqual(list(got), sorted(got))
+
+    def test_distribution(self):
+        for inputs in [2, 4, 8, 16]:
+            reach = distributionRouting(inputs, inputs)
+            self.assertEqual(reach.shape, (inputs, inputs))
+            self.assertTrue(reach.any(axis=0).all())
+            self.assertTrue(reach.any(axis=1).all())
@@ -0,0 +1,237 @@
+from amaranth import *
+from amaranth.sim import Simulator, Settle
+from fhdl import FHDLTestCase
+from typing import Callable
+
+from utils import cl2
+from ElabCache import pure
+from SortingNetworks import mergingNetwork, sortingNetwork
+from Stream import ArrayStreamInterface, StreamFifo
+from Algorithms import Swap2, SortingNet
+
+
+class StreamRunMerger(Elaboratable):
+    # Merges a run of run_beats full beats from si[0] with a run from si[1] into one run of 2*run_beats beats, framed by first and last.
+    # Runs are in descending order under comp, like the output of SortingNet. Every step takes the next beat of the run with the greater
+    # head, merges it with the N smallest keys kept so far and outputs the N greatest. The kept keys of a run are output in the same
+    # cycle as the next run is loaded, so one beat is merged every cycle.
+    def __init__(self, comp:Callable[[Value, Value], Value], payload_width : int = 8, N : int = 8, run_beats : int = 1):
+        assert N == 1 << cl2(N, min1=False), "N has to be a power of two"
+        self.comp = comp
+        self.payload_width = payload_width
+        self.N = N
+        self.run_beats = run_beats
+        self.network = mergingNetwork(2*N, d=1)
+
+        self.si = [ArrayStreamInterface(name=f"si{i}", payload_width=payload_width, valid_width=N) for i in range(2)]
+        self.so = ArrayStreamInterface(name="so", payload_width=payload_width, valid_width=N, extra_fields=[("first", 1), ("last", 1)])
+
+    def ports(self):
+        return sum([[s[f] for f in s.fields] for s in self.si + [self.so]], [])
+
+    def pureIdentifier(self):
+        return (type(self), self.comp, self.payload_width, self.N, self.run_beats)
+
+    @pure()
+    def elaborate(self, platform):
+
+        m = Module()
+
+        for field in self.so.fields:
+            if field not in ["valid", "ready"]:
+                self.so[field].reset_less = True
+
+        N = self.N
+        kept = [Signal(self.payload_width, name=f"kept{i}") for i in range(N)]
+        loaded = Signal()
+        first = Signal(reset=1)
+        taken = [Signal(range(self.run_beats + 1), name=f"taken{i}") for i in range(2)]
+        done = [Signal(name=f"done{i}") for i in range(2)]
+        present = [Signal(name=f"present{i}") for i in range(2)]
+        m.d.comb += [d.eq(t == self.run_beats) for d, t in zip(done, taken)]
+        m.d.comb += [p.eq(si.valid.any()) for p, si in zip(present, self.si)]
+
+        ovalid = Signal()
+        ready = Signal()
+        m.d.comb += ready.eq(self.so.ready | ~ovalid)
+
+        sel0 = Signal()
+        m.d.comb += sel0.eq(done[1] | (~done[0] & ~self.comp(self.si[0].payload[0], self.si[1].payload[0])))
+        block = [Mux(sel0, self.si[0].payload[i], self.si[1].payload[i]) for i in range(N)]
+
+        swap_cnt = 0
+        def swap2(T0, T1, d):
+            nonlocal swap_cnt
+            m.submodules[f"swap{swap_cnt}"] = sw = Swap2(self.comp, self.payload_width, d)
+            swap_cnt += 1
+            m.d.comb += [
+                sw.valid0_i.eq(1),
+                sw.payload0_i.eq(T0),
+                sw.valid1_i.eq(1),
+                sw.payload1_i.eq(T1)
+            ]
+            return sw.payload0_o, sw.payload1_o
+
+        # The kept keys ascending followed by the new beat descending form a bitonic sequence
+        A = kept[::-1] + block
+        for layer in self.network.layers:
+            for i0, i1, d in layer:
+                A[i0], A[i1] = swap2(A[i0], A[i1], d)
+
+        doLoad = Signal()
+        doStep = Signal()
+        doFlush = Signal()
+        m.d.comb += [
+            doFlush.eq(loaded & done[0] & done[1] & ready),
+            doLoad.eq((~loaded | doFlush) & present[0]),
+            doStep.eq(loaded & ~(done[0] & done[1]) & ready & (present[0] | done[0]) & (present[1] | done[1])),
+            self.si[0].ready.eq(doLoad | (doStep & sel0)),
+            self.si[1].ready.eq(doStep & ~sel0)
+        ]
+
+        with m.If(doStep):
+            m.d.sync += [k.eq(a) for k, a in zip(kept, A[N:])]
+            m.d.sync += [o.eq(a) for o, a in zip(self.so.payload, A[:N])]
+            m.d.sync += [self.so.valid.eq((1 << N) - 1), self.so.first.eq(first), self.so.last.eq(0), ovalid.eq(1), first.eq(0)]
+            with m.If(sel0):
+                m.d.sync += taken[0].eq(taken[0] + 1)
+            with m.Else():
+                m.d.sync += taken[1].eq(taken[1] + 1)
+        with m.Elif(doFlush):
+            m.d.sync += [o.eq(k) for o, k in zip(self.so.payload, kept)]
+            m.d.sync += [self.so.valid.eq((1 << N) - 1), self.so.first.eq(first), self.so.last.eq(1), ovalid.eq(1), first.eq(1)]
+            m.d.sync += [loaded.eq(0), taken[0].eq(0), taken[1].eq(0)]
+        with m.Elif(self.so.ready):
+            m.d.sync += [self.so.valid.eq(0), ovalid.eq(0)]
+
+        with m.If(doLoad):
+            m.d.sync += [k.eq(self.si[0].payload[i]) for i, k in enumerate(kept)]
+            m.d.sync += [loaded.eq(1), taken[0].eq(1), taken[1].eq(0)]
+
+        return m
+
+
+class MergeSortEngine(Elaboratable):
+    # Sorts every run_length keys of the input into one descending run, framed by first and last. The input beats have to be full.
+    # A SortingNet sorts every beat, then level k of the merge tree alternates runs of 2**k beats between two StreamFifos and
+    # merges them with a StreamRunMerger. The FIFOs of a level hold buffering runs each, 2 is needed for one beat every cycle.
+    def __init__(self, comp:Callable[[Value, Value], Value], payload_width : int = 8, N : int = 8, run_length : int = 64, registerStride=2, buffering=2,
+                 useOptimal=True, policy="depth", network="bitonic", memAttrs=None):
+        run_beats = run_length // N
+        assert run_beats * N == run_length and run_beats == 1 << cl2(run_beats, min1=False), "run_length has to be N times a power of two"
+        self.comp = comp
+        self.payload_width = payload_width
+        self.N = N
+        self.run_length = run_length
+        self.run_beats = run_beats
+        self.levels = cl2(run_beats, min1=False)
+        self.registerStride = registerStride
+        self.buffering = buffering
+        self.useOptimal = useOptimal
+        self.policy = policy
+        self.networkType = network
+        self.memAttrs = memAttrs
+        # Cycles from the last beat of a run going in to the last beat of the sorted run coming out, without back pressure
+        self.delay = sortingNetwork(N, useOptimal, registerStride, True, policy=policy, network=network).delay + run_beats - 1 + 4*self.levels
+
+        self.input_stream = ArrayStreamInterface(payload_width=payload_width, valid_width=N)
+        self.output_stream = ArrayStreamInterface(payload_width=payload_width, valid_width=N, extra_fields=[("first", 1), ("last", 1)])
+
+    def ports(self):
+        return sum([[s[f] for f in s.fields] for s in [self.input_stream, self.output_stream]], [])
+
+    def pureIdentifier(self):
+        return (type(self), self.comp, self.payload_width, self.N, self.run_length, self.registerStride, self.buffering, self.useOptimal, self.policy, self.networkType,
+                tuple(self.memAttrs.items()) if isinstance(self.memAttrs, dict) else self.memAttrs)
+
+    @pure()
+    def elaborate(self, platform):
+
+        m = Module()
+
+        N = self.N
+        m.submodules.sorter = sorter = SortingNet(self.comp, self.payload_width, N, self.registerStride, useOptimal=self.useOptimal, policy=self.policy, network=self.networkType)
+        m.d.comb += sorter.input_stream.stream_eq(self.input_stream)
+
+        stream = sorter.output_stream
+        run_beats = 1
+        for level in range(self.levels):
+            fifos = []
+            for i in range(2):
+                m.submodules[f"fifo{level}_{i}"] = fifo = StreamFifo(ArrayStreamInterface, self.payload_width, N, depth=self.buffering*run_beats, memAttrs=self.memAttrs)
+                fifos.append(fifo)
+            m.submodules[f"merger{level}"] = merger = StreamRunMerger(self.comp, self.payload_width, N, run_beats)
+
+            # Whole runs go to the two FIFOs in turn
+            sel = Signal(name=f"sel{level}")
+            end = stream.last if level > 0 else Const(1)
+            with m.If(stream.valid.any() & stream.ready & end):
+                m.d.sync += sel.eq(~sel)
+            for i, fifo in enumerate(fifos):
+                m.d.comb += fifo.si.valid.eq(Mux(sel == i, stream.valid, 0))
+                m.d.comb += [fifo.si.payload[l].eq(stream.payload[l]) for l in range(N)]
+                m.d.comb += merger.si[i].stream_eq(fifo.so)
+            m.d.comb += stream.ready.eq(Mux(sel, fifos[1].si.ready, fifos[0].si.ready))
+
+            stream = merger.so
+            run_beats *= 2
+
+        if self.levels > 0:
+            m.d.comb += self.output_stream.stream_eq(stream)
+        else:
+            m.d.comb += [
+                self.output_stream.valid.eq(stream.valid),
+                stream.ready.eq(self.output_stream.ready),
+                self.output_stream.first.eq(1),
+                self.output_stream.last.eq(1)
+            ]
+            m.d.comb += [self.output_stream.payload[l].eq(stream.payload[l]) for l in range(N)]
+
+        return m
+
+
+class MergeSortTest(FHDLTestCase):
+    def test_sort(self):
+        import random
+        random.seed(1)
+
+        N = 4
+        run_length = 32
+        runs = 4
+        keys = [random.randrange(64) for _ in range(runs*run_length)]
+
+        dut = MergeSortEngine(comp=lambda a, b: a < b, payload_width=6, N=N, run_length=run_length)
+        sim = Simulator(dut)
+
+        def source():
+            for b in range(len(keys)//N):
+                yield dut.input_stream.valid.eq((1 << N) - 1)
+                for l in range(N):
+                    yield dut.input_stream.payload[l].eq(keys[b*N + l])
+                yield Settle()
+                while not (yield dut.input_stream.ready):
+                    yield
+                    yield Settle()
+                yield
+            yield dut.input_stream.valid.eq(0)
+
+        def sink():
+            yield dut.output_stream.ready.eq(1)
+            output = []
+            framing = []
+            while len(output) < len(keys):
+                yield Settle()
+                if (yield dut.output_stream.valid) == (1 << N) - 1:
+                    for l in range(N):
+                        output.append((yield dut.output_stream.payload[l]))
+                    framing.append(((yield dut.output_stream.first), (yield dut.output_stream.last)))
+                yield
+            for r in range(runs):
+                self.assertEqual(output[r*run_length:(r+1)*run_length], sorted(keys[r*run_length:(r+1)*run_length], reverse=True))
+            beats = run_length // N
+            self.assertEqual(framing, [(1, 0)] + [(0, 0)]*(beats-2) + [(0, 1)] + ([(1, 0)] + [(0, 0)]*(beats-2) + [(0, 1)])*(runs-1))
+
+        sim.add_clock(1e-6)
+        sim.add_sync_process(source)
+        sim.add_sync_process(sink)
+        sim.run()
@@ -0,0 +1,94 @@
+import sys
+
+import numpy as np
+
+import SortingNetworks
+from SortingNetworks import ComparatorNetwork, readNetworkTable, writeNetworkTable, layered, prune, oddEvenMerge
+from GoldenModels import evaluateSortingNet, zeroOneCheck
+from utils import cl2
+
+# Builds the table of SortingNetworks.txt: for every N the sorting networks that no other known
+# network beats in both depth and size. The networks already in the table are the starting point,
+# new candidates come from Batcher's merge exchange, from two smaller networks joined by an
+# odd-even merger and from removing a lane of a larger network. Run as
+#   python NetworkTables.py [maxN]
+# to improve and rewrite the table in place.
+
+
+def flattened(layers):
+    return [c for layer in layers for c in layer]
+
+
+def mergeExchange(N):
+    """Batcher's merge exchange sort (Knuth, Algorithm 5.2.2M)."""
+    res = []
+    t = cl2(N, min1=False)
+    p = 1 << (t-1)
+    while p > 0:
+        q, r, d = 1 << (t-1), 0, p
+        while True:
+            res += [(i, i+d) for i in range(N-d) if i & p == r]
+            if q == p:
+                break
+            d, q, r = q-p, q >> 1, p
+        p >>= 1
+    return res
+
+
+def _depthSize(layers):
+    return len(layers), sum(len(layer) for layer in layers)
+
+
+def pareto(candidates):
+    """The candidates no other candidate beats in both depth and size, the first one kept of equals."""
+    best = {}
+    for layers in candidates:
+        best.setdefault(_depthSize(layers), layers)
+    front = []
+    for (depth, size), layers in sorted(best.items()):
+        if not front or size < _depthSize(front[-1])[1]:
+            front.append(layers)
+    return front
+
+
+def improve(fronts, maxN=64):
+    for N in range(2, maxN+1):
+        candidates = list(fronts.get(N, [])) + [layered(N, mergeExchange(N))]
+        for k in range(1, N//2+1):
+            merger = oddEvenMerge(k, N-k)
+            for A in fronts.get(k, [()]):
+                for B in fronts.get(N-k, [()]):
+                    comparators = flattened(A) + [(i+k, j+k) for i, j in flattened(B)] + merger
+                    candidates.append(layered(N, comparators))
+        fronts[N] = pareto(candidates)
+    for N in range(maxN, 2, -1):
+        candidates = list(fronts[N-1])
+        for layers in fronts[N]:
+            for p in range(N):
+                for inf in (-1, 1):
+                    candidates.append(layered(N-1, prune(N, flattened(layers), {p: inf})))
+        fronts[N-1] = pareto(candidates)
+    return fronts
+
+
+def verify(N, layers, vectors=1 << 16):
+    net = ComparatorNetwork(N, tuple(tuple((i, j, 0) for i, j in layer) for layer in layers), d=0)
+    if N <= 24:
+        return zeroOneCheck(net) is None
+    rng = np.random.default_rng(N)
+    for keys in (rng.integers(0, 2, (vectors, N)), rng.integers(0, 1 << 16, (vectors, N))):
+        # d=0 sorts valid keys ascending
+        k, _ = evaluateSortingNet(net, keys)
+        if not (k[:, :-1] <= k[:, 1:]).all():
+            return False
+    return True
+
+
+if __name__ == "__main__":
+    maxN = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    fronts = improve(readNetworkTable(), maxN)
+    for N, front in sorted(fronts.items()):
+        for layers in front:
+            assert verify(N, layers), f"network for N={N} does not sort"
+        print(N, *(_depthSize(layers) for layers in front))
+    writeNetworkTable(fronts, SortingNetworks.networkTableFile)
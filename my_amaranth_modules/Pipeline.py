@@ -0,0 +1,229 @@
+from amaranth import *
+from amaranth.sim import Simulator, Settle
+from fhdl import FHDLTestCase
+
+from utils import StageTiming, streamBits
+from Stream import StreamReg, BasicStreamInterface, ArrayStreamInterface
+
+
+# The streams a stage is connected by, si and so or the input_stream and output_stream of the older modules
+def stageStreams(stage):
+    if hasattr(stage, "si"):
+        return stage.si, stage.so
+    return stage.input_stream, stage.output_stream
+
+def _through(depth, stage_depth):
+    return 0 if stage_depth == 0 else depth + stage_depth
+
+
+class StreamPipeline(Elaboratable):
+    """A chain of stream stages, connected so to si in the order they are added.
+
+    Every stage declares its ``StageTiming``, from its ``pipelineTiming()`` or from the keyword
+    arguments of ``add``, which also override single fields of it. While adding, the pipeline adds
+    up the combinational levels of the valid and the ready path between registers, and when a stage
+    would take one of them past ``depth_budget`` it puts a ``StreamReg`` slice in front of the stage:
+    a forward slice for the valid path, a backward slice for the ready path and a full slice when
+    both need it or the cheaper one would push the other path past the budget. The slices are pure
+    modules like the stages, so slices of the same stream are deduplicated.
+
+    Parameters
+    ----------
+    depth_budget : int
+        Combinational levels allowed on the valid and on the ready path between two registers.
+        A single stage deeper than that is left as it is.
+
+    Attributes
+    ----------
+    si, so : the input stream of the first stage and the output stream of the last one.
+    latency, register_bits, buffer_bits : the sums over the stages and the inserted slices.
+
+    Usage::
+
+        p = StreamPipeline(depth_budget=2)
+        p.add(StreamCompaction(8, 16), name="compact")
+        p.add(SortingNet(operator.lt, 16, 8))
+        p.add(StreamFifo(ArrayStreamInterface, 16, 8, depth=64))
+        print(p.report())
+        m.submodules.pipeline = p
+
+    Paths that leave the pipeline through si and so are not counted.
+    """
+    def __init__(self, depth_budget=2):
+        self.depth_budget = depth_budget
+        self.stages = []
+        self.valid_depth = 0
+        self.ready_depth = 0
+
+    def add(self, stage, name=None, **timing):
+        if hasattr(stage, "pipelineTiming"):
+            stage_timing = stage.pipelineTiming()._replace(**timing)
+        else:
+            stage_timing = StageTiming(**timing)
+        name = name or f"{type(stage).__name__.lower()}{len(self.stages)}"
+
+        if self.stages:
+            slice_type = self._sliceFor(stage_timing)
+            if slice_type is not None:
+                so = stageStreams(self.stages[-1][1])[1]
+                self._append(f"slice{len(self.stages)}", self._slice(so, slice_type))
+        self._append(name, stage, stage_timing)
+        return stage
+
+    def _append(self, name, stage, stage_timing=None):
+        assert name not in [n for n, _, _ in self.stages], f"There is already a stage named {name}"
+        stage_timing = stage_timing or stage.pipelineTiming()
+        self.stages.append((name, stage, stage_timing))
+        self.valid_depth = _through(self.valid_depth, stage_timing.valid_depth)
+        self.ready_depth = _through(self.ready_depth, stage_timing.ready_depth)
+
+    # The cheapest slice that keeps both paths into the stage within the budget, None if they already are
+    def _sliceFor(self, stage_timing):
+        def within(slice_timing):
+            valid, ready = self.valid_depth, self.ready_depth
+            if slice_timing is not None:
+                valid, ready = _through(valid, slice_timing.valid_depth), _through(ready, slice_timing.ready_depth)
+            valid, ready = _through(valid, stage_timing.valid_depth), _through(ready, stage_timing.ready_depth)
+            return valid <= max(self.depth_budget, stage_timing.valid_depth) and ready <= max(self.depth_budget, stage_timing.ready_depth)
+
+        if within(None):
+            return None
+        for slice_type, slice_timing in [("forward", StageTiming(1, 0, 1)), ("backward", StageTiming(0, 1, 0))]:
+            if within(slice_timing):
+                return slice_type
+        return "full"
+
+    def _slice(self, stream, slice_type):
+        T = type(stream)
+        valid_width = len(stream.valid)
+        if T is ArrayStreamInterface:
+            payload_width = len(stream.payload0)
+        else:
+            payload_width = len(stream.payload)
+        extra_fields = [(f, len(stream[f])) for f in stream._extra_fields]
+        return StreamReg(T, payload_width, valid_width, extra_fields=extra_fields, slice_type=slice_type)
+
+    @property
+    def si(self):
+        return stageStreams(self.stages[0][1])[0]
+
+    @property
+    def so(self):
+        return stageStreams(self.stages[-1][1])[1]
+
+    @property
+    def latency(self):
+        return sum(t.latency for _, _, t in self.stages)
+
+    @property
+    def register_bits(self):
+        return sum(t.register_bits for _, _, t in self.stages)
+
+    @property
+    def buffer_bits(self):
+        return sum(t.buffer_bits for _, _, t in self.stages)
+
+    def report(self):
+        lines = [f"{'stage':<24}{'module':<24}{'latency':>8}{'valid':>6}{'ready':>6}{'registers':>10}{'buffers':>10}"]
+        for name, stage, t in self.stages:
+            lines.append(f"{name:<24}{type(stage).__name__:<24}{t.latency:>8}{t.valid_depth:>6}{t.ready_depth:>6}{t.register_bits:>10}{t.buffer_bits:>10}")
+        lines.append(f"{'total':<48}{self.latency:>8}{'':>12}{self.register_bits:>10}{self.buffer_bits:>10}")
+        return "\n".join(lines)
+
+    def ports(self):
+        return [self.si[f] for f in self.si.fields] + [self.so[f] for f in self.so.fields]
+
+    def elaborate(self, platform):
+        m = Module()
+
+        for name, stage, _ in self.stages:
+            m.submodules[name] = stage
+        for (_, a, _), (_, b, _) in zip(self.stages, self.stages[1:]):
+            m.d.comb += stageStreams(b)[0].stream_eq(stageStreams(a)[1])
+
+        return m
+
+
+class PipelineTest(FHDLTestCase):
+    def test_slices(self):
+        from StreamCompaction import StreamCompaction
+        # Compactions are combinational on both paths, every third one needs a full slice in front of it
+        p = StreamPipeline(depth_budget=2)
+        for i in range(5):
+            p.add(StreamCompaction(3, 8))
+        self.assertEqual([type(s).__name__ for _, s, _ in p.stages],
+                         ["StreamCompaction"]*2 + ["StreamReg"] + ["StreamCompaction"]*2 + ["StreamReg"] + ["StreamCompaction"])
+        self.assertEqual([s.slice_type for _, s, _ in p.stages if isinstance(s, StreamReg)], ["full", "full"])
+        self.assertEqual(p.latency, 2)
+
+        # Only the valid path of a forward slice is registered, a backward slice follows it
+        p = StreamPipeline(depth_budget=1)
+        p.add(StreamReg(BasicStreamInterface, 8, slice_type="forward"))
+        p.add(StreamCompaction(1, 8), ready_depth=0)
+        p.add(StreamCompaction(1, 8), ready_depth=0)
+        p.add(StreamReg(BasicStreamInterface, 8, slice_type="forward"))
+        p.add(StreamReg(BasicStreamInterface, 8, slice_type="forward"))
+        self.assertEqual([s.slice_type for _, s, _ in p.stages if isinstance(s, StreamReg)], ["forward", "forward", "forward", "backward", "forward"])
+        self.assertEqual(p.latency, 4)
+        self.assertEqual(p.register_bits, 5*(8 + 1))
+
+    def test_dedup(self):
+        import re
+        from StreamCompaction import StreamCompaction
+        # The registry the modules use, also when this file is imported under the package name
+        from ElabCache import convert, clearRegistry
+        clearRegistry()
+        p = StreamPipeline(depth_budget=2)
+        for i in range(8):
+            p.add(StreamCompaction(3, 8))
+        text = convert(p, ports=p.ports())
+        modules = re.findall(r"^module \\(\S+)$", text, re.MULTILINE)
+        # The three slices share one body
+        self.assertEqual(len([m for m in modules if m.startswith("StreamReg_")]), 1)
+        self.assertEqual(len(re.findall(r"^\s*cell \\StreamReg_", text, re.MULTILINE)), 3)
+
+    def test_accounting(self):
+        import operator
+        from Algorithms import SortingNet
+        from Stream import StreamFifo
+        p = StreamPipeline()
+        net = p.add(SortingNet(operator.lt, 8, 4))
+        fifo = p.add(StreamFifo(ArrayStreamInterface, 8, 4, depth=16))
+        self.assertEqual(p.latency, net.network.delay + fifo.latency)
+        self.assertEqual(p.buffer_bits, 16*(4 + 4*8))
+        self.assertIn("sortingnet0", p.report())
+
+    def test_stream(self):
+        import random
+        from StreamCompaction import StreamCompaction
+        random.seed(23)
+        p = StreamPipeline(depth_budget=1)
+        for i in range(4):
+            p.add(StreamCompaction(3, 8))
+        sim = Simulator(p)
+        data = [(random.randrange(1, 8), random.randrange(1 << 24)) for _ in range(100)]
+
+        # The valid lanes of a beat, the compaction does not keep their order
+        def lanes(valid, payload):
+            return sorted((payload >> (8*i)) & 0xFF for i in range(3) if (valid >> i) & 1)
+
+        def process():
+            sent, received = 0, []
+            while len(received) < len(data):
+                offer = sent < len(data) and random.random() < 0.7
+                yield p.si.valid.eq(data[sent][0] if offer else 0)
+                yield p.si.payload.eq(data[sent][1] if offer else 0)
+                yield p.so.ready.eq(random.random() < 0.6)
+                yield Settle()
+                if offer and (yield p.si.ready):
+                    sent += 1
+                valid = yield p.so.valid
+                if valid and (yield p.so.ready):
+                    self.assertEqual(valid & (valid + 1), 0)
+                    received.append(lanes(valid, (yield p.so.payload)))
+                yield
+            self.assertEqual(received, [lanes(*d) for d in data])
+
+        sim.add_clock(1e-6)
+        sim.add_sync_process(process)
+        sim.run()
@@ -0,0 +1,194 @@
+import json
+import time
+import tracemalloc
+import unittest
+
+import ElabCache
+
+
+def _describeParameter(p):
+    if isinstance(p, type):
+        return p.__name__
+    if callable(p):
+        return getattr(p, "__qualname__", type(p).__name__)
+    if isinstance(p, tuple):
+        return "(" + ", ".join(_describeParameter(e) for e in p) + ")"
+    return repr(p)
+
+
+class _Frame:
+    def __init__(self, name, params, parent):
+        self.name = name
+        self.params = params
+        self.parent = parent
+        self.stack = (parent.stack if parent is not None else ()) + (name,)
+        self.start = time.perf_counter()
+        self.children = 0.0
+        self.signals = 0
+        self.statements = 0
+        self.memStart = 0
+        self.memMax = 0
+
+
+class ElaborationProfiler:
+    """Records the elaboration of every module decorated with ``@pure``.
+
+    For each module it records the wall time (including and excluding submodules),
+    the peak memory allocated while elaborating it, the number of Signals and
+    statements it created and whether the deduplication registry or the disk cache
+    provided its body.
+
+    Parameters
+    ----------
+    memory : bool
+        Track peak memory with tracemalloc. Slows elaboration down noticeably.
+    verbose : bool
+        Print every elaborated module, like the modules used to do themselves.
+
+    Usage::
+
+        with ElaborationProfiler() as prof:
+            convert(SortingNet(comp=lambda a, b: a < b, N=32))
+        prof.summary()
+        prof.writeJSON("elab.json")
+        prof.writeFolded("elab.folded") # for flamegraph.pl or speedscope
+
+    Modules generated in the workers of ``ElabCache.generateParallel`` are not recorded.
+    """
+    def __init__(self, memory=True, verbose=False):
+        self.memory = memory
+        self.verbose = verbose
+        self.records = []
+        self._frame = None
+        self._started_tracing = False
+
+    def __enter__(self):
+        if ElabCache._profiler is not None:
+            raise RuntimeError("Another ElaborationProfiler is already active")
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        ElabCache._profiler = self
+        return self
+
+    def __exit__(self, *exc):
+        ElabCache._profiler = None
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def enter(self, elaboratable):
+        try:
+            params = _describeParameter(tuple(elaboratable.pureIdentifier()[1:]))
+        except AttributeError:
+            params = ""
+        frame = _Frame(type(elaboratable).__name__, params, self._frame)
+        if self.verbose:
+            print("Elaborating ", frame.name, params)
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            # Hand the peak so far to the parent before starting a new measurement
+            if frame.parent is not None:
+                frame.parent.memMax = max(frame.parent.memMax, peak)
+            tracemalloc.reset_peak()
+            frame.memStart = frame.memMax = current
+        self._frame = frame
+
+    def count(self, signals, statements):
+        self._frame.signals += signals
+        self._frame.statements += statements
+
+    def exit(self, how):
+        frame = self._frame
+        wall = time.perf_counter() - frame.start
+        peak = 0
+        if self.memory:
+            frame.memMax = max(frame.memMax, tracemalloc.get_traced_memory()[1])
+            peak = frame.memMax - frame.memStart
+            if frame.parent is not None:
+                frame.parent.memMax = max(frame.parent.memMax, frame.memMax)
+            tracemalloc.reset_peak()
+        if frame.parent is not None:
+            frame.parent.children += wall
+        self.records.append({
+            "module": frame.name,
+            "params": frame.params,
+            "stack": list(frame.stack),
+            "wall": wall,
+            "self": wall - frame.children,
+            "peak_memory": peak,
+            "signals": frame.signals,
+            "statements": frame.statements,
+            "dedup": how
+        })
+        self._frame = frame.parent
+
+    def summary(self, by_params=True):
+        """Totals per module class, or per class and parameter set, slowest first."""
+        totals = {}
+        for r in self.records:
+            key = (r["module"], r["params"] if by_params else "")
+            t = totals.setdefault(key, {
+                "module": r["module"], "params": key[1], "count": 0, "wall": 0.0, "self": 0.0, "peak_memory": 0,
+                "signals": 0, "statements": 0, "hits": 0, "disk_hits": 0, "misses": 0, "inline": 0
+            })
+            t["count"] += 1
+            t["self"] += r["self"]
+            # Time of a module inside another module of the same class is already counted
+            if by_params or r["module"] not in r["stack"][:-1]:
+                t["wall"] += r["wall"]
+            t["peak_memory"] = max(t["peak_memory"], r["peak_memory"])
+            t["signals"] += r["signals"]
+            t["statements"] += r["statements"]
+            t[{"hit": "hits", "disk": "disk_hits", "miss": "misses"}.get(r["dedup"], "inline")] += 1
+        return sorted(totals.values(), key=lambda t: t["self"], reverse=True)
+
+    def report(self):
+        return {"modules": self.summary(), "classes": self.summary(by_params=False), "records": self.records}
+
+    def writeJSON(self, path):
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=1)
+
+    def folded(self):
+        """Self time per call stack in microseconds, in the folded format of flamegraph.pl."""
+        stacks = {}
+        for r in self.records:
+            s = ";".join(r["stack"])
+            stacks[s] = stacks.get(s, 0) + r["self"]
+        return "".join(f"{s} {round(t*1e6)}\n" for s, t in stacks.items())
+
+    def writeFolded(self, path):
+        with open(path, "w") as f:
+            f.write(self.folded())
+
+
+class ProfilerTest(unittest.TestCase):
+    def test_records(self):
+        import operator
+        from Algorithms import SortingNet
+        ElabCache.clearRegistry()
+        with ElaborationProfiler(memory=False) as prof:
+            ElabCache.convert(SortingNet(operator.lt, 8, 4))
+        self.assertEqual(prof.records[-1]["module"], "SortingNet")
+        swaps = [r for r in prof.records if r["module"] == "Swap2"]
+        self.assertGreater(len(swaps), 1)
+        self.assertEqual([r["dedup"] for r in swaps], ["miss"] + ["hit"]*(len(swaps) - 1))
+        self.assertTrue(all(r["stack"] == ["SortingNet", "Swap2"] for r in swaps))
+
+    def test_inline(self):
+        import operator
+        from amaranth import Module
+        from amaranth.hdl.ir import Fragment
+        from Algorithms import SortingNet
+        with ElaborationProfiler(memory=False) as prof:
+            net = SortingNet(operator.lt, 8, 4)
+            net._MustUse__used = True
+            module = net.elaborate(None)
+            self.assertIsInstance(module, Module)
+            records = len(prof.records)
+            Fragment.get(module, None)
+        # The submodules are elaborated once, inside the module that holds them
+        self.assertEqual(len(prof.records), records)
+        self.assertTrue(all(r["dedup"] == "inline" for r in prof.records))
+        self.assertTrue(all(r["stack"][0] == "SortingNet" and len(r["stack"]) == 2 for r in prof.records[:-1]))
@@ -0,0 +1,467 @@
+import os
+import unittest
+from collections.abc import Mapping
+from functools import lru_cache
+from utils import cl2
+
+# Sorting networks per number of inputs, every network that no other known one beats in both depth and size.
+# The ones with the least number of layers up to 32 inputs are from https://bertdobbelaere.github.io/sorting_networks.html
+# (for inputs 17 and fewer, the depth is optimal), the others are built by NetworkTables.py.
+# One line per network: N, depth, size and the layers separated by |, with comparators as i:j.
+networkTableFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "SortingNetworks.txt")
+
+
+def readNetworkTable(path=networkTableFile):
+    fronts = {}
+    with open(path) as f:
+        for line in f:
+            if line.startswith("#") or not line.strip():
+                continue
+            N, _, _, layers = line.split()
+            fronts.setdefault(int(N), []).append(tuple(tuple(tuple(int(i) for i in c.split(":")) for c in layer.split(",")) for layer in layers.split("|")))
+    return fronts
+
+
+def writeNetworkTable(fronts, path=networkTableFile):
+    with open(path, "w") as f:
+        for N, front in sorted(fronts.items()):
+            for layers in front:
+                f.write(f"{N} {len(layers)} {sum(len(layer) for layer in layers)} " + "|".join(",".join(f"{i}:{j}" for i, j in layer) for layer in layers) + "\n")
+
+
+_fronts = None
+
+def networkFront(N):
+    """The networks for N inputs in the table, from the one with the least layers to the one with the fewest comparators."""
+    global _fronts
+    if _fronts is None:
+        _fronts = readNetworkTable()
+    return _fronts.get(N, [])
+
+
+# How sortingNetwork picks a network from the front: least layers, fewest comparators or the least product of the two
+policies = {
+    "depth": lambda front: front[0],
+    "size": lambda front: front[-1],
+    "pareto": lambda front: min(front, key=lambda layers: len(layers)*sum(len(layer) for layer in layers))
+}
+
+
+class _NetworkTable(Mapping):
+    # dict of N to the layers of the network picked by policy, read on first use
+    def __init__(self, policy):
+        self.policy = policy
+
+    def __getitem__(self, N):
+        front = networkFront(N)
+        if not front:
+            raise KeyError(N)
+        return policies[self.policy](front)
+
+    def __iter__(self):
+        networkFront(0)
+        return iter(sorted(_fronts))
+
+    def __len__(self):
+        networkFront(0)
+        return len(_fronts)
+
+
+perfectSortings = _NetworkTable("depth")
+smallSortings = _NetworkTable("size")
+
+
+class ComparatorNetwork:
+    """Schedule of a comparator network, without any hardware.
+
+    ``layers`` is a tuple of layers of ``(i, j, d)`` comparators with ``i < j``, where
+    ``d`` is the direction given to the comparator, as in the ``swap2`` of the sorters,
+    and ``d`` of the network is the direction of the whole network.
+    ``cuts`` holds the levels, counted in layers passed, that are followed by a register stage.
+    ``parts`` holds the networks this one is built from, the left and right sorter and
+    the merger for a sorter and the left and right merger for a merger, and is empty for
+    networks taken from the table. ``outputs`` are the lanes that make up the result, the
+    first K for a network that only selects the first K of its inputs, and all lanes otherwise.
+    """
+    def __init__(self, N, layers, cuts=(), parts=(), d=1, outputs=None):
+        self.N = N
+        self.layers = layers
+        self.cuts = cuts
+        self.parts = parts
+        self.d = d
+        self.outputs = tuple(range(N)) if outputs is None else tuple(outputs)
+
+    @property
+    def depth(self):
+        return len(self.layers)
+
+    @property
+    def size(self):
+        return sum(len(layer) for layer in self.layers)
+
+    @property
+    def delay(self):
+        return len(self.cuts)
+
+    def comparators(self):
+        for level, layer in enumerate(self.layers, 1):
+            for c in layer:
+                yield level, c
+
+    def withCuts(self, cuts):
+        return ComparatorNetwork(self.N, self.layers, tuple(cuts), self.parts, self.d, self.outputs)
+
+    def liveLanes(self):
+        """Per level, counted in layers passed, the lanes whose value can still reach one of the outputs."""
+        live = set(self.outputs)
+        res = [frozenset(live)]
+        for layer in reversed(self.layers):
+            for i, j, _ in layer:
+                if i in live or j in live:
+                    live |= {i, j}
+            res.append(frozenset(live))
+        return res[::-1]
+
+    def stageDelays(self, comparatorDelay=1):
+        """Longest path through the comparators between each pair of register stages, in the unit of comparatorDelay."""
+        delayOf = _delayFunction(comparatorDelay)
+        arrival = [0]*self.N
+        stages = []
+        for level, layer in enumerate(self.layers, 1):
+            for c in layer:
+                i, j, _ = c
+                arrival[i] = arrival[j] = max(arrival[i], arrival[j]) + delayOf(level, c)
+            if level in self.cuts:
+                stages.append(max(arrival))
+                arrival = [0]*self.N
+        if self.depth not in self.cuts:
+            stages.append(max(arrival, default=0))
+        return stages
+
+    def __repr__(self):
+        return f"ComparatorNetwork(N={self.N}, depth={self.depth}, size={self.size}, cuts={self.cuts})"
+
+
+def isCut(level, registerStride):
+    return registerStride > 0 and (level%registerStride) == (registerStride-1)
+
+
+def _parallel(A, B, offset):
+    layers = []
+    for l in range(max(A.depth, B.depth)):
+        a = A.layers[l] if l < A.depth else ()
+        b = tuple((i+offset, j+offset, d) for i, j, d in B.layers[l]) if l < B.depth else ()
+        layers.append(a + b)
+    return tuple(layers)
+
+
+# Bitonic merger that also works when N is not a power of two: the first layer compares
+# the lanes k apart, where k is the largest power of two below N, and the halves are split at k.
+# The lanes between N-k and k have no comparator in the first layer.
+@lru_cache(maxsize=None)
+def _merge(N, d):
+    if N <= 1:
+        return ComparatorNetwork(N, (), d=d)
+    k = 1 << (cl2(N) - 1)
+    left = _merge(k, d)
+    right = _merge(N-k, d)
+    first = tuple((i, i+k, d) for i in range(N-k))
+    return ComparatorNetwork(N, (first,) + _parallel(left, right, k), parts=(left, right), d=d)
+
+
+def layered(N, comparators):
+    # Puts every comparator in the first layer after the ones it depends on
+    last = [0]*N
+    layers = []
+    for i, j in comparators:
+        l = max(last[i], last[j])
+        if l == len(layers):
+            layers.append([])
+        layers[l].append((i, j))
+        last[i] = last[j] = l+1
+    return tuple(tuple(sorted(layer)) for layer in layers)
+
+
+def untangle(comparators):
+    """Standard form (min to the lower lane) of a network with comparators given as (min lane, max lane).
+
+    A reversed comparator is turned around and the two lanes are renamed in everything after it.
+    """
+    name = {}
+    res = []
+    for a, b in comparators:
+        a, b = name.get(a, a), name.get(b, b)
+        if a < b:
+            res.append((a, b))
+            continue
+        res.append((b, a))
+        old = {v: k for k, v in name.items()}
+        name[old.get(a, a)], name[old.get(b, b)] = b, a
+    return res
+
+
+def prune(M, comparators, fixed):
+    """Removes the lanes in fixed, a dict of lane to -1 or 1 for an input of minus or plus infinity.
+
+    A comparator between a removed lane and a remaining one only moves the remaining value,
+    so it disappears. Returns the network on the remaining lanes, numbered in order.
+    """
+    where = {}
+    n = 0
+    for p in range(M):
+        if p in fixed:
+            where[p] = fixed[p]
+        else:
+            where[p] = (n,)
+            n += 1
+    res = []
+    for p, q in comparators:
+        a, b = where[p], where[q]
+        if isinstance(a, tuple) and isinstance(b, tuple):
+            res.append((a[0], b[0]))
+        elif isinstance(a, tuple):
+            where[p], where[q] = (b, a) if b == -1 else (a, b)
+        elif isinstance(b, tuple):
+            where[p], where[q] = (a, b) if a == -1 else (b, a)
+        else:
+            where[p], where[q] = min(a, b), max(a, b)
+    return untangle(res)
+
+
+def _oddEvenMerge(lanes):
+    if len(lanes) == 2:
+        return [tuple(lanes)]
+    res = _oddEvenMerge(lanes[0::2]) + _oddEvenMerge(lanes[1::2])
+    return res + [(lanes[i], lanes[i+1]) for i in range(1, len(lanes)-1, 2)]
+
+
+def oddEvenMerge(m, n):
+    """Batcher's odd-even merger of a sorted lanes 0..m-1 and a sorted lanes m..m+n-1."""
+    P = 1 << cl2(max(m, n), min1=False)
+    fixed = {p: -1 for p in range(P-m)}
+    fixed.update({p: 1 for p in range(P+n, 2*P)})
+    return prune(2*P, _oddEvenMerge(list(range(2*P))), fixed)
+
+
+def _pairwise(lanes):
+    # Parberry's pairwise network: sort the pairs, the smaller and the larger elements of the pairs, then merge them
+    n = len(lanes)
+    if n < 2:
+        return []
+    res = [(lanes[2*i], lanes[2*i+1]) for i in range(n//2)]
+    res += _pairwise(lanes[0::2]) + _pairwise(lanes[1::2])
+    j = n//4
+    while j >= 1:
+        res += [(lanes[2*i+1], lanes[2*(i+j)]) for i in range(n//2 - j)]
+        j //= 2
+    return res
+
+
+def _directed(N, comparators, d):
+    return tuple(tuple((i, j, d) for i, j in layer) for layer in layered(N, comparators))
+
+
+# How the sorters are built when there is no network for N in the table (or useOptimal is not set)
+constructions = ("bitonic", "oddeven", "pairwise")
+
+# With bitonic the left half is sorted in the opposite direction of the right, which is required by the merger when N is not a power of two.
+# With oddeven both halves are sorted in the direction of the network and merged by an odd-even merger, with as many layers
+# as the bitonic one but fewer comparators. The pairwise network is built for the next power of two, leaving out the lanes
+# above N, which never take part as they would hold the largest values, and has no parts.
+@lru_cache(maxsize=None)
+def _sort(N, useOptimal, d, policy="depth", network="bitonic"):
+    if N <= 1:
+        return ComparatorNetwork(N, (), d=d)
+    if useOptimal and networkFront(N):
+        return ComparatorNetwork(N, tuple(tuple((i, j, d) for i, j in layer) for layer in policies[policy](networkFront(N))), d=d)
+    if network == "pairwise":
+        P = 1 << cl2(N, min1=False)
+        return ComparatorNetwork(N, _directed(N, [(i, j) for i, j in _pairwise(list(range(P))) if j < N], d), d=d)
+    k = N//2
+    if network == "oddeven":
+        left = _sort(k, useOptimal, d, policy, network)
+        merge = ComparatorNetwork(N, _directed(N, oddEvenMerge(k, N-k), d), d=d)
+    else:
+        left = _sort(k, useOptimal, 1-d, policy, network)
+        merge = _merge(N, d)
+    right = _sort(N-k, useOptimal, d, policy, network)
+    return ComparatorNetwork(N, _parallel(left, right, k) + merge.layers, parts=(left, right, merge), d=d)
+
+
+def _pruned(layers, outputs):
+    # Drops the comparators that can not change the value of any lane in outputs, and the layers left empty
+    live = set(outputs)
+    res = []
+    for layer in reversed(layers):
+        kept = tuple(c for c in layer if c[0] in live or c[1] in live)
+        live.update(i for c in kept for i in c[:2])
+        if kept:
+            res.append(kept)
+    return tuple(res[::-1])
+
+
+# The first K lanes of a sorter on N lanes. The K first of both halves are selected, where the left half has at least K lanes,
+# and merged by an odd-even merger pruned to its first K outputs. The sorter for N pruned to its first K outputs
+# is used instead when it is shallower.
+@lru_cache(maxsize=None)
+def _select(N, K, useOptimal, d, policy="depth", network="bitonic"):
+    full = _sort(N, useOptimal, d, policy, network)
+    if K >= N:
+        return full
+    pruned = ComparatorNetwork(N, _pruned(full.layers, range(K)), d=d, outputs=range(K))
+    k = max(K, N//2)
+    left = _select(k, K, useOptimal, d, policy, network)
+    right = _select(N-k, K, useOptimal, d, policy, network)
+    kl, kr = len(left.outputs), len(right.outputs)
+    merge = ComparatorNetwork(kl+kr, _pruned(_directed(kl+kr, oddEvenMerge(kl, kr), d), range(K)), d=d, outputs=range(K))
+    lane = list(range(kl)) + list(range(k, k+kr))
+    layers = _parallel(left, right, k) + tuple(tuple((lane[i], lane[j], dd) for i, j, dd in layer) for layer in merge.layers)
+    tree = ComparatorNetwork(N, layers, parts=(left, right, merge), d=d, outputs=range(K))
+    return min((tree, pruned), key=lambda net: (net.depth, net.size))
+
+
+def registerCuts(depth, registerStride, endOnReg=False):
+    cuts = tuple(l for l in range(1, depth+1) if isCut(l, registerStride))
+    if endOnReg and depth not in cuts:
+        cuts += (depth,)
+    return cuts
+
+
+def comparatorLevels(width):
+    """Rough logic levels of a compare and swap on width bit keys, the comparator tree and the output mux."""
+    return cl2(width, min1=False) + 2
+
+
+def _delayFunction(comparatorDelay):
+    return comparatorDelay if callable(comparatorDelay) else (lambda level, c: comparatorDelay)
+
+
+def timedCuts(net, targetDepth, comparatorDelay=1, endOnReg=False):
+    """Register cuts with the fewest stages that keep every path between two registers within targetDepth.
+
+    comparatorDelay is the delay of one comparator, in the unit of targetDepth, or a function of
+    (level, (i, j, d)) giving it per comparator. Paths are followed per lane, so lanes without a
+    comparator in a layer, as in the bitonic mergers of sizes that are not a power of two, add nothing.
+    Cutting as late as possible gives the fewest cuts.
+    """
+    delayOf = _delayFunction(comparatorDelay)
+    cuts = []
+    arrival = [0]*net.N
+    for level, layer in enumerate(net.layers, 1):
+        for restart in (False, True):
+            new = list(arrival)
+            for c in layer:
+                i, j, _ = c
+                new[i] = new[j] = max(arrival[i], arrival[j]) + delayOf(level, c)
+            if max(new) <= targetDepth:
+                break
+            if restart or level == 1:
+                raise ValueError(f"A comparator in layer {level} alone is deeper than the target depth {targetDepth}")
+            cuts.append(level-1)
+            arrival = [0]*net.N
+        arrival = new
+    if endOnReg and net.depth not in cuts:
+        cuts.append(net.depth)
+    return tuple(cuts)
+
+
+@lru_cache(maxsize=None)
+def sortingNetwork(N, useOptimal=True, registerStride=0, endOnReg=False, d=1, policy="depth", network="bitonic", top_k=None):
+    """Comparator schedule of the sorters, with register cuts every registerStride layers.
+
+    With useOptimal the network comes from the table when it has one for N, picked by policy
+    ("depth", "size" or "pareto"). Others are built as given by network: "bitonic" or "oddeven"
+    from two halves and a merger, or "pairwise". With top_k only the first top_k lanes are
+    sorted, the greatest for d=1 and the smallest for d=0, and ``outputs`` holds those lanes.
+    """
+    if policy not in policies:
+        raise ValueError(f"Unknown network selection policy {policy!r}, expected one of {list(policies)}")
+    if network not in constructions:
+        raise ValueError(f"Unknown sorting network construction {network!r}, expected one of {list(constructions)}")
+    if top_k is not None and top_k < 1:
+        raise ValueError(f"top_k has to be at least 1, not {top_k}")
+    net = _sort(N, useOptimal, d, policy, network) if top_k is None else _select(N, top_k, useOptimal, d, policy, network)
+    return ComparatorNetwork(N, net.layers, registerCuts(net.depth, registerStride, endOnReg), net.parts, d, net.outputs)
+
+
+@lru_cache(maxsize=None)
+def mergingNetwork(N, registerStride=0, endOnReg=False, d=1):
+    """Comparator schedule merging a bitonic sequence, such as two halves sorted in opposite directions."""
+    net = _merge(N, d)
+    return ComparatorNetwork(N, net.layers, registerCuts(net.depth, registerStride, endOnReg), net.parts, d)
+
+
+@lru_cache(maxsize=None)
+def sortedMergingNetwork(A, B, registerStride=0, endOnReg=False, d=1):
+    """Comparator schedule of Batcher's odd-even merger of lanes 0..A-1 and A..A+B-1, both sorted in direction d."""
+    layers = _directed(A+B, oddEvenMerge(A, B), d) if A and B else ()
+    return ComparatorNetwork(A+B, layers, registerCuts(len(layers), registerStride, endOnReg), d=d)
+
+
+def netDepth(width):
+    return sortingNetwork(width if (width in perfectSortings) else (1 << cl2(width))).depth
+
+
+# Router layers of the DistributionNet, [kind, a, b] per router pair where kind is the number of used outputs
+def omegaNet(inputs, outputs):
+    assert inputs >= outputs
+
+    p2 = (1 << cl2(inputs)) == inputs 
+
+    steps = cl2(inputs)
+
+    indirection = [0]*inputs
+    for i, j in enumerate(sum((list(z) for z in zip(range(0,inputs//2), range(inputs//2,inputs))), [])):
+        indirection[j] = i
+
+    def addr(a):
+        #Rotate addr bits 1 step left
+        if p2:
+            assert indirection[a] == ((a & ((1<<(steps-1))-1))<<1) | ((a & (1 << (steps-1))) != 0)
+        
+        return indirection[a]
+
+
+    mask = ((1<<steps)-1) & ~1
+    layers = []
+    for _ in range(steps):
+        layer = []
+        for i in range(inputs//2):
+            a = (addr(i*2) & mask) >> 1
+            b = (addr(i*2 + 1) & mask) >> 1
+            layer.append([0, a, b])
+        layers.append(layer)
+    layers.append([[0, i, i] for i in range(inputs//2)])
+    
+    use = 2#1 if outputs_l2 < inputs_l2 else 2
+    offset = (inputs//2 - outputs//use) // 2 #0
+    shift = 1#(inputs_l2 - outputs_l2)
+    for i in range(0, shift*outputs//use, shift):
+        layers[steps][i+offset][0] = use
+    
+    for s in reversed(range(steps)):
+        for i in range(len(layers[s])):
+            layers[s][i][0] = (layers[s+1][layers[s][i][1]][0] != 0) + (layers[s+1][layers[s][i][2]][0] != 0)
+    
+    return layers
+
+
+class TimedCutsTest(unittest.TestCase):
+    def test_uniform(self):
+        net = sortingNetwork(48)
+        for target in [1, 2, 3, 5]:
+            cuts = timedCuts(net, target)
+            self.assertEqual(len(cuts), (net.depth-1)//target)
+            self.assertTrue(max(net.withCuts(cuts).stageDelays()) <= target)
+        self.assertEqual(timedCuts(net, 2, endOnReg=True)[-1], net.depth)
+        with self.assertRaises(ValueError):
+            timedCuts(net, 2, comparatorDelay=3)
+
+    def test_uneven(self):
+        # Only the comparators within the first four lanes are slow
+        net = mergingNetwork(7)
+        slow = lambda level, c: 3 if c[1] < 4 else 1
+        cuts = timedCuts(net, 4, slow)
+        self.assertTrue(max(net.withCuts(cuts).stageDelays(slow)) <= 4)
+        self.assertLess(len(cuts), len(timedCuts(net, 4, 3)))
+
@@ -4,14 +4,15 @@ from amaranth.tracer import get_var_name
 from typing import Hashable
 from amaranth.lib.data import *
 from amaranth.hdl.ast import ShapeCastable
-from amaranth.lib.fifo import SyncFIFO
+from amaranth.lib.fifo import SyncFIFO, AsyncFIFO
 
 from amaranth.asserts import Assert, Assume, Cover
 from amaranth.sim import Simulator, Delay, Settle, Tick
 
 from fhdl import FHDLTestCase
 
-from utils import ifGen
+from utils import ifGen, cl2, tree_reduce, RoundRobin, StageTiming, streamBits
+from ElabCache import pure
 
 class BasicStreamInterface(StreamInterface, Record):
     
@@ -125,10 +126,28 @@ class ArrayStreamInterface(StreamInterface, Record):
         return assignments
 
 
+# Register slices of StreamReg, the beats they hold and the cycles from input to output without back pressure.
+# All of them pass a beat every cycle while the output is ready.
+#   forward:  valid and payload registered, ready combinational. 1 beat, latency 1.
+#   backward: ready registered, valid and payload pass combinationally unless a beat is held. 1 beat, latency 0.
+#   full:     valid, payload and ready registered, two entries. 2 beats, latency 1.
+#   skid:     ready registered, two entries that only fill under back pressure. 2 beats, latency 0 while empty.
+sliceTypes = {"forward": 1, "backward": 1, "full": 2, "skid": 2}
+
+# Packet framing for the extra_fields of a stream, last marks the final beat of a packet. With packet_lock the joins and
+# distributors keep a packet together, holding their choice from its first beat until its last one.
+framingFields = [("first", 1), ("last", 1)]
+
 class StreamReg(Elaboratable):
 
-    def __init__(self, T=StreamInterface, payload_width=8, valid_width=1, zero_payload_at_nv=False, use_double_buffering=True, max_width=256, optimized_valid_in=False, optimized_valid_out=False, extra_fields=[]):
+    # slice_type is one of sliceTypes, without it use_double_buffering picks full or forward
+    def __init__(self, T=StreamInterface, payload_width=8, valid_width=1, zero_payload_at_nv=False, use_double_buffering=True, max_width=256, optimized_valid_in=False, optimized_valid_out=False, extra_fields=[],
+                 slice_type=None):
         assert(T in [StreamInterface, BasicStreamInterface, ArrayStreamInterface])
+        if slice_type is None:
+            slice_type = "full" if use_double_buffering else "forward"
+        if slice_type not in sliceTypes:
+            raise ValueError(f"Unknown slice type {slice_type!r}, expected one of {list(sliceTypes)}")
         
         self.T_ = {StreamInterface:0, BasicStreamInterface:1, ArrayStreamInterface:2}[T]
 
@@ -140,29 +159,24 @@ class StreamReg(Elaboratable):
         self.zero_payload_at_nv = zero_payload_at_nv
         self.payload_width = payload_width
         self.valid_width = valid_width
-        self.use_double_buffering = use_double_buffering
+        self.slice_type = slice_type
+        self.use_double_buffering = slice_type == "full"
         self.ivalid = Signal()
 
     def ports(self):
-        return [self.si[f] for f in self.si.fields] + [self.so[f] for f in self.so.fields]
+        return [self.si[f] for f in self.si.fields] + [self.so[f] for f in self.so.fields] + [self.ivalid]
 
-    def elaborate(self, platform):
+    def pureIdentifier(self):
+        return (type(self), type(self.si), self.T_, tuple((f, len(self.si[f])) for f in self.si._extra_fields), self.max_width, self.zero_payload_at_nv, self.payload_width, self.valid_width, self.slice_type, self.optimized_valid_in, self.optimized_valid_out)
 
-        m = Module()
+    def pipelineTiming(self):
+        latency, valid_depth, ready_depth = {"forward": (1, 0, 1), "backward": (0, 1, 0), "full": (1, 0, 0), "skid": (0, 1, 0)}[self.slice_type]
+        return StageTiming(latency, valid_depth, ready_depth, register_bits=sliceTypes[self.slice_type]*streamBits(self.si))
 
-        data_in = [field for field in self.si.fields if field not in ["valid", "ready"]]
-        data_out = [field for field in self.so.fields if field not in ["valid", "ready"]]
+    @pure()
+    def elaborate(self, platform):
 
-        if m.setPureIdentifier(type(self), type(self.si), self.T_, tuple(self.si._extra_fields), self.max_width, self.zero_payload_at_nv, self.payload_width, self.valid_width, self.use_double_buffering, self.optimized_valid_in, self.optimized_valid_out):
-            m.submodules += Instance("dummy", i_clk=ClockSignal("sync"), i_rst=ResetSignal("sync"),
-            o_ivalid=self.ivalid,
-            i_si_valid=self.si.valid, o_si_ready=self.si.ready,
-            o_so_valid=self.so.valid, i_so_ready=self.so.ready,
-            **{f"i_si_{f}":self.si[f] for f in data_in},
-            **{f"o_so_{f}":self.so[f] for f in data_out})
-            return m
-        
-        print("Elaborating ", self.__class__.__name__, self)
+        m = Module()
 
 
         for field in self.so.fields:
@@ -219,7 +233,7 @@ class StreamReg(Elaboratable):
                 m.d.comb += input_S.eq(self.si[f][i0:i1])
                 inputs.append(input_S)
             
-        if self.use_double_buffering:
+        if self.slice_type == "full":
             buffer_valid = Signal(self.valid_width)
 
             ready = Signal()
@@ -258,6 +272,82 @@ class StreamReg(Elaboratable):
             
             m.d.comb += self.si.ready.eq(~bv)
 
+        elif self.slice_type in ["backward", "skid"]:
+
+            # The input goes straight to the output while nothing is held
+            def passInput():
+                m.d.comb += self.so.valid.eq(self.si.valid)
+                if self.zero_payload_at_nv:
+                    m.d.comb += [outputs[i].eq(Mux(self.ivalid, inputs[i], 0)) for i in range(len(inputs))]
+                else:
+                    m.d.comb += [outputs[i].eq(inputs[i]) for i in range(len(inputs))]
+                if active_ovalid:
+                    m.d.comb += ovalid.eq(self.ivalid)
+
+            def passBuffer(buffer_valid, buffer):
+                m.d.comb += [self.so.valid.eq(buffer_valid)] + [outputs[i].eq(buffer[i]) for i in range(len(buffer))]
+                if active_ovalid:
+                    m.d.comb += ovalid.eq(1)
+
+            if self.slice_type == "backward":
+                buffer_valid = Signal(self.valid_width)
+                bv = buffer_valid if (self.valid_width == 1 and not self.optimized_valid_in) else Signal()
+
+                m.d.comb += self.si.ready.eq(~bv)
+                with m.If(bv):
+                    passBuffer(buffer_valid, buffer)
+                with m.Else():
+                    passInput()
+
+                with m.If(self.ivalid & ~bv & ~self.so.ready):
+                    m.d.sync += [buffer_valid.eq(self.si.valid)] + [buffer[i].eq(inputs[i]) for i in range(len(inputs))]
+                    if bv is not buffer_valid:
+                        m.d.sync += bv.eq(1)
+                with m.Elif(self.so.ready):
+                    m.d.sync += buffer_valid.eq(0)
+                    if bv is not buffer_valid:
+                        m.d.sync += bv.eq(0)
+
+            else:
+                buffers = [buffer, [Signal(len(b), name=f"{b.name}_1") for b in buffer]]
+                buffer_valid = [Signal(self.valid_width, name=f"buffer_valid{i}") for i in range(2)]
+                count = Signal(range(3))
+                bv = count != 0
+
+                m.d.comb += self.si.ready.eq(count != 2)
+                with m.If(bv):
+                    passBuffer(buffer_valid[0], buffers[0])
+                with m.Else():
+                    passInput()
+
+                push = Signal()
+                pop = Signal()
+                m.d.comb += [
+                    push.eq(self.ivalid & self.si.ready),
+                    pop.eq(ovalid & self.so.ready)
+                ]
+
+                def store(n):
+                    m.d.sync += [buffer_valid[n].eq(self.si.valid)] + [b.eq(i) for b, i in zip(buffers[n], inputs)]
+
+                with m.Switch(count):
+                    with m.Case(0):
+                        with m.If(push & ~pop):
+                            store(0)
+                            m.d.sync += count.eq(1)
+                    with m.Case(1):
+                        with m.If(push & pop):
+                            store(0)
+                        with m.Elif(push):
+                            store(1)
+                            m.d.sync += count.eq(2)
+                        with m.Elif(pop):
+                            m.d.sync += count.eq(0)
+                    with m.Case(2):
+                        with m.If(pop):
+                            m.d.sync += [buffer_valid[0].eq(buffer_valid[1])] + [b0.eq(b1) for b0, b1 in zip(*buffers)]
+                            m.d.sync += count.eq(1)
+
         else:
 
             del buffer
@@ -310,10 +400,33 @@ class StreamReg(Elaboratable):
             with m.Elif(past_output_valid_and_not_ready):
                 m.d.sync += Assert(ovalid & (self.so.payload == past_so_payload))
             
-            past_input_transfere_and_full = Signal()
-            m.d.sync += past_input_transfere_and_full.eq(self.ivalid & self.si.ready & ovalid & (bv if self.use_double_buffering else Const(1)))
-            with m.If(started & past_input_transfere_and_full & ~self.so.ready):
-                m.d.sync += Assert(~self.si.ready)
+            # Beats taken in and not yet passed on never exceed what the slice holds, and arrive with the latency of the slice
+            inflight = Signal(range(sliceTypes[self.slice_type] + 2))
+            m.d.sync += inflight.eq(inflight + (self.ivalid & self.si.ready) - (ovalid & self.so.ready))
+            with m.If(started):
+                m.d.sync += Assert(inflight <= sliceTypes[self.slice_type])
+            if self.slice_type in ["backward", "skid"]:
+                with m.If(started & (inflight == 0) & self.ivalid):
+                    m.d.sync += Assert(ovalid & (Cat(*outputs) == Cat(*inputs)))
+            else:
+                with m.If(started & (inflight == 0)):
+                    m.d.sync += Assert(~ovalid)
+
+            # A cycle with the output ready lets the next input in, at once when ready is combinational
+            past_so_ready = Signal()
+            m.d.sync += past_so_ready.eq(self.so.ready)
+            if self.slice_type == "forward":
+                with m.If(self.so.ready):
+                    m.d.sync += Assert(self.si.ready)
+            else:
+                with m.If(started & past_so_ready):
+                    m.d.sync += Assert(self.si.ready)
+
+            if self.slice_type in ["forward", "full"]:
+                past_input_transfere_and_full = Signal()
+                m.d.sync += past_input_transfere_and_full.eq(self.ivalid & self.si.ready & ovalid & (bv if self.use_double_buffering else Const(1)))
+                with m.If(started & past_input_transfere_and_full & ~self.so.ready):
+                    m.d.sync += Assert(~self.si.ready)
             
             if self.use_double_buffering:
                 with m.If(started & ~bv):
@@ -330,8 +443,11 @@ class StreamReg(Elaboratable):
 
         return m
 
+# latency is the least number of cycles from a beat entering si to it leaving so: 3 through the SyncFIFO and a register for its
+# read data, 2 with fwft where the read data of the SyncFIFO goes straight to the output register, and 1 with bypass, which
+# hands the input to the output register while the FIFO and its read stage are empty
 class StreamFifo(Elaboratable):
-    def __init__(self, T=BasicStreamInterface, payload_width=8, valid_width=1, depth=32, extra_fields=None, memAttrs=None):
+    def __init__(self, T=BasicStreamInterface, payload_width=8, valid_width=1, depth=32, extra_fields=None, memAttrs=None, bypass=False, fwft=False, count_packets=False):
         assert(T in [StreamInterface, BasicStreamInterface, ArrayStreamInterface])
 
         extra_fields = extra_fields or []
@@ -344,19 +460,29 @@ class StreamFifo(Elaboratable):
         self.depth = depth
         self.fill = Signal(range(self.depth+1))
         self.memAttrs = memAttrs
+        self.bypass = bypass
+        self.fwft = fwft
+        self.latency = 1 if bypass else (2 if fwft else 3)
+        # Whole packets in the SyncFIFO, its read stage and the output register, counted by their last beats
+        self.count_packets = count_packets
+        assert not count_packets or "last" in self.si.fields, "count_packets needs a last field"
+        self.packets = Signal(range(self.depth+3))
 
+    def ports(self):
+        return [self.si[f] for f in self.si.fields] + [self.so[f] for f in self.so.fields] + [self.fill] + ([self.packets] if self.count_packets else [])
+
+    def pureIdentifier(self):
+        return (type(self), type(self.si), tuple((f, len(self.si[f])) for f in self.si._extra_fields), self.payload_width, self.valid_width, self.depth, tuple(self.memAttrs.items()) if isinstance(self.memAttrs, dict) else self.memAttrs,
+                self.bypass, self.fwft, self.count_packets)
+
+    # Both paths end in registers, the output register on the valid side and the SyncFIFO on the ready side
+    def pipelineTiming(self):
+        return StageTiming(self.latency, 0, 0, register_bits=streamBits(self.so), buffer_bits=self.depth*streamBits(self.si))
+
+    @pure()
     def elaborate(self, platform):
         m = Module()
 
-        if m.setPureIdentifier(type(self), type(self.si), tuple(self.si._extra_fields), self.payload_width, self.valid_width, self.depth, tuple(self.memAttrs.items()) if isinstance(self.memAttrs, dict) else self.memAttrs):
-            m.submodules += Instance("dummy", i_clk=ClockSignal("sync"), i_rst=ResetSignal("sync"),
-            o_si_ready=self.si.ready, i_so_ready=self.so.ready, o_fill=self.fill,
-            **{f"i_si_{f}":self.si[f] for f in self.si.fields if f != "ready"},
-            **{f"o_so_{f}":self.so[f] for f in self.so.fields if f != "ready"})
-            return m
-        
-        print("Elaborating ", self.__class__.__name__, self)
-
         valid = self.si.valid if self.valid_width <= 1 else self.si.valid.any()
         removed_fields = ["ready"]
         if self.valid_width <= 1:
@@ -366,41 +492,424 @@ class StreamFifo(Elaboratable):
         m.submodules.ouput_reg = output_reg = StreamReg(optimized_valid_in=(self.valid_width > 1),**self.stream_config, use_double_buffering=False)
 
         data_in = Cat(*[self.si[field] for field in self.si.fields if field not in removed_fields])
-        data_out = Cat(*[output_reg.si[field] for field in output_reg.si.fields if field not in removed_fields])
+        data_out = Cat(*[output_reg.si[field] for field in output_reg.si.fields if field not in removed_fields + ["o_valid"]])
         m.d.comb += self.so.stream_eq(output_reg.so)
 
-        m.submodules.fifo = fifo = SyncFIFO(width=len(data_in), depth=self.depth, fwft=False, memAttrs=self.memAttrs)
+        # memAttrs is only understood by the forked SyncFIFO
+        memAttrs = {} if self.memAttrs is None else {"memAttrs":self.memAttrs}
+        m.submodules.fifo = fifo = SyncFIFO(width=len(data_in), depth=self.depth, fwft=self.fwft, **memAttrs)
 
         m.d.comb += [
             self.fill.eq(fifo.level),
             fifo.w_data.eq(data_in),
+            self.si.ready.eq(fifo.w_rdy)
+        ]
+
+        if self.fwft:
+            valid_out = fifo.r_rdy
+            m.d.comb += fifo.r_en.eq(output_reg.si.ready)
+        else:
+            ready = Signal()
+            valid_out = Signal()
+            m.d.comb += ready.eq(output_reg.si.ready | ~valid_out)
+
+            m.d.comb += fifo.r_en.eq(ready)
+            
+            with m.If(fifo.r_rdy & ready):
+                m.d.sync += valid_out.eq(1)
+            with m.Elif(output_reg.si.ready):
+                m.d.sync += valid_out.eq(0)
+
+        output_valid = output_reg.si.valid if self.valid_width <= 1 else output_reg.si.o_valid
+
+        def fromFifo():
+            m.d.comb += [
+                fifo.w_en.eq(valid),
+                output_valid.eq(valid_out),
+                data_out.eq(fifo.r_data)
+            ]
+
+        if self.bypass:
+            # Nothing is waiting in the FIFO or its read stage, so the input can go first
+            bypass = Signal()
+            m.d.comb += bypass.eq(~fifo.r_rdy & ~valid_out)
+            with m.If(bypass):
+                m.d.comb += [
+                    fifo.w_en.eq(valid & ~output_reg.si.ready),
+                    output_valid.eq(valid),
+                    data_out.eq(data_in)
+                ]
+            with m.Else():
+                fromFifo()
+        else:
+            fromFifo()
+
+        if self.count_packets:
+            packet_in = Signal()
+            packet_out = Signal()
+            m.d.comb += [
+                packet_in.eq(valid & self.si.ready & self.si.last),
+                packet_out.eq(self.so.valid.any() & self.so.ready & self.so.last)
+            ]
+            with m.If(packet_in & ~packet_out):
+                m.d.sync += self.packets.eq(self.packets + 1)
+            with m.Elif(packet_out & ~packet_in):
+                m.d.sync += self.packets.eq(self.packets - 1)
+        
+        return m
+
+
+# StreamFifo between two clock domains on an AsyncFIFO, si in w_domain and so behind an output register in r_domain.
+# The depth is rounded up to a power of two. w_fill and r_fill are the fill level as seen by the write and the read side,
+# from the Gray coded pointers that cross between the domains, so w_fill may still count beats that were already read and
+# r_fill may not count beats that were just written yet.
+class AsyncStreamFifo(Elaboratable):
+    def __init__(self, T=BasicStreamInterface, payload_width=8, valid_width=1, depth=32, extra_fields=None, w_domain="write", r_domain="read"):
+        assert(T in [StreamInterface, BasicStreamInterface, ArrayStreamInterface])
+
+        extra_fields = extra_fields or []
+
+        self.si = T(name="si", payload_width=payload_width, valid_width=valid_width, extra_fields=extra_fields)
+        self.so = T(name="so", payload_width=payload_width, valid_width=valid_width, extra_fields=extra_fields)
+        self.stream_config = {"T":T, "payload_width":payload_width, "valid_width":valid_width, "extra_fields":extra_fields}
+        self.payload_width = payload_width
+        self.valid_width = valid_width
+        self.depth = 1 << cl2(depth, min1=False)
+        self.w_domain = w_domain
+        self.r_domain = r_domain
+        self.w_fill = Signal(range(self.depth+1))
+        self.r_fill = Signal(range(self.depth+1))
+
+    def ports(self):
+        return [self.si[f] for f in self.si.fields] + [self.so[f] for f in self.so.fields] + [self.w_fill, self.r_fill]
+
+    def pureIdentifier(self):
+        return (type(self), type(self.si), tuple((f, len(self.si[f])) for f in self.si._extra_fields), self.payload_width, self.valid_width, self.depth, self.w_domain, self.r_domain)
+
+    @pure()
+    def elaborate(self, platform):
+        m = Module()
+
+        valid = self.si.valid if self.valid_width <= 1 else self.si.valid.any()
+        removed_fields = ["ready"]
+        if self.valid_width <= 1:
+            removed_fields.append("valid")
+
+        output_reg = StreamReg(optimized_valid_in=(self.valid_width > 1), **self.stream_config, use_double_buffering=False)
+        m.submodules.output_reg = DomainRenamer(self.r_domain)(output_reg)
+
+        data_in = Cat(*[self.si[field] for field in self.si.fields if field not in removed_fields])
+        data_out = Cat(*[output_reg.si[field] for field in output_reg.si.fields if field not in removed_fields + ["o_valid"]])
+        m.d.comb += self.so.stream_eq(output_reg.so)
+
+        m.submodules.fifo = fifo = AsyncFIFO(width=len(data_in), depth=self.depth, w_domain=self.w_domain, r_domain=self.r_domain)
+
+        output_valid = output_reg.si.valid if self.valid_width <= 1 else output_reg.si.o_valid
+        m.d.comb += [
+            self.w_fill.eq(fifo.w_level),
+            self.r_fill.eq(fifo.r_level),
+            fifo.w_data.eq(data_in),
             fifo.w_en.eq(valid),
             self.si.ready.eq(fifo.w_rdy),
-            data_out.eq(fifo.r_data)
+            data_out.eq(fifo.r_data),
+            output_valid.eq(fifo.r_rdy),
+            fifo.r_en.eq(output_reg.si.ready)
         ]
 
-        ready = Signal()
-        valid_out = Signal()
-        m.d.comb += ready.eq(output_reg.si.ready | ~valid_out)
+        return m
+
+
+# Credit based link without a ready path. The sender starts with credits beats it may send and gets one back on credit_i for
+# every beat the receiver passes on, so any number of registers can sit on tx_valid, tx_data and credit_o between them. A
+# receiver with depth of at least credits never overflows, and credits of at least creditRoundTrip keep one beat every cycle going.
+def creditRoundTrip(forward_stages, backward_stages):
+    return forward_stages + backward_stages + CREDIT_LOOP
+
+
+# Cycles of the credit loop in the sender and the receiver: the sender output register, the two of the fwft StreamFifo of the
+# receiver, the credit register and the sender counter
+CREDIT_LOOP = 5
+
+
+def _linkFields(stream, valid_width):
+    # The fields that go over the link, the valid of a single lane is tx_valid itself
+    removed_fields = ["ready", "o_valid"]
+    if valid_width <= 1:
+        removed_fields.append("valid")
+    return [stream[f] for f in stream.fields if f not in removed_fields]
+
+
+class CreditSender(Elaboratable):
+    def __init__(self, T=BasicStreamInterface, payload_width=8, valid_width=1, credits=8, extra_fields=None):
+        assert(T in [StreamInterface, BasicStreamInterface, ArrayStreamInterface])
+
+        extra_fields = extra_fields or []
 
+        self.si = T(name="si", payload_width=payload_width, valid_width=valid_width, extra_fields=extra_fields)
+        self.payload_width = payload_width
+        self.valid_width = valid_width
+        self.credits = credits
+        self.tx_valid = Signal()
+        self.tx_data = Signal(len(Cat(*_linkFields(self.si, valid_width))), reset_less=True)
+        self.credit_i = Signal()
+
+    def ports(self):
+        return [self.si[f] for f in self.si.fields] + [self.tx_valid, self.tx_data, self.credit_i]
+
+    def pureIdentifier(self):
+        return (type(self), type(self.si), tuple((f, len(self.si[f])) for f in self.si._extra_fields), self.payload_width, self.valid_width, self.credits)
+
+    @pure()
+    def elaborate(self, platform):
+        m = Module()
+
+        valid = self.si.valid if self.valid_width <= 1 else self.si.valid.any()
+        credits = Signal(range(self.credits + 1), reset=self.credits)
+        send = Signal()
+
+        m.d.comb += [
+            self.si.ready.eq(credits != 0),
+            send.eq(valid & self.si.ready)
+        ]
+        m.d.sync += [
+            self.tx_valid.eq(send),
+            self.tx_data.eq(Cat(*_linkFields(self.si, self.valid_width))),
+            credits.eq(credits - send + self.credit_i)
+        ]
+
+        return m
+
+
+class CreditReceiver(Elaboratable):
+    def __init__(self, T=BasicStreamInterface, payload_width=8, valid_width=1, depth=8, extra_fields=None, memAttrs=None):
+        assert(T in [StreamInterface, BasicStreamInterface, ArrayStreamInterface])
+
+        extra_fields = extra_fields or []
+
+        self.so = T(name="so", payload_width=payload_width, valid_width=valid_width, extra_fields=extra_fields)
+        self.stream_config = {"T":T, "payload_width":payload_width, "valid_width":valid_width, "extra_fields":extra_fields}
+        self.payload_width = payload_width
+        self.valid_width = valid_width
+        self.depth = depth
+        self.memAttrs = memAttrs
+        self.rx_valid = Signal()
+        self.rx_data = Signal(len(Cat(*_linkFields(self.so, valid_width))))
+        self.credit_o = Signal()
+
+    def ports(self):
+        return [self.so[f] for f in self.so.fields] + [self.rx_valid, self.rx_data, self.credit_o]
+
+    def pureIdentifier(self):
+        return (type(self), type(self.so), tuple((f, len(self.so[f])) for f in self.so._extra_fields), self.payload_width, self.valid_width, self.depth,
+                tuple(self.memAttrs.items()) if isinstance(self.memAttrs, dict) else self.memAttrs)
+
+    @pure()
+    def elaborate(self, platform):
+        m = Module()
+
+        # The credits guarantee room, so the ready of the FIFO is not needed
+        m.submodules.fifo = fifo = StreamFifo(**self.stream_config, depth=self.depth, memAttrs=self.memAttrs, fwft=True)
+        m.d.comb += self.so.stream_eq(fifo.so)
+
+        offset = 0
+        for field in _linkFields(fifo.si, self.valid_width):
+            data = self.rx_data[offset:offset+len(field)]
+            offset += len(field)
+            if field is fifo.si.valid:
+                m.d.comb += field.eq(Mux(self.rx_valid, data, 0))
+            else:
+                m.d.comb += field.eq(data)
         if self.valid_width <= 1:
-            m.d.comb += output_reg.si.valid.eq(valid_out)
-        else:
-            m.d.comb += output_reg.si.o_valid.eq(valid_out)
+            m.d.comb += fifo.si.valid.eq(self.rx_valid)
+
+        valid = self.so.valid if self.valid_width <= 1 else self.so.valid.any()
+        m.d.sync += self.credit_o.eq(valid & self.so.ready)
 
-        m.d.comb += fifo.r_en.eq(ready)
-        
-        with m.If(fifo.r_rdy & ready):
-            m.d.sync += valid_out.eq(1)
-        with m.Elif(output_reg.si.ready):
-            m.d.sync += valid_out.eq(0)
-        
         return m
 
 
+# A CreditSender and a CreditReceiver with forward_stages registers on the data and backward_stages on the credits between them
+class CreditLink(Elaboratable):
+    def __init__(self, T=BasicStreamInterface, payload_width=8, valid_width=1, forward_stages=2, backward_stages=2, credits=None, extra_fields=None, memAttrs=None):
+        assert(T in [StreamInterface, BasicStreamInterface, ArrayStreamInterface])
+
+        extra_fields = extra_fields or []
+
+        self.stream_config = {"T":T, "payload_width":payload_width, "valid_width":valid_width, "extra_fields":extra_fields}
+        self.si = T(name="si", payload_width=payload_width, valid_width=valid_width, extra_fields=extra_fields)
+        self.so = T(name="so", payload_width=payload_width, valid_width=valid_width, extra_fields=extra_fields)
+        self.payload_width = payload_width
+        self.valid_width = valid_width
+        self.forward_stages = forward_stages
+        self.backward_stages = backward_stages
+        self.credits = creditRoundTrip(forward_stages, backward_stages) if credits is None else credits
+        self.memAttrs = memAttrs
+
+    def ports(self):
+        return [self.si[f] for f in self.si.fields] + [self.so[f] for f in self.so.fields]
+
+    def pureIdentifier(self):
+        return (type(self), type(self.si), tuple((f, len(self.si[f])) for f in self.si._extra_fields), self.payload_width, self.valid_width, self.forward_stages, self.backward_stages, self.credits,
+                tuple(self.memAttrs.items()) if isinstance(self.memAttrs, dict) else self.memAttrs)
+
+    @pure()
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules.sender = sender = CreditSender(**self.stream_config, credits=self.credits)
+        m.submodules.receiver = receiver = CreditReceiver(**self.stream_config, depth=self.credits, memAttrs=self.memAttrs)
+        m.d.comb += [
+            sender.si.stream_eq(self.si),
+            self.so.stream_eq(receiver.so)
+        ]
+
+        valid, data = sender.tx_valid, sender.tx_data
+        for i in range(self.forward_stages):
+            valid_r = Signal(name=f"valid{i}")
+            data_r = Signal(len(data), name=f"data{i}", reset_less=True)
+            m.d.sync += [valid_r.eq(valid), data_r.eq(data)]
+            valid, data = valid_r, data_r
+        m.d.comb += [receiver.rx_valid.eq(valid), receiver.rx_data.eq(data)]
+
+        credit = receiver.credit_o
+        for i in range(self.backward_stages):
+            credit_r = Signal(name=f"credit{i}")
+            m.d.sync += credit_r.eq(credit)
+            credit = credit_r
+        m.d.comb += sender.credit_i.eq(credit)
+
+        return m
+
+
+# Converts a stream of in_lanes lanes of lane_width bits to out_lanes lanes, for any ratio. The lanes keep their order and valid
+# bits, the lanes of a beat without any valid lane are dropped, and the extra fields travel with the lanes, an output beat carrying
+# those of its last lane. An output beat waits until out_lanes lanes are there, or leaves with fewer at a flush: the flush strobe
+# ends it after the lanes taken so far, including a beat taken in the same cycle, and so does an input beat with last set. With
+# framing fields, first is set on the output beat with the first lane of a packet and last on the one with its last lane. The lanes
+# wait in out_lanes + 2*in_lanes - 1 slots, which is enough for one beat every cycle on the narrower side with si.ready taken from
+# registers only.
+class StreamGearbox(Elaboratable):
+    def __init__(self, T=ArrayStreamInterface, lane_width=8, in_lanes=8, out_lanes=32, extra_fields=None):
+        assert(T in [BasicStreamInterface, ArrayStreamInterface])
+
+        extra_fields = extra_fields or []
+
+        def stream(name, lanes):
+            payload_width = lane_width if T is ArrayStreamInterface else lanes*lane_width
+            return T(name=name, payload_width=payload_width, valid_width=lanes, extra_fields=extra_fields)
+
+        self.T = T
+        self.lane_width = lane_width
+        self.in_lanes = in_lanes
+        self.out_lanes = out_lanes
+        self.slots = out_lanes + 2*in_lanes - 1
+        self.si = stream("si", in_lanes)
+        self.so = stream("so", out_lanes)
+        self.flush = Signal()
+
+    def ports(self):
+        return [self.si[f] for f in self.si.fields] + [self.so[f] for f in self.so.fields] + [self.flush]
+
+    def pureIdentifier(self):
+        return (type(self), self.T, tuple((f, len(self.si[f])) for f in self.si._extra_fields), self.lane_width, self.in_lanes, self.out_lanes)
+
+    def pipelineTiming(self):
+        slot_bits = 2 + self.lane_width + sum(len(self.si[f]) for f in self.si._extra_fields)
+        return StageTiming(1, 0, 0, register_bits=self.slots*slot_bits + cl2(self.slots + 1))
+
+    def lanes(self, stream):
+        if self.T is ArrayStreamInterface:
+            return [stream[f"payload{i}"] for i in range(len(stream.valid))]
+        return [stream.payload.word_select(i, self.lane_width) for i in range(len(stream.valid))]
+
+    @pure()
+    def elaborate(self, platform):
+        m = Module()
+
+        for field in self.so.fields:
+            if field not in ["valid", "ready"]:
+                self.so[field].reset_less = True
+
+        IN, OUT = self.in_lanes, self.out_lanes
+        extras = self.si._extra_fields
+        # A slot with end set is the last lane of an output beat. first and last only mark the first and the last lane of a packet.
+        layout = [("valid", 1), ("payload", self.lane_width), ("end", 1)] + [(f, len(self.si[f])) for f in extras]
+        slots = [Record(layout, name=f"slot{j}") for j in range(self.slots)]
+        inputs = []
+        for i, payload in enumerate(self.lanes(self.si)):
+            lane = Record(layout, name=f"lane{i}")
+            m.d.comb += [lane.valid.eq(self.si.valid[i]), lane.payload.eq(payload)] + [lane[f].eq(self.si[f]) for f in extras]
+            if i == IN - 1:
+                m.d.comb += lane.end.eq(self.flush | (self.si.last if "last" in extras else 0))
+            elif "last" in extras:
+                m.d.comb += lane.last.eq(0)
+            if i > 0 and "first" in extras:
+                m.d.comb += lane.first.eq(0)
+            inputs.append(lane)
+
+        count = Signal(range(self.slots + 1))
+        take = Signal(range(1, OUT + 1))
+        avail = Signal()
+        valid = Signal(OUT)
+        push = Signal()
+        pop = Signal()
+        # An output beat ends at the first end among the first out_lanes slots, slots past count never have one
+        m.d.comb += take.eq(OUT)
+        for j in reversed(range(OUT)):
+            with m.If(slots[j].end):
+                m.d.comb += take.eq(j + 1)
+        m.d.comb += [
+            avail.eq((count >= OUT) | Cat(*(s.end for s in slots[:OUT])).any()),
+            valid.eq(Cat(*(s.valid & (j < take) for j, s in enumerate(slots[:OUT])))),
+            self.si.ready.eq(count <= self.slots - IN),
+            push.eq(self.si.valid.any() & self.si.ready),
+            # Beats without a valid lane are not beats at all, so they leave without waiting for ready
+            pop.eq(avail & (self.so.ready | ~valid.any()))
+        ]
+
+        m.d.comb += self.so.valid.eq(Mux(avail, valid, 0))
+        m.d.comb += [o.eq(s.payload) for o, s in zip(self.lanes(self.so), slots)]
+        taken = Array(slots[:OUT])[take - 1]
+        m.d.comb += [self.so[f].eq(taken[f]) for f in extras if f not in ["first", "last"]]
+        if "first" in extras:
+            m.d.comb += self.so.first.eq(Cat(*(s.first & (j < take) for j, s in enumerate(slots[:OUT]))).any())
+        if "last" in extras:
+            m.d.comb += self.so.last.eq(taken.last)
+
+        # The input lanes go after the lanes that stay
+        position = Signal(range(self.slots + 1))
+        m.d.comb += position.eq(count - Mux(pop, take, 0))
+        inputArray = Array(inputs)
+        for j, slot in enumerate(slots):
+            shifted = Array(slots[j + t] if j + t < self.slots else Const(0, len(slot)) for t in range(1, OUT + 1))
+            with m.If(push & (position <= j) & (j < position + IN)):
+                m.d.sync += slot.eq(inputArray[j - position])
+            with m.Elif(pop):
+                m.d.sync += slot.eq(shifted[take - 1])
+            # A flush without an input beat ends the output beat after the lanes that are there
+            with m.If(self.flush & ~push & (j + 1 == position)):
+                m.d.sync += slot.end.eq(1)
+        m.d.sync += count.eq(position + Mux(push, IN, 0))
+
+        return m
+
+
+class StreamUpsizer(StreamGearbox):
+    def __init__(self, T=ArrayStreamInterface, lane_width=8, in_lanes=8, out_lanes=32, extra_fields=None):
+        assert out_lanes >= in_lanes, "An upsizer has at least as many output lanes as input lanes"
+        super().__init__(T, lane_width, in_lanes, out_lanes, extra_fields)
+
+
+class StreamDownsizer(StreamGearbox):
+    def __init__(self, T=ArrayStreamInterface, lane_width=8, in_lanes=32, out_lanes=8, extra_fields=None):
+        assert out_lanes <= in_lanes, "A downsizer has at most as many output lanes as input lanes"
+        super().__init__(T, lane_width, in_lanes, out_lanes, extra_fields)
+
+
 class StreamJoin(Elaboratable):
 
-    def __init__(self, T=StreamInterface, payload_width=8, valid_width=1, max_width=256, optimized_valid_in=False, optimized_valid_out=False, extra_fields=[], fixed_prio=False):
+    def __init__(self, T=StreamInterface, payload_width=8, valid_width=1, max_width=256, optimized_valid_in=False, optimized_valid_out=False, extra_fields=[], fixed_prio=False,
+                 packet_lock=False):
         assert(T in [StreamInterface, BasicStreamInterface, ArrayStreamInterface])
 
         self.max_width = max_width
@@ -412,27 +921,21 @@ class StreamJoin(Elaboratable):
         self.valid_width = valid_width
         self.fixed_prio = fixed_prio
         self.w_prioCounter = "prioCounter" in [e[0] for e in extra_fields]
+        self.packet_lock = packet_lock
+        assert not packet_lock or "last" in self.so.fields, "packet_lock needs a last field"
 
     def ports(self):
-        return [self.si[f] for f in self.si.fields] + [self.so[f] for f in self.so.fields]
+        return sum([[s[f] for f in s.fields] for s in self.si + [self.so]], [])
 
+    def pureIdentifier(self):
+        return (type(self), type(self.so), tuple((f, len(self.so[f])) for f in self.so._extra_fields), self.max_width, self.payload_width, self.valid_width, self.optimized_valid_in, self.optimized_valid_out, self.fixed_prio, self.w_prioCounter,
+                self.packet_lock)
+
+    @pure()
     def elaborate(self, platform):
 
         m = Module()
 
-        data_in = [[field for field in si.fields if field not in ["ready"]] for si in self.si]
-        data_out = [field for field in self.so.fields if field not in ["ready"]]
-
-        if m.setPureIdentifier(type(self), type(self.so), tuple(self.so._extra_fields), self.max_width, self.payload_width, self.valid_width, self.optimized_valid_in, self.optimized_valid_out, self.fixed_prio, self.w_prioCounter):
-            m.submodules += Instance("dummy", i_clk=ClockSignal("sync"), i_rst=ResetSignal("sync"),
-            o_si0_ready=self.si[0].ready, o_si1_ready=self.si[1].ready, i_so_ready=self.so.ready,
-            **{f"i_si0_{f}":self.si[0][f] for f in data_in[0]},
-            **{f"i_si1_{f}":self.si[1][f] for f in data_in[1]},
-            **{f"o_so_{f}":self.so[f] for f in data_out})
-            return m
-        
-        print("Elaborating ", self.__class__.__name__, self)
-        
         for field in self.so.fields:
             if field not in ["valid", "ready"]:
                 self.so[field].reset_less = True
@@ -505,7 +1008,28 @@ class StreamJoin(Elaboratable):
 
         m.d.comb += ready.eq(self.so.ready | ~ovalid)
 
-        if self.fixed_prio:
+        if self.packet_lock:
+            # One input at a time, so the buffer stays empty and a packet is not interleaved with the other input
+            locked = Signal()
+            owner = Signal()
+            grant = Signal()
+            if self.fixed_prio:
+                choice = ~ivalid[0]
+            elif self.w_prioCounter:
+                choice = Mux(ivalid[0] & ivalid[1], self.si[1].prioCounter > self.si[0].prioCounter, ~ivalid[0])
+            else:
+                rr_prio = Signal()
+                choice = Mux(ivalid[0] & ivalid[1], rr_prio, ~ivalid[0])
+            m.d.comb += grant.eq(Mux(locked, owner, choice))
+            m.d.comb += [self.si[i].ready.eq(ready & (grant == i)) for i in range(2)]
+            with m.If(ready & Mux(grant, ivalid[1], ivalid[0])):
+                m.d.sync += [
+                    locked.eq(~Mux(grant, self.si[1].last, self.si[0].last)),
+                    owner.eq(grant)
+                ]
+                if (not self.fixed_prio) and (not self.w_prioCounter):
+                    m.d.sync += rr_prio.eq(~grant)
+        elif self.fixed_prio:
             m.d.comb += self.si[0].ready.eq(ready )
             m.d.comb += self.si[1].ready.eq(ready & (~bv))
         else:
@@ -556,7 +1080,7 @@ class StreamJoin(Elaboratable):
 
 class StreamJoin2(Elaboratable):
 
-    def __init__(self, T=StreamInterface, payload_width=8, valid_width=1, max_width=256, optimized_valid_in=False, optimized_valid_out=False, extra_fields=[]):
+    def __init__(self, T=StreamInterface, payload_width=8, valid_width=1, max_width=256, optimized_valid_in=False, optimized_valid_out=False, extra_fields=[], packet_lock=False):
         assert(T in [StreamInterface, BasicStreamInterface, ArrayStreamInterface])
 
         self.max_width = max_width
@@ -568,29 +1092,23 @@ class StreamJoin2(Elaboratable):
         self.valid_width = valid_width
         self.extra_fields = extra_fields
         self.w_prioCounter = "prioCounter" in [e[0] for e in extra_fields]
+        self.packet_lock = packet_lock
+        assert not packet_lock or "last" in self.so.fields, "packet_lock needs a last field"
 
     def ports(self):
-        return [self.si[f] for f in self.si.fields] + [self.so[f] for f in self.so.fields]
+        return sum([[s[f] for f in s.fields] for s in self.si + [self.so]], [])
+
+    def pureIdentifier(self):
+        return (type(self), type(self.so), tuple((f, len(self.so[f])) for f in self.so._extra_fields), self.max_width, self.payload_width, self.valid_width, self.optimized_valid_in, self.optimized_valid_out, self.w_prioCounter,
+                self.packet_lock)
 
+    @pure()
     def elaborate(self, platform):
         
         assert self.w_prioCounter
 
         m = Module()
 
-        data_in = [[field for field in si.fields if field not in ["ready"]] for si in self.si]
-        data_out = [field for field in self.so.fields if field not in ["ready"]]
-
-        if m.setPureIdentifier(type(self), type(self.so), tuple(self.so._extra_fields), self.max_width, self.payload_width, self.valid_width, self.optimized_valid_in, self.optimized_valid_out, self.w_prioCounter):
-            m.submodules += Instance("dummy", i_clk=ClockSignal("sync"), i_rst=ResetSignal("sync"),
-            o_si0_ready=self.si[0].ready, o_si1_ready=self.si[1].ready, i_so_ready=self.so.ready,
-            **{f"i_si0_{f}":self.si[0][f] for f in data_in[0]},
-            **{f"i_si1_{f}":self.si[1][f] for f in data_in[1]},
-            **{f"o_so_{f}":self.so[f] for f in data_out})
-            return m
-        
-        print("Elaborating ", self.__class__.__name__, self)
-
 
         m.submodules.ireg0 = ireg0 = StreamReg(type(self.si[0]), self.payload_width, self.valid_width, False, False, self.max_width, self.optimized_valid_in, True, self.extra_fields)
         m.submodules.ireg1 = ireg1 = StreamReg(type(self.si[0]), self.payload_width, self.valid_width, False, False, self.max_width, self.optimized_valid_in, True, self.extra_fields)
@@ -666,7 +1184,18 @@ class StreamJoin2(Elaboratable):
             i_si[1].ready.eq(ready & ((rr_prio==1)))
         ]
 
-        with m.If(ready):
+        # rr_prio stays on the input of an unfinished packet
+        hold = Signal()
+        if self.packet_lock:
+            locked = Signal()
+            transfer = Signal()
+            m.d.comb += [
+                transfer.eq(Mux(rr_prio, i_si[1].ready & i_si[1].o_valid, i_si[0].ready & i_si[0].o_valid)),
+                hold.eq(Mux(transfer, ~Mux(rr_prio, i_si[1].last, i_si[0].last), locked))
+            ]
+            m.d.sync += locked.eq(hold)
+
+        with m.If(ready & ~hold):
             with m.If(ireg0.ivalid & ireg1.ivalid):
                 m.d.sync += last_rr_prio.eq(Cat(rr_prio, *(last_rr_prio[:9])))
                 with m.If(last_rr_prio.all() | ~(last_rr_prio.any())):
@@ -697,9 +1226,169 @@ class StreamJoin2(Elaboratable):
         
         return m
 
+# Merges n input streams in a single arbitration stage over all of them. The policies:
+#   fixed:      the lowest valid input wins.
+#   roundrobin: the first valid input after the last winner wins, the RoundRobin from utils keeps the last winner.
+#   prio:       the valid input with the greatest prioCounter wins, the lowest one on a tie.
+#   drr:        deficit round robin. The input keeps the grant while it is valid and has deficit left, every beat costs 1 or,
+#               with cost="lanes", its number of valid lanes. The next valid input after it then gets quanta[i] added to its
+#               deficit and passes a beat in the same cycle. An input that goes idle loses the deficit it has left.
+# With packet_lock an input keeps the grant from the first beat of a packet until its last one, drr charges the whole
+# packet and lets the deficit go down to -max_packet beats.
+# With output_reg the winner goes through a full StreamReg, so the merge costs one cycle and si.ready comes from registers.
+class StreamJoinN(Elaboratable):
+    def __init__(self, T=StreamInterface, payload_width=8, valid_width=1, n=4, policy="roundrobin", output_reg=True, max_width=256, extra_fields=None,
+                 quanta=None, cost="beats", packet_lock=False, max_packet=64):
+        assert(T in [StreamInterface, BasicStreamInterface, ArrayStreamInterface])
+        assert n >= 2, "A join needs at least two inputs"
+        if policy not in ["fixed", "roundrobin", "prio", "drr"]:
+            raise ValueError(f"Unknown policy {policy!r}, expected one of ['fixed', 'roundrobin', 'prio', 'drr']")
+        if cost not in ["beats", "lanes"]:
+            raise ValueError(f"Unknown cost {cost!r}, expected one of ['beats', 'lanes']")
+        quanta = tuple(quanta) if quanta is not None else (valid_width if cost == "lanes" else 1,)*n
+        assert len(quanta) == n, "One quantum per input"
+        # A quantum of at least the largest cost lets every input pass a beat as soon as it gets the grant
+        assert min(quanta) >= (valid_width if cost == "lanes" else 1), "A quantum can not be below the cost of one beat"
+
+        extra_fields = extra_fields or []
+        assert policy != "prio" or "prioCounter" in [e[0] for e in extra_fields], "The prio policy needs a prioCounter field"
+
+        self.T = T
+        self.si = [T(name=f"si{i}", payload_width=payload_width, valid_width=valid_width, extra_fields=extra_fields) for i in range(n)]
+        self.so = T(name="so", payload_width=payload_width, valid_width=valid_width, extra_fields=extra_fields)
+        self.payload_width = payload_width
+        self.valid_width = valid_width
+        self.n = n
+        self.policy = policy
+        self.output_reg = output_reg
+        self.max_width = max_width
+        self.extra_fields = extra_fields
+        self.quanta = quanta
+        self.cost = cost
+        self.packet_lock = packet_lock
+        self.max_packet = max_packet
+        assert not packet_lock or "last" in self.so.fields, "packet_lock needs a last field"
+        self.latency = 1 if output_reg else 0
+
+    def ports(self):
+        return sum([[s[f] for f in s.fields] for s in self.si + [self.so]], [])
+
+    def pureIdentifier(self):
+        return (type(self), self.T, tuple((f, len(self.so[f])) for f in self.so._extra_fields), self.payload_width, self.valid_width, self.n, self.policy, self.output_reg, self.max_width,
+                (self.quanta, self.cost) if self.policy == "drr" else None, self.packet_lock, self.max_packet if self.packet_lock and self.policy == "drr" else None)
+
+    @pure()
+    def elaborate(self, platform):
+        m = Module()
+
+        if self.output_reg:
+            m.submodules.oreg = oreg = StreamReg(self.T, self.payload_width, self.valid_width, False, True, self.max_width, False, False, self.extra_fields)
+            m.d.comb += self.so.stream_eq(oreg.so)
+            joined = oreg.si
+        else:
+            joined = self.so
+
+        requests = Signal(self.n)
+        m.d.comb += requests.eq(Cat(*(si.valid.any() for si in self.si)))
+        grant = Signal(range(self.n))
+        choice = Signal(range(self.n))
+        transfer = Signal()
+        m.d.comb += transfer.eq(joined.valid.any() & joined.ready)
+
+        # While locked the input of the last transfer keeps the grant, until the last beat of its packet
+        locked = Signal()
+        if self.packet_lock:
+            with m.If(transfer):
+                m.d.sync += locked.eq(~joined.last)
+            if self.policy != "drr":
+                owner = Signal(range(self.n))
+                with m.If(transfer):
+                    m.d.sync += owner.eq(grant)
+                m.d.comb += grant.eq(Mux(locked, owner, choice))
+        elif self.policy != "drr":
+            m.d.comb += grant.eq(choice)
+
+        if self.policy == "fixed":
+            for i in reversed(range(self.n)):
+                with m.If(requests[i]):
+                    m.d.comb += choice.eq(i)
+        elif self.policy == "roundrobin":
+            m.submodules.rr = rr = EnableInserter(transfer & ~locked)(RoundRobin(count=self.n))
+            m.d.comb += rr.requests.eq(requests)
+            # The same rotation as the RoundRobin, taken from its state combinationally so the winner passes this cycle
+            for i in reversed(range(self.n)):
+                with m.If(requests[i]):
+                    m.d.comb += choice.eq(i)
+            for i in reversed(range(self.n)):
+                with m.If(requests[i] & (rr.grant < i)):
+                    m.d.comb += choice.eq(i)
+        elif self.policy == "drr":
+            max_cost = self.valid_width if self.cost == "lanes" else 1
+            # A locked packet may overdraw by up to max_packet beats, the deficit saturates below that
+            floor = 1 - max_cost*(self.max_packet if self.packet_lock else 1)
+            current = Signal(range(self.n))
+            deficit = Array(Signal(range(floor, max(self.quanta) + 1), name=f"deficit{i}") for i in range(self.n))
+            quanta = Array(Const(q, range(max(self.quanta) + 1)) for q in self.quanta)
+            hold = Signal()
+            following = Signal(range(self.n))
+            m.d.comb += hold.eq(locked | (requests.bit_select(current, 1) & (deficit[current] > 0)))
+            for i in reversed(range(self.n)):
+                with m.If(requests[i]):
+                    m.d.comb += following.eq(i)
+            for i in reversed(range(self.n)):
+                with m.If(requests[i] & (current < i)):
+                    m.d.comb += following.eq(i)
+            m.d.comb += grant.eq(Mux(hold, current, following))
+
+            cost = Signal(range(max_cost + 1))
+            if self.cost == "lanes":
+                m.d.comb += cost.eq(sum(joined.valid[k] for k in range(self.valid_width)))
+            else:
+                m.d.comb += cost.eq(1)
+            with m.If(~requests.bit_select(current, 1) & (deficit[current] > 0) & ~locked):
+                m.d.sync += deficit[current].eq(0)
+            with m.If(transfer):
+                with m.If(hold):
+                    if self.packet_lock:
+                        with m.If(deficit[current] - cost < floor):
+                            m.d.sync += deficit[current].eq(floor)
+                        with m.Else():
+                            m.d.sync += deficit[current].eq(deficit[current] - cost)
+                    else:
+                        m.d.sync += deficit[current].eq(deficit[current] - cost)
+                with m.Else():
+                    m.d.sync += [
+                        current.eq(following),
+                        deficit[following].eq(deficit[following] + quanta[following] - cost)
+                    ]
+        else:
+            def better(a, b):
+                av, ap, ai = a
+                bv, bp, bi = b
+                take_b = Signal()
+                v, p, i = Signal(), Signal.like(ap), Signal.like(grant)
+                m.d.comb += [
+                    take_b.eq(bv & (~av | (bp > ap))),
+                    v.eq(av | bv),
+                    p.eq(Mux(take_b, bp, ap)),
+                    i.eq(Mux(take_b, bi, ai))
+                ]
+                return v, p, i
+            _, _, winner = tree_reduce(better, [(requests[i], si.prioCounter, i) for i, si in enumerate(self.si)])
+            m.d.comb += choice.eq(winner)
+
+        for f in joined.fields:
+            if f == "ready":
+                continue
+            m.d.comb += joined[f].eq(Array(si[f] for si in self.si)[grant])
+        m.d.comb += [si.ready.eq(joined.ready & (grant == i)) for i, si in enumerate(self.si)]
+
+        return m
+
+
 class StreamDistribute_2to2(Elaboratable):
 
-    def __init__(self, T=StreamInterface, payload_width=8, valid_width=1, max_width=256, optimized_valid_in=False, optimized_valid_out=False, extra_fields=[]):
+    def __init__(self, T=StreamInterface, payload_width=8, valid_width=1, max_width=256, optimized_valid_in=False, optimized_valid_out=False, extra_fields=[], packet_lock=False):
         assert(T in [StreamInterface, BasicStreamInterface, ArrayStreamInterface])
 
         self.max_width = max_width
@@ -709,31 +1398,22 @@ class StreamDistribute_2to2(Elaboratable):
         self.so = [T(name=f"so{i}", payload_width=payload_width, valid_width=valid_width, extra_fields=([('o_valid', 1)] if self.optimized_valid_out else [])+extra_fields) for i in range(2)]
         self.payload_width = payload_width
         self.valid_width = valid_width
+        self.packet_lock = packet_lock
+        assert not packet_lock or "last" in self.so[0].fields, "packet_lock needs a last field"
 
 
     def ports(self):
         return sum([[s[f] for f in s.fields] for s in self.si + self.so], [])
 
+    def pureIdentifier(self):
+        return (type(self), type(self.si[0]), tuple((f, len(self.si[0][f])) for f in self.si[0]._extra_fields), self.max_width, self.payload_width, self.valid_width, self.optimized_valid_in, self.optimized_valid_out,
+                self.packet_lock)
+
+    @pure()
     def elaborate(self, platform):
 
         m = Module()
 
-        data_in = [[field for field in si.fields if field not in ["ready"]] for si in self.si]
-        data_out = [[field for field in so.fields if field not in ["ready"]] for so in self.so]
-
-        if m.setPureIdentifier(type(self), type(self.si[0]), tuple(self.si[0]._extra_fields), self.max_width, self.payload_width, self.valid_width, self.optimized_valid_in, self.optimized_valid_out):
-            m.submodules += Instance("dummy", i_clk=ClockSignal("sync"), i_rst=ResetSignal("sync"),
-            o_si0_ready=self.si[0].ready, o_si1_ready=self.si[1].ready,
-            i_so0_ready=self.so[0].ready, i_so1_ready=self.so[1].ready,
-            **{f"i_si0_{f}":self.si[0][f] for f in data_in[0]},
-            **{f"i_si1_{f}":self.si[1][f] for f in data_in[1]},
-            **{f"o_so0_{f}":self.so[0][f] for f in data_out[0]},
-            **{f"o_so1_{f}":self.so[1][f] for f in data_out[1]}
-            )
-            return m
-        
-        print("Elaborating ", self.__class__.__name__, self)
-        
         for so in self.so:
             for field in so.fields:
                 if field not in ["valid", "ready"]:
@@ -797,6 +1477,10 @@ class StreamDistribute_2to2(Elaboratable):
         buffer_valid = Signal(self.valid_width)
         ready = [Signal(name=f"ready{i}") for i in range(2)]
         m.d.comb += [ready[i].eq(self.so[i].ready | ~(ovalid[i])) for i in range(2)]
+
+        if self.packet_lock:
+            self.elaboratePackets(m, ivalid, ovalid, active_ovalid, ready, inputs, outputs)
+            return m
         if self.optimized_valid_in:
             bv = Signal()
         elif self.valid_width==1:
@@ -889,6 +1573,61 @@ class StreamDistribute_2to2(Elaboratable):
 
         return m
 
+    # Every input goes straight to an output register, so both inputs can pass a beat in the same cycle. An input in the middle
+    # of a packet is bound to the output its first beat went to, and the other input may not use that output until the last beat.
+    def elaboratePackets(self, m, ivalid, ovalid, active_ovalid, ready, inputs, outputs):
+        bound = [Signal(name=f"bound{i}") for i in range(2)]
+        route = [Signal(name=f"route{i}") for i in range(2)]
+        rr_prio = Signal()
+
+        # The input first in line picks an output, then the other one picks from what is left
+        def pick(i, taken):
+            ok = Signal(name=f"ok{i}_{taken is not None}")
+            out = Signal(name=f"out{i}_{taken is not None}")
+            usable = [ready[o] & ~(bound[not i] & (route[not i] == o)) for o in range(2)]
+            if taken is not None:
+                usable = [u & ~(taken[0] & (taken[1] == o)) for o, u in enumerate(usable)]
+            with m.If(bound[i]):
+                m.d.comb += [out.eq(route[i]), ok.eq(Mux(route[i], usable[1], usable[0]))]
+            with m.Else():
+                m.d.comb += [out.eq(~usable[0]), ok.eq(usable[0] | usable[1])]
+            return ok, out
+
+        ok = [Signal(name=f"ok{i}") for i in range(2)]
+        out = [Signal(name=f"out{i}") for i in range(2)]
+        for first in range(2):
+            ok_first, out_first = pick(first, None)
+            ok_second, out_second = pick(not first, (ok_first & ivalid[first], out_first))
+            with m.If(rr_prio == first):
+                m.d.comb += [
+                    ok[first].eq(ok_first), out[first].eq(out_first),
+                    ok[not first].eq(ok_second), out[not first].eq(out_second)
+                ]
+
+        transfer = [Signal(name=f"transfer{i}") for i in range(2)]
+        m.d.comb += [transfer[i].eq(ok[i] & ivalid[i]) for i in range(2)]
+        m.d.comb += [self.si[i].ready.eq(ok[i]) for i in range(2)]
+
+        for i in range(2):
+            with m.If(transfer[i]):
+                m.d.sync += [
+                    bound[i].eq(~self.si[i].last),
+                    route[i].eq(out[i])
+                ]
+        with m.If(transfer[0] | transfer[1]):
+            m.d.sync += rr_prio.eq(~rr_prio)
+
+        for o in range(2):
+            for i, ifTransfer in enumerate(ifGen(m, (transfer[i] & (out[i] == o) for i in range(2)), withElse=False, startFromIf=True)):
+                with ifTransfer:
+                    m.d.sync += [self.so[o].valid.eq(self.si[i].valid)] + [x.eq(y) for x, y in zip(outputs[o], inputs[i])]
+                    if active_ovalid:
+                        m.d.sync += ovalid[o].eq(1)
+            with m.Elif(self.so[o].ready):
+                m.d.sync += self.so[o].valid.eq(0)
+                if active_ovalid:
+                    m.d.sync += ovalid[o].eq(0)
+
 
 class StreamDistribute_1to2(Elaboratable):
 
@@ -910,25 +1649,14 @@ class StreamDistribute_1to2(Elaboratable):
     def ports(self):
         return sum([[s[f] for f in s.fields] for s in [self.si] + self.so], [])
 
+    def pureIdentifier(self):
+        return (type(self), type(self.si), tuple((f, len(self.si[f])) for f in self.si._extra_fields), self.max_width, self.payload_width, self.valid_width, self.optimized_valid_in, self.optimized_valid_out, self.zero_payload_at_nv)
+
+    @pure()
     def elaborate(self, platform):
 
         m = Module()
 
-        data_in = [field for field in self.si.fields if field not in ["ready"]]
-        data_out = [[field for field in so.fields if field not in ["ready"]] for so in self.so]
-
-        if m.setPureIdentifier(type(self), type(self.si), tuple(self.si._extra_fields), self.max_width, self.payload_width, self.valid_width, self.optimized_valid_in, self.optimized_valid_out, self.zero_payload_at_nv):
-            m.submodules += Instance("dummy", i_clk=ClockSignal("sync"), i_rst=ResetSignal("sync"),
-            o_si0_ready=self.si.ready,
-            i_so0_ready=self.so[0].ready, i_so1_ready=self.so[1].ready,
-            **{f"i_si_{f}":self.si[f] for f in data_in},
-            **{f"o_so0_{f}":self.so[0][f] for f in data_out[0]},
-            **{f"o_so1_{f}":self.so[1][f] for f in data_out[1]}
-            )
-            return m
-        
-        print("Elaborating ", self.__class__.__name__, self)
-        
         for so in self.so:
             for field in so.fields:
                 if field not in ["valid", "ready"]:
@@ -1017,8 +1745,895 @@ class StreamDistribute_1to2(Elaboratable):
 
         return m
 
+# Passes each beat of si to one of n registered outputs, chosen among the outputs that can take it. The policies:
+#   roundrobin: the first output after the last chosen one, the RoundRobin from utils keeps the last choice.
+#   lru:        the output chosen the longest time ago.
+#   fill:       the output with the fewest beats downstream, from the fill inputs (e.g. the fill of a StreamFifo behind it)
+#               plus the beat in its own output register, the lowest one on a tie.
+# With packet_lock the beats of a packet all go to the output its first beat went to.
+class StreamDistributeN(Elaboratable):
+    def __init__(self, T=StreamInterface, payload_width=8, valid_width=1, n=4, policy="roundrobin", fill_width=8, extra_fields=None, packet_lock=False):
+        assert(T in [StreamInterface, BasicStreamInterface, ArrayStreamInterface])
+        assert n >= 2, "A distributor needs at least two outputs"
+        if policy not in ["roundrobin", "lru", "fill"]:
+            raise ValueError(f"Unknown policy {policy!r}, expected one of ['roundrobin', 'lru', 'fill']")
+
+        extra_fields = extra_fields or []
+
+        self.T = T
+        self.si = T(name="si", payload_width=payload_width, valid_width=valid_width, extra_fields=extra_fields)
+        self.so = [T(name=f"so{i}", payload_width=payload_width, valid_width=valid_width, extra_fields=extra_fields) for i in range(n)]
+        self.payload_width = payload_width
+        self.valid_width = valid_width
+        self.n = n
+        self.policy = policy
+        self.fill_width = fill_width
+        self.fill = [Signal(fill_width, name=f"fill{i}") for i in range(n)] if policy == "fill" else []
+        self.packet_lock = packet_lock
+        assert not packet_lock or "last" in self.si.fields, "packet_lock needs a last field"
+
+    def ports(self):
+        return sum([[s[f] for f in s.fields] for s in [self.si] + self.so], []) + self.fill
+
+    def pureIdentifier(self):
+        return (type(self), self.T, tuple((f, len(self.si[f])) for f in self.si._extra_fields), self.payload_width, self.valid_width, self.n, self.policy,
+                self.fill_width if self.policy == "fill" else None, self.packet_lock)
+
+    @pure()
+    def elaborate(self, platform):
+        m = Module()
+
+        for so in self.so:
+            for field in so.fields:
+                if field not in ["valid", "ready"]:
+                    so[field].reset_less = True
+
+        free = Signal(self.n)
+        m.d.comb += free.eq(Cat(*(so.ready | ~so.valid.any() for so in self.so)))
+        transfer = Signal()
+        m.d.comb += transfer.eq(self.si.valid.any() & self.si.ready)
+        grant = Signal(range(self.n))
+        choice = Signal(range(self.n))
+
+        # While locked the rest of a packet follows its first beat to the same output
+        locked = Signal()
+        if self.packet_lock:
+            owner = Signal(range(self.n))
+            with m.If(transfer):
+                m.d.sync += [locked.eq(~self.si.last), owner.eq(grant)]
+            m.d.comb += [
+                grant.eq(Mux(locked, owner, choice)),
+                self.si.ready.eq(Mux(locked, free.bit_select(owner, 1), free.any()))
+            ]
+        else:
+            m.d.comb += [
+                grant.eq(choice),
+                self.si.ready.eq(free.any())
+            ]
+
+        if self.policy == "roundrobin":
+            m.submodules.rr = rr = EnableInserter(transfer & ~locked)(RoundRobin(count=self.n))
+            m.d.comb += rr.requests.eq(free)
+            # The same rotation as the RoundRobin, taken from its state combinationally so the beat leaves this cycle
+            for i in reversed(range(self.n)):
+                with m.If(free[i]):
+                    m.d.comb += choice.eq(i)
+            for i in reversed(range(self.n)):
+                with m.If(free[i] & (rr.grant < i)):
+                    m.d.comb += choice.eq(i)
+        elif self.policy == "lru":
+            # order[0] is the least recently chosen output, the chosen one moves to the end
+            order = [Signal(range(self.n), name=f"order{k}", reset=k) for k in range(self.n)]
+            position = Signal(range(self.n))
+            for k in reversed(range(self.n)):
+                with m.If(free.bit_select(order[k], 1)):
+                    m.d.comb += [choice.eq(order[k]), position.eq(k)]
+            with m.If(transfer & ~locked):
+                for k in range(self.n - 1):
+                    with m.If(position <= k):
+                        m.d.sync += order[k].eq(order[k+1])
+                m.d.sync += order[-1].eq(choice)
+        else:
+            def fewer(a, b):
+                av, af, ai = a
+                bv, bf, bi = b
+                take_b = Signal()
+                v, f, i = Signal(), Signal.like(af), Signal.like(grant)
+                m.d.comb += [
+                    take_b.eq(bv & (~av | (bf < af))),
+                    v.eq(av | bv),
+                    f.eq(Mux(take_b, bf, af)),
+                    i.eq(Mux(take_b, bi, ai))
+                ]
+                return v, f, i
+            occupancy = [Signal(self.fill_width + 1, name=f"occupancy{i}") for i in range(self.n)]
+            m.d.comb += [o.eq(fill + so.valid.any()) for o, fill, so in zip(occupancy, self.fill, self.so)]
+            _, _, winner = tree_reduce(fewer, [(free[i], o, i) for i, o in enumerate(occupancy)])
+            m.d.comb += choice.eq(winner)
+
+        for i, so in enumerate(self.so):
+            with m.If(transfer & (grant == i)):
+                m.d.sync += [so[f].eq(self.si[f]) for f in so.fields if f != "ready"]
+            with m.Elif(so.ready):
+                m.d.sync += so.valid.eq(0)
+
+        return m
+
+
+# Counts what happens on a stream without driving any of it, for any record with valid and ready: the stream interfaces as
+# well as the AXI4 channels. cycles, transfers, lanes (the valid lanes of the transfers), stalls (valid & ~ready), idles
+# (~valid & ready), longest_stall (the longest run of stall cycles) and, on streams with a last field, packets.
+# take_snapshot copies all of them in the same cycle to snapshot[name], with the values from before that cycle, and clear
+# restarts them from that cycle on, so both at once measure back to back intervals without losing a cycle.
+# With saturate the counters stop at their maximum, otherwise they wrap.
+class StreamMonitor(Elaboratable):
+    def __init__(self, stream, counter_width=32, saturate=True):
+        self.stream = stream
+        self.valid_width = len(stream.valid)
+        self.counter_width = counter_width
+        self.saturate = saturate
+        self.w_last = "last" in stream.fields
+        names = ["cycles", "transfers", "lanes", "stalls", "idles", "longest_stall"] + (["packets"] if self.w_last else [])
+        self.counters = {n: Signal(counter_width, name=n) for n in names}
+        self.snapshot = {n: Signal(counter_width, name=f"snapshot_{n}") for n in names}
+        self.take_snapshot = Signal()
+        self.clear = Signal()
+
+    def ports(self):
+        observed = [self.stream.valid, self.stream.ready] + ([self.stream.last] if self.w_last else [])
+        return observed + [self.take_snapshot, self.clear] + list(self.counters.values()) + list(self.snapshot.values())
+
+    def pureIdentifier(self):
+        return (type(self), self.valid_width, self.counter_width, self.saturate, self.w_last)
+
+    @pure()
+    def elaborate(self, platform):
+        m = Module()
+
+        valid = self.stream.valid.any()
+        ready = self.stream.ready
+        transfer = Signal()
+        stall = Signal()
+        m.d.comb += [
+            transfer.eq(valid & ready),
+            stall.eq(valid & ~ready)
+        ]
+        lanes = Signal(range(self.valid_width + 1))
+        m.d.comb += lanes.eq(sum(self.stream.valid[i] for i in range(self.valid_width)))
+
+        maximum = (1 << self.counter_width) - 1
+        def step(counter, amount):
+            value = Signal(self.counter_width + cl2(self.valid_width + 1), name=f"{counter.name}_next")
+            m.d.comb += value.eq(Mux(self.clear, 0, counter) + amount)
+            if self.saturate:
+                m.d.sync += counter.eq(Mux(value > maximum, maximum, value))
+            else:
+                m.d.sync += counter.eq(value)
+
+        c = self.counters
+        step(c["cycles"], 1)
+        step(c["transfers"], transfer)
+        step(c["lanes"], Mux(transfer, lanes, 0))
+        step(c["stalls"], stall)
+        step(c["idles"], ~valid & ready)
+        if self.w_last:
+            step(c["packets"], transfer & self.stream.last)
+
+        # The stall cycles in a row up to this one, which always saturates
+        stall_run = Signal(self.counter_width)
+        run = Signal(self.counter_width)
+        longest = Signal(self.counter_width)
+        m.d.comb += [
+            run.eq(Mux(stall, Mux(stall_run == maximum, maximum, stall_run + 1), 0)),
+            longest.eq(Mux(self.clear, 0, c["longest_stall"]))
+        ]
+        m.d.sync += [
+            stall_run.eq(run),
+            c["longest_stall"].eq(Mux(run > longest, run, longest))
+        ]
+
+        with m.If(self.take_snapshot):
+            m.d.sync += [self.snapshot[n].eq(c[n]) for n in c]
+
+        return m
+
+
+class MonitorTest(FHDLTestCase):
+    # The counts of a stretch of (valid, ready, last) cycles, like StreamMonitor keeps them
+    def expected(self, cycles, saturate_at=None):
+        counts = {"cycles": 0, "transfers": 0, "lanes": 0, "stalls": 0, "idles": 0, "longest_stall": 0, "packets": 0}
+        run = 0
+        for valid, ready, last in cycles:
+            counts["cycles"] += 1
+            counts["transfers"] += bool(valid) and ready
+            counts["lanes"] += bin(valid).count("1") if ready else 0
+            counts["stalls"] += bool(valid) and not ready
+            counts["idles"] += (not valid) and ready
+            counts["packets"] += bool(valid) and ready and last
+            run = run + 1 if valid and not ready else 0
+            counts["longest_stall"] = max(counts["longest_stall"], run)
+        if saturate_at is not None:
+            counts = {n: min(v, saturate_at) for n, v in counts.items()}
+        return counts
+
+    def test_counters(self):
+        import random
+        from AXI4 import AXI4_W_Interface
+        random.seed(24)
+        for stream, counter_width in [(ArrayStreamInterface(name="s", payload_width=8, valid_width=4), 32),
+                                      (AXI4_W_Interface(name="w", data_width=32), 32),
+                                      (BasicStreamInterface(name="s"), 3)]:
+            dut = StreamMonitor(stream, counter_width=counter_width)
+            sim = Simulator(dut)
+            full = (1 << len(stream.valid)) - 1
+            cycles = [(random.randint(0, full) if random.random() < 0.7 else 0, random.random() < 0.4, random.random() < 0.3) for _ in range(200)]
+            saturate_at = (1 << counter_width) - 1 if counter_width < 32 else None
+
+            def counters(values):
+                res = {}
+                for n, s in values.items():
+                    res[n] = yield s
+                return res
+
+            def process():
+                for i, (valid, ready, last) in enumerate(cycles):
+                    yield stream.valid.eq(valid)
+                    yield stream.ready.eq(ready)
+                    if dut.w_last:
+                        yield stream.last.eq(last)
+                    # Both at once: the snapshot holds the first 120 cycles and the counters start again with this one
+                    yield dut.take_snapshot.eq(i == 120)
+                    yield dut.clear.eq(i == 120)
+                    yield
+                yield Settle()
+                # The first clock edge comes before the process drives anything
+                for values, part in [(dut.snapshot, [(0, False, False)] + cycles[:120]), (dut.counters, cycles[120:])]:
+                    expected = self.expected(part, saturate_at)
+                    if not dut.w_last:
+                        del expected["packets"]
+                    self.assertEqual((yield from counters(values)), expected)
+
+            sim.add_clock(1e-6)
+            sim.add_sync_process(process)
+            sim.run()
+
+    def test_dedup(self):
+        # The monitor only reads the stream, also as an instance of a shared body
+        m = Module()
+        m.submodules.reg = reg = StreamReg(BasicStreamInterface, 8)
+        m.submodules.monitor_in = monitor_in = StreamMonitor(reg.si)
+        m.submodules.monitor_out = monitor_out = StreamMonitor(reg.so)
+        import re
+        from ElabCache import convert
+        text = convert(m, ports=reg.ports() + monitor_in.ports()[2:] + monitor_out.ports()[2:])
+        self.assertEqual(len(re.findall(r"^module \\StreamMonitor_", text, re.MULTILINE)), 1)
+        self.assertEqual(len(re.findall(r"^\s*cell \\StreamMonitor_", text, re.MULTILINE)), 2)
+
+
+class PacketTest(FHDLTestCase):
+    # Sends random packets into inputs under random back pressure on outputs, a beat is input << 12 | packet << 4 | beat.
+    # Every output must see whole packets one after the other, and every packet must arrive once, in order per input.
+    def runPackets(self, dut, inputs, outputs, cycles_limit=4000, seed=22):
+        import random
+        random.seed(seed)
+        packets = [[[(i << 12) | (p << 4) | b for b in range(random.randint(1, 5))] for p in range(12)] for i in range(len(inputs))]
+        queues = [[(beat, b == 0, b == len(packet) - 1) for packet in ps for b, beat in enumerate(packet)] for ps in packets]
+        received = [[] for _ in outputs]
+
+        def process():
+            cycles = 0
+            while sum(map(len, received)) < sum(len(p) for ps in packets for p in ps):
+                offer = [len(q) > 0 and random.random() < 0.7 for q in queues]
+                for si, q, o in zip(inputs, queues, offer):
+                    beat, first, last = q[0] if o else (0, 0, 0)
+                    yield si.valid.eq(o)
+                    yield si.payload.eq(beat)
+                    yield si.first.eq(first)
+                    yield si.last.eq(last)
+                for so in outputs:
+                    yield so.ready.eq(random.random() < 0.6)
+                yield Settle()
+                for si, q, o in zip(inputs, queues, offer):
+                    if o and (yield si.ready):
+                        q.pop(0)
+                for so, r in zip(outputs, received):
+                    if (yield so.valid) and (yield so.ready):
+                        r.append(((yield so.payload), (yield so.last)))
+                yield
+                cycles += 1
+                self.assertLess(cycles, cycles_limit)
+
+        sim = Simulator(dut)
+        sim.add_clock(1e-6)
+        sim.add_sync_process(process)
+        sim.run()
+
+        arrived = []
+        for r in received:
+            current = []
+            for beat, last in r:
+                current.append(beat)
+                if last:
+                    arrived.append(current)
+                    current = []
+            self.assertEqual(current, [])
+        for i, ps in enumerate(packets):
+            mine = [p for p in arrived if p[0] >> 12 == i]
+            self.assertEqual(sorted(mine), ps)
+            if len(outputs) == 1:
+                self.assertEqual(mine, ps)
+        for r in received:
+            for i in range(len(inputs)):
+                mine = [beat for beat, _ in r if beat >> 12 == i]
+                self.assertEqual(mine, sorted(mine))
+
+    def test_joins(self):
+        fields = framingFields + [("prioCounter", 4)]
+        for dut in [StreamJoin(BasicStreamInterface, 16, extra_fields=framingFields, packet_lock=True),
+                    StreamJoin(BasicStreamInterface, 16, extra_fields=framingFields, fixed_prio=True, packet_lock=True),
+                    StreamJoin2(BasicStreamInterface, 16, extra_fields=fields, packet_lock=True)]:
+            self.runPackets(dut, dut.si, [dut.so])
+        for policy in ["fixed", "roundrobin", "prio", "drr"]:
+            dut = StreamJoinN(BasicStreamInterface, 16, n=4, policy=policy, extra_fields=fields, packet_lock=True, quanta=(2, 1, 3, 1))
+            self.runPackets(dut, dut.si, [dut.so])
+
+    def test_distribution(self):
+        dut = StreamDistribute_2to2(BasicStreamInterface, 16, extra_fields=framingFields, packet_lock=True)
+        self.runPackets(dut, dut.si, dut.so)
+        for policy in ["roundrobin", "lru", "fill"]:
+            dut = StreamDistributeN(BasicStreamInterface, 16, n=3, policy=policy, extra_fields=framingFields, packet_lock=True)
+            self.runPackets(dut, [dut.si], dut.so)
+
+    def test_distribution_net(self):
+        # The same Stream module as the one Algorithms imports
+        from Algorithms import DistributionNet
+        from Stream import BasicStreamInterface, framingFields
+        dut = DistributionNet(4, 4, BasicStreamInterface, 16, extra_fields=framingFields, packet_lock=True)
+        self.runPackets(dut, dut.inputs, dut.outputs)
+
+    def test_fifo_packets(self):
+        dut = StreamFifo(BasicStreamInterface, 8, depth=8, extra_fields=framingFields, count_packets=True)
+        sim = Simulator(dut)
+
+        def process():
+            # Two packets of 3 and 1 beats go in while the output waits, then they are read out
+            for beat, last in [(1, 0), (2, 0), (3, 1), (4, 1), (5, 0)]:
+                yield dut.si.valid.eq(1)
+                yield dut.si.payload.eq(beat)
+                yield dut.si.last.eq(last)
+                yield
+            yield dut.si.valid.eq(0)
+            yield
+            yield Settle()
+            self.assertEqual((yield dut.packets), 2)
+            yield dut.so.ready.eq(1)
+            counts = []
+            for _ in range(6):
+                yield Settle()
+                valid = yield dut.so.valid
+                yield
+                yield Settle()
+                if valid:
+                    counts.append((yield dut.packets))
+            self.assertEqual(counts, [2, 2, 1, 0, 0])
+
+        sim.add_clock(1e-6)
+        sim.add_sync_process(process)
+        sim.run()
+
+
+class FifoTest(FHDLTestCase):
+    def test_latency(self):
+        import random
+        for T, bypass, fwft in [(BasicStreamInterface, False, False), (BasicStreamInterface, False, True), (BasicStreamInterface, True, False),
+                                (BasicStreamInterface, True, True), (ArrayStreamInterface, False, False), (ArrayStreamInterface, True, True)]:
+            random.seed(0)
+            data = [random.randrange(256) for _ in range(100)]
+            dut = StreamFifo(T, payload_width=8, valid_width=1 if T is BasicStreamInterface else 4, depth=4, bypass=bypass, fwft=fwft)
+            sim = Simulator(dut)
+            full = (1 << len(dut.si.valid)) - 1
+            # The data of an ArrayStreamInterface beat is followed in its first lane
+            payload = (lambda s: s.payload) if T is BasicStreamInterface else (lambda s: s.payload0)
+
+            def process():
+                # A single beat into the empty FIFO takes latency cycles
+                yield dut.so.ready.eq(1)
+                yield dut.si.valid.eq(full)
+                yield payload(dut.si).eq(data[0])
+                yield
+                yield dut.si.valid.eq(0)
+                for _ in range(dut.latency - 1):
+                    yield Settle()
+                    self.assertEqual((yield dut.so.valid), 0)
+                    yield
+                yield Settle()
+                self.assertEqual((yield dut.so.valid), full)
+                self.assertEqual((yield payload(dut.so)), data[0])
+                yield
+
+                # Beats keep their order under random back pressure
+                sent, received = 1, [data[0]]
+                for _ in range(1000):
+                    if len(received) == len(data):
+                        break
+                    yield dut.si.valid.eq(full if (sent < len(data)) & (random.random() < 0.7) else 0)
+                    yield payload(dut.si).eq(data[sent] if sent < len(data) else 0)
+                    yield dut.so.ready.eq(random.random() < 0.6)
+                    yield Settle()
+                    if (yield dut.si.valid) and (yield dut.si.ready):
+                        sent += 1
+                    if (yield dut.so.valid) and (yield dut.so.ready):
+                        received.append((yield payload(dut.so)))
+                    yield
+                self.assertEqual(received, data)
+
+            sim.add_clock(1e-6)
+            sim.add_sync_process(process)
+            sim.run()
+
+
+class CreditLinkTest(FHDLTestCase):
+    def test_link(self):
+        import random
+        for T, forward_stages, backward_stages in [(BasicStreamInterface, 0, 0), (BasicStreamInterface, 3, 2), (ArrayStreamInterface, 1, 4)]:
+            random.seed(4)
+            data = [random.randrange(256) for _ in range(100)]
+            dut = CreditLink(T, payload_width=8, valid_width=1 if T is BasicStreamInterface else 2, forward_stages=forward_stages, backward_stages=backward_stages)
+            sim = Simulator(dut)
+            full = (1 << len(dut.si.valid)) - 1
+            payload = (lambda s: s.payload) if T is BasicStreamInterface else (lambda s: s.payload0)
+
+            def process():
+                # One beat every cycle once the link is filled
+                yield dut.so.ready.eq(1)
+                yield dut.si.valid.eq(full)
+                beats = 0
+                for cycle in range(60):
+                    yield Settle()
+                    if cycle >= 30 and (yield dut.so.valid):
+                        beats += 1
+                    yield
+                self.assertEqual(beats, 30)
+                yield dut.si.valid.eq(0)
+                for _ in range(forward_stages + 5):
+                    yield
+                yield Settle()
+                self.assertEqual((yield dut.so.valid), 0)
+
+                # Nothing is lost or reordered under random back pressure
+                sent, received = 0, []
+                while len(received) < len(data):
+                    transfer = sent < len(data) and random.random() < 0.8
+                    yield dut.si.valid.eq(full if transfer else 0)
+                    yield payload(dut.si).eq(data[sent] if transfer else 0)
+                    yield dut.so.ready.eq(random.random() < 0.5)
+                    yield Settle()
+                    if transfer and (yield dut.si.ready):
+                        sent += 1
+                    if (yield dut.so.valid) and (yield dut.so.ready):
+                        received.append((yield payload(dut.so)))
+                    yield
+                self.assertEqual(received, data)
+
+            sim.add_clock(1e-6)
+            sim.add_sync_process(process)
+            sim.run()
+
+
+class GearboxTest(FHDLTestCase):
+    def test_ratios(self):
+        import random
+        for cls, T, in_lanes, out_lanes in [(StreamUpsizer, ArrayStreamInterface, 3, 8), (StreamUpsizer, BasicStreamInterface, 2, 4),
+                                            (StreamDownsizer, ArrayStreamInterface, 8, 3), (StreamDownsizer, BasicStreamInterface, 4, 1)]:
+            random.seed(in_lanes*out_lanes)
+            dut = cls(T, lane_width=10, in_lanes=in_lanes, out_lanes=out_lanes, extra_fields=[("tag", 4)])
+            sim = Simulator(dut)
+            # Every lane has its own payload, so that lanes can be told apart
+            beats = [[i*in_lanes + l for l in range(in_lanes)] for i in range(60)]
+
+            def outputBeat():
+                valid = yield dut.so.valid
+                tag = yield dut.so.tag
+                beat = []
+                for l, payload in enumerate(dut.lanes(dut.so)):
+                    beat.append(((valid >> l) & 1, (yield payload), tag))
+                return beat
+
+            def process():
+                # Lanes, their valid bits and the extra fields under random back pressure
+                sent, received = [], []
+                for i, beat in enumerate(beats):
+                    valid = random.randrange(1 << in_lanes)
+                    yield dut.si.valid.eq(valid)
+                    yield dut.si.tag.eq(i % 16)
+                    for l, payload in enumerate(dut.lanes(dut.si)):
+                        yield payload.eq(beat[l])
+                    if valid:
+                        sent += [((valid >> l) & 1, beat[l], i % 16) for l in range(in_lanes)]
+                    while True:
+                        yield dut.so.ready.eq(random.random() < 0.6)
+                        yield Settle()
+                        if (yield dut.so.valid.any()) and (yield dut.so.ready):
+                            received.append((yield from outputBeat()))
+                        if not valid or (yield dut.si.ready):
+                            break
+                        yield
+                    yield
+                # A flush sends the last partial output beat on its way
+                yield dut.si.valid.eq(0)
+                yield dut.flush.eq(1)
+                for _ in range(dut.slots):
+                    yield dut.so.ready.eq(1)
+                    yield Settle()
+                    if (yield dut.so.valid.any()):
+                        received.append((yield from outputBeat()))
+                    yield
+                    yield dut.flush.eq(0)
+                # Everything came out, in order
+                valid_sent = [p for v, p, t in sent if v]
+                valid_received = [p for beat in received for v, p, t in beat if v]
+                self.assertEqual(valid_received, valid_sent)
+                # The tag of a full output beat is the one of its last lane
+                tags = {p: t for v, p, t in sent}
+                for beat in received[:-1]:
+                    self.assertEqual(beat[-1][2], tags[beat[-1][1]])
+
+                # The narrower side moves one beat every cycle
+                yield dut.so.ready.eq(1)
+                yield dut.si.valid.eq((1 << in_lanes) - 1)
+                for cycle in range(40):
+                    yield Settle()
+                    if cycle >= 10:
+                        self.assertEqual((yield dut.si.ready if in_lanes <= out_lanes else dut.so.valid.any()), 1)
+                    yield
+
+            sim.add_clock(1e-6)
+            sim.add_sync_process(process)
+            sim.run()
+
+    def test_framing(self):
+        import random
+        from StreamSim import StreamSource, StreamSink, runStreams
+        for cls, in_lanes, out_lanes in [(StreamDownsizer, 4, 2), (StreamDownsizer, 3, 2), (StreamUpsizer, 2, 4), (StreamUpsizer, 2, 3)]:
+            random.seed(in_lanes*out_lanes)
+            dut = cls(ArrayStreamInterface, lane_width=10, in_lanes=in_lanes, out_lanes=out_lanes, extra_fields=framingFields)
+            # Every lane has its own payload, a packet is a list of its beats
+            packets, lane = [], 0
+            for p in range(20):
+                packets.append([list(range(lane + b*in_lanes, lane + (b + 1)*in_lanes)) for b in range(random.randint(1, 4))])
+                lane += len(packets[-1])*in_lanes
+            beats = [{"payload": beat, "first": b == 0, "last": b == len(packet) - 1} for packet in packets for b, beat in enumerate(packet)]
+            source = StreamSource(dut.si, beats, pattern="random", rate=0.7)
+            fields = ["valid", "first", "last"] + [f"payload{l}" for l in range(out_lanes)]
+            sink = StreamSink(dut.so, pattern="random", rate=0.6, fields=fields)
+            runStreams(dut, source, sink, deadline=2000)
+
+            # Every output beat belongs to one packet, first is set on its first beat and last on its last one
+            received, current = [], []
+            for beat in sink.beats:
+                self.assertEqual(beat["first"], current == [])
+                current.append([beat[f"payload{l}"] for l in range(out_lanes) if (beat["valid"] >> l) & 1])
+                if beat["last"]:
+                    received.append(current)
+                    current = []
+            self.assertEqual(current, [])
+            self.assertEqual([sum(p, []) for p in received], [sum(p, []) for p in packets])
+            for p in received:
+                self.assertTrue(all(len(beat) == out_lanes for beat in p[:-1]))
+
+        # A 4 to 2 downsizer turns a packet of 2 beats into one of 4
+        dut = StreamDownsizer(ArrayStreamInterface, lane_width=10, in_lanes=4, out_lanes=2, extra_fields=framingFields)
+        source = StreamSource(dut.si, [{"payload": range(4), "first": 1, "last": 0}, {"payload": range(4, 8), "first": 0, "last": 1}])
+        sink = StreamSink(dut.so, count=4, fields=["first", "last"])
+        runStreams(dut, source, sink)
+        self.assertEqual([(b["first"], b["last"]) for b in sink.beats], [(1, 0), (0, 0), (0, 0), (0, 1)])
+
+
+class JoinNTest(FHDLTestCase):
+    def test_policies(self):
+        import random
+        for T, policy, output_reg in [(BasicStreamInterface, "roundrobin", True), (BasicStreamInterface, "roundrobin", False), (ArrayStreamInterface, "fixed", True), (BasicStreamInterface, "prio", True)]:
+            random.seed(19)
+            n = 5
+            extra_fields = [("prioCounter", 4)] if policy == "prio" else []
+            dut = StreamJoinN(T, payload_width=8, valid_width=1 if T is BasicStreamInterface else 2, n=n, policy=policy, output_reg=output_reg, extra_fields=extra_fields)
+            sim = Simulator(dut)
+            full = (1 << len(dut.so.valid)) - 1
+            payload = (lambda s: s.payload) if T is BasicStreamInterface else (lambda s: s.payload0)
+            data = [[(i << 5) | j for j in range(30)] for i in range(n)]
+
+            def process():
+                # Every input always valid: one beat every cycle, shared by the policy
+                yield dut.so.ready.eq(1)
+                for i, si in enumerate(dut.si):
+                    yield si.valid.eq(full)
+                    yield payload(si).eq(i << 5)
+                    if policy == "prio":
+                        yield si.prioCounter.eq(3 if i == 2 else i % 2)
+                winners = []
+                for cycle in range(dut.latency + 8*n):
+                    yield Settle()
+                    if cycle >= dut.latency:
+                        self.assertEqual((yield dut.so.valid), full)
+                        winners.append((yield payload(dut.so)) >> 5)
+                    yield
+                if policy == "roundrobin":
+                    self.assertEqual([winners.count(i) for i in range(n)], [8]*n)
+                else:
+                    self.assertEqual(set(winners), {0 if policy == "fixed" else 2})
+                for si in dut.si:
+                    yield si.valid.eq(0)
+                for _ in range(3):
+                    yield
+
+                # Nothing is lost or reordered within an input under random back pressure
+                sent, received = [0]*n, [[] for _ in range(n)]
+                while sum(map(len, received)) < n*len(data[0]):
+                    offer = [sent[i] < len(data[i]) and random.random() < 0.6 for i in range(n)]
+                    for i, si in enumerate(dut.si):
+                        yield si.valid.eq(full if offer[i] else 0)
+                        yield payload(si).eq(data[i][sent[i]] if offer[i] else 0)
+                    yield dut.so.ready.eq(random.random() < 0.7)
+                    yield Settle()
+                    for i, si in enumerate(dut.si):
+                        if offer[i] and (yield si.ready):
+                            sent[i] += 1
+                    if (yield dut.so.valid) and (yield dut.so.ready):
+                        beat = yield payload(dut.so)
+                        received[beat >> 5].append(beat)
+                    yield
+                self.assertEqual(received, data)
+
+            sim.add_clock(1e-6)
+            sim.add_sync_process(process)
+            sim.run()
+
+    def test_drr(self):
+        import random
+        # Shares follow the quanta, in beats or in valid lanes, at one beat every cycle
+        for quanta, cost, lanes in [((1, 2, 5), "beats", (1, 1, 1)), ((4, 4, 8), "lanes", (4, 1, 2))]:
+            n = 3
+            dut = StreamJoinN(ArrayStreamInterface, payload_width=8, valid_width=4, n=n, policy="drr", quanta=quanta, cost=cost)
+            sim = Simulator(dut)
+
+            def process():
+                yield dut.so.ready.eq(1)
+                for i, si in enumerate(dut.si):
+                    yield si.valid.eq((1 << lanes[i]) - 1)
+                    yield si.payload0.eq(i)
+                served = [0]*n
+                # A round takes quanta[i] // lanes[i] beats of every input
+                for cycle in range(dut.latency + 20*sum(q // l for q, l in zip(quanta, lanes))):
+                    yield Settle()
+                    if cycle >= dut.latency:
+                        valid = yield dut.so.valid
+                        self.assertNotEqual(valid, 0)
+                        served[(yield dut.so.payload0)] += bin(valid).count("1") if cost == "lanes" else 1
+                    yield
+                self.assertEqual(served, [20*q for q in quanta])
+
+            sim.add_clock(1e-6)
+            sim.add_sync_process(process)
+            sim.run()
+
+        # Nothing is lost or reordered within an input under random back pressure
+        random.seed(21)
+        n = 3
+        dut = StreamJoinN(BasicStreamInterface, payload_width=8, n=n, policy="drr", quanta=(3, 1, 2))
+        sim = Simulator(dut)
+        data = [[(i << 5) | j for j in range(30)] for i in range(n)]
+
+        def process():
+            sent, received = [0]*n, [[] for _ in range(n)]
+            while sum(map(len, received)) < n*len(data[0]):
+                offer = [sent[i] < len(data[i]) and random.random() < 0.6 for i in range(n)]
+                for i, si in enumerate(dut.si):
+                    yield si.valid.eq(offer[i])
+                    yield si.payload.eq(data[i][sent[i]] if offer[i] else 0)
+                yield dut.so.ready.eq(random.random() < 0.7)
+                yield Settle()
+                for i, si in enumerate(dut.si):
+                    if offer[i] and (yield si.ready):
+                        sent[i] += 1
+                if (yield dut.so.valid) and (yield dut.so.ready):
+                    beat = yield dut.so.payload
+                    received[beat >> 5].append(beat)
+                yield
+            self.assertEqual(received, data)
+
+        sim.add_clock(1e-6)
+        sim.add_sync_process(process)
+        sim.run()
+
+
+class DistributeNTest(FHDLTestCase):
+    def test_policies(self):
+        import random
+        for T, policy in [(BasicStreamInterface, "roundrobin"), (ArrayStreamInterface, "lru"), (BasicStreamInterface, "fill")]:
+            random.seed(20)
+            n = 3
+            dut = StreamDistributeN(T, payload_width=8, valid_width=1 if T is BasicStreamInterface else 2, n=n, policy=policy)
+            sim = Simulator(dut)
+            full = (1 << len(dut.si.valid)) - 1
+            payload = (lambda s: s.payload) if T is BasicStreamInterface else (lambda s: s.payload0)
+            data = list(range(200))
+
+            def outputValids():
+                valids = []
+                for so in dut.so:
+                    valids.append((yield so.valid))
+                return valids
+
+            def process():
+                # All outputs ready: one beat every cycle, spread evenly, or to the emptiest output
+                for i, so in enumerate(dut.so):
+                    yield so.ready.eq(1)
+                for i, fill in enumerate(dut.fill):
+                    yield fill.eq([5, 0, 9][i])
+                yield dut.si.valid.eq(full)
+                chosen = []
+                for cycle in range(3*n + 1):
+                    yield Settle()
+                    if cycle > 0:
+                        valids = yield from outputValids()
+                        self.assertEqual(valids.count(full), 1)
+                        chosen.append(valids.index(full))
+                    yield
+                # The RoundRobin starts with output 0 as the last chosen one
+                expected = {"roundrobin": [(k + 1) % n for k in range(3*n)], "lru": [k % n for k in range(3*n)], "fill": [1]*3*n}
+                self.assertEqual(chosen, expected[policy])
+                yield dut.si.valid.eq(0)
+                yield
+                yield
+
+                # Nothing is lost or reordered within an output under random back pressure
+                sent, received = 0, [[] for _ in range(n)]
+                while sum(map(len, received)) < len(data):
+                    offer = sent < len(data) and random.random() < 0.8
+                    yield dut.si.valid.eq(full if offer else 0)
+                    yield payload(dut.si).eq(data[sent] if offer else 0)
+                    for i, so in enumerate(dut.so):
+                        yield so.ready.eq(random.random() < 0.4)
+                    for i, fill in enumerate(dut.fill):
+                        yield fill.eq(len(received[i]) % 4)
+                    yield Settle()
+                    if offer and (yield dut.si.ready):
+                        sent += 1
+                    for i, so in enumerate(dut.so):
+                        if (yield so.valid) and (yield so.ready):
+                            received[i].append((yield payload(so)))
+                    yield
+                self.assertEqual(sorted(sum(received, [])), data)
+                for r in received:
+                    self.assertEqual(r, sorted(r))
+                    self.assertGreater(len(r), len(data)//(2*n))
+
+            sim.add_clock(1e-6)
+            sim.add_sync_process(process)
+            sim.run()
+
+    def test_lru(self):
+        # Output 0 is held while 1 and 2 are chosen in turn, once it is free again it is the least recently used one.
+        # A round robin would choose 2 there, the output after the last chosen one.
+        dut = StreamDistributeN(BasicStreamInterface, payload_width=8, n=3, policy="lru")
+        sim = Simulator(dut)
+
+        def process():
+            chosen = []
+            yield dut.si.valid.eq(1)
+            for step, ready in enumerate([[1, 1, 1], [0, 1, 1], [0, 1, 1], [0, 1, 1], [1, 1, 1]]):
+                yield dut.si.payload.eq(step + 1)
+                for so, r in zip(dut.so, ready):
+                    yield so.ready.eq(r)
+                yield
+                yield Settle()
+                for i, so in enumerate(dut.so):
+                    if (yield so.valid) and (yield so.payload) == step + 1:
+                        chosen.append(i)
+            self.assertEqual(chosen, [0, 1, 2, 1, 0])
+
+        sim.add_clock(1e-6)
+        sim.add_sync_process(process)
+        sim.run()
+
+
+class AsyncFifoTest(FHDLTestCase):
+    def test_crossing(self):
+        import random
+        for T, w_period, r_period in [(BasicStreamInterface, 7e-9, 10e-9), (ArrayStreamInterface, 10e-9, 3e-9)]:
+            random.seed(2)
+            data = [random.randrange(256) for _ in range(100)]
+            dut = AsyncStreamFifo(T, payload_width=8, valid_width=1 if T is BasicStreamInterface else 3, depth=8)
+            sim = Simulator(dut)
+            full = (1 << len(dut.si.valid)) - 1
+            payload = (lambda s: s.payload) if T is BasicStreamInterface else (lambda s: s.payload0)
+            received = []
+
+            def source():
+                for d in data:
+                    yield dut.si.valid.eq(full if random.random() < 0.8 else 0)
+                    yield payload(dut.si).eq(d)
+                    yield Settle()
+                    while not ((yield dut.si.valid) and (yield dut.si.ready)):
+                        yield
+                        yield dut.si.valid.eq(full)
+                        yield Settle()
+                    self.assertLessEqual((yield dut.w_fill), dut.depth)
+                    yield
+                yield dut.si.valid.eq(0)
+
+            def sink():
+                while len(received) < len(data):
+                    yield dut.so.ready.eq(random.random() < 0.7)
+                    yield Settle()
+                    if (yield dut.so.valid) and (yield dut.so.ready):
+                        self.assertEqual((yield dut.so.valid), full)
+                        received.append((yield payload(dut.so)))
+                    yield
+
+            sim.add_clock(w_period, domain="write")
+            sim.add_clock(r_period, domain="read")
+            sim.add_sync_process(source, domain="write")
+            sim.add_sync_process(sink, domain="read")
+            sim.run()
+            self.assertEqual(received, data)
+
+
+class SliceTest(FHDLTestCase):
+    def test_slice_types(self):
+        import random
+        for slice_type, beats in sliceTypes.items():
+            for valid_width in [1, 3]:
+                random.seed(1)
+                data = [(random.randrange(1, 1 << valid_width), random.randrange(256)) for _ in range(100)]
+                dut = StreamReg(BasicStreamInterface, payload_width=8, valid_width=valid_width, slice_type=slice_type)
+                sim = Simulator(dut)
+                latency = 0 if slice_type in ["backward", "skid"] else 1
+
+                def process():
+                    # One beat every cycle while the output is ready, after the latency of the slice
+                    yield dut.so.ready.eq(1)
+                    for cycle in range(10):
+                        yield dut.si.valid.eq(1)
+                        yield dut.si.payload.eq(cycle)
+                        yield Settle()
+                        self.assertEqual((yield dut.si.ready), 1)
+                        if cycle >= latency:
+                            self.assertEqual((yield dut.so.valid), 1)
+                            self.assertEqual((yield dut.so.payload), cycle - latency)
+                        yield
+                    yield dut.si.valid.eq(0)
+                    for _ in range(latency):
+                        yield
+
+                    # Beats keep their order under random back pressure, and the slice never holds more than it can
+                    sent, received = [], []
+                    while len(received) < len(data):
+                        transfer = len(sent) < len(data) and random.random() < 0.7
+                        yield dut.si.valid.eq(data[len(sent)][0] if transfer else 0)
+                        yield dut.si.payload.eq(data[len(sent)][1] if transfer else 0)
+                        yield dut.so.ready.eq(random.random() < 0.6)
+                        yield Settle()
+                        if transfer and (yield dut.si.ready):
+                            sent.append(data[len(sent)])
+                        if (yield dut.so.valid) and (yield dut.so.ready):
+                            received.append(((yield dut.so.valid), (yield dut.so.payload)))
+                        self.assertLessEqual(len(sent) - len(received), beats)
+                        yield
+                    self.assertEqual(received, data)
+
+                sim.add_clock(1e-6)
+                sim.add_sync_process(process)
+                sim.run()
+
+
 class RegTest(FHDLTestCase):
     def test_formal(self):
         self.assertFormal(StreamReg(T=BasicStreamInterface, payload_width=8, valid_width=1), mode="prove", depth=25)
         self.assertFormal(StreamReg(T=BasicStreamInterface, payload_width=8, valid_width=1, use_double_buffering=False), mode="prove", depth=25)
+
+    def test_formal_slice_types(self):
+        for slice_type in sliceTypes:
+            self.assertFormal(StreamReg(T=BasicStreamInterface, payload_width=8, valid_width=1, slice_type=slice_type), mode="prove", depth=25)
+            self.assertFormal(StreamReg(T=BasicStreamInterface, payload_width=8, valid_width=3, slice_type=slice_type), mode="prove", depth=25)
         self.assertFormal(StreamReg(T=BasicStreamInterface, payload_width=8, valid_width=4), mode="prove", depth=25)
\ No newline at end of file
@@ -3,8 +3,11 @@ from Stream import BasicStreamInterface, StreamReg
 from amaranth import *
 from typing import Hashable
 from amaranth.lib.data import *
-from utils import cl2
-from Algorithms import perfectSortings
+from utils import cl2, StageTiming
+from ElabCache import pure
+from amaranth.sim import Simulator, Settle
+from fhdl import FHDLTestCase
+from SortingNetworks import perfectSortings, sortingNetwork, timedCuts, comparatorLevels
 class CompactionIndexesDeprecated(Elaboratable):
 
     def __init__(self, N=4, dir=0, passNV=False):
@@ -15,14 +18,16 @@ class CompactionIndexesDeprecated(Elaboratable):
         self.valid_o = Signal(N)
         self.indexes = Signal(ArrayLayout(unsigned(cl2(N)), N))
 
+    def ports(self):
+        return [self.valid_i, self.valid_o, self.indexes.as_value()]
+
+    def pureIdentifier(self):
+        return (type(self),self.N, self.passNV, self.dir)
+
+    @pure()
     def elaborate(self, platform):
 
         m = Module()
-        if m.setPureIdentifier(type(self),self.N, self.passNV, self.dir):
-            m.submodules += Instance("dummy", i_valid_i=self.valid_i, o_valid_o=self.valid_o, o_indexes=self.indexes)
-            return m
-
-        print("Elaborating ", self.__class__.__name__, self)
 
         def T(si, so):
             with m.If(si[0][0]):
@@ -52,7 +57,10 @@ class CompactionIndexesDeprecated(Elaboratable):
 
 class CompactionIndexes(Elaboratable):
 
-    def __init__(self, N=4, dir=0, passNV=False, index_in=False, stable=False, width=None, registers=[], optimized_valid_in=False, optimized_valid_out=False):
+    # registers lists the layers followed by a register stage, or with targetDepth they are placed by timedCuts,
+    # where comparatorDelay defaults to comparatorLevels of the index width when stable, or 1 for the valid bit only
+    def __init__(self, N=4, dir=0, passNV=False, index_in=False, stable=False, width=None, registers=[], optimized_valid_in=False, optimized_valid_out=False, policy="depth",
+                 network="bitonic", targetDepth=None, comparatorDelay=None):
         self.N = N
         self.passNV = passNV
         self.dir = dir
@@ -62,7 +70,17 @@ class CompactionIndexes(Elaboratable):
         self.width = width if width != None else cl2(N)
         self.indexes = Array(Signal(self.width, name=f"index{i}") for i in range(self.N))
         self.stable = stable
+        self.policy = policy
+        self.networkType = network
+        self.diff = (1 << cl2(N, min1=False)) - N if N > max(perfectSortings.keys()) else 0
+        self.network = sortingNetwork(N + self.diff, d=dir, policy=policy, network=network)
+        if targetDepth is not None:
+            if comparatorDelay is None:
+                comparatorDelay = comparatorLevels(cl2(N)) if stable else 1
+            registers = list(timedCuts(self.network, targetDepth, comparatorDelay))
         self.registers = registers
+        self.network = self.network.withCuts(registers)
+        self.delay = len(registers)
         self.optimized_valid_in = optimized_valid_in and len(registers) > 0
         self.optimized_valid_out = optimized_valid_out and len(registers) > 0
         if self.optimized_valid_in:
@@ -78,20 +96,26 @@ class CompactionIndexes(Elaboratable):
         else:
             self.indexes_in = Array(Const(i, self.width) for i in range(self.N))
 
+    def ports(self):
+        ports = [self.valid_i, self.valid_o, *self.indexes]
+        if self.index_in:
+            ports += list(self.indexes_in)
+        if len(self.registers) > 0:
+            ports += [self.ready_i, self.ready_o]
+        if self.optimized_valid_in:
+            ports.append(self.o_valid_in)
+        if self.optimized_valid_out:
+            ports.append(self.o_valid_out)
+        return ports
+
+    def pureIdentifier(self):
+        return (type(self),self.N, self.passNV, self.dir, self.index_in, self.width, self.stable, tuple(self.registers), self.optimized_valid_in, self.optimized_valid_out, self.policy, self.networkType)
+
+    @pure()
     def elaborate(self, platform):
 
         m = Module()
-        if m.setPureIdentifier(type(self),self.N, self.passNV, self.dir, self.index_in, self.width, self.stable, tuple(self.registers), self.optimized_valid_in, self.optimized_valid_out):
-            ii = {"i_indexes_in":self.indexes_in} if self.index_in else {}
-            syncs = {"i_clk":ClockSignal("sync"), "i_rst":ResetSignal("sync")} if len(self.registers) > 0 else {}
-            readys = {"i_ready_i":self.ready_i, "o_ready_o":self.ready_o} if len(self.registers) > 0 else {}
-            ovi = {"i_o_valid_in":self.o_valid_in} if self.optimized_valid_in else {}
-            ovo = {"o_o_valid_out":self.o_valid_out} if self.optimized_valid_out else {}
-            m.submodules += Instance("dummy", i_valid_i=self.valid_i, o_valid_o=self.valid_o, o_indexes=self.indexes, **ii, **syncs, **readys, **ovi, **ovo)
-            return m
-
-        print("Elaborating ", self.__class__.__name__, self)
-        
+
         regLayers = {}
         W = (cl2(self.N)+self.width) if self.stable and self.index_in else self.width
 
@@ -138,81 +162,25 @@ class CompactionIndexes(Elaboratable):
                     m.d.comb += [B[0][0].eq(0), B[0][1].eq(Eu), B[1][0].eq(0), B[1][1].eq(Ev)]
             return B
         
-        def bSort(A, d, l=0):
-            cnt = len(A)
-            if cnt <= 1:
-                return A, l
-            elif cnt in perfectSortings.keys():
-                sorter = perfectSortings[cnt]
-                for layer in sorter:
-                    for swap in layer:
-                        i0, i1 = swap
-                        A[i0], A[i1] = swap2(A[i0], A[i1], d)
-                    l += 1
-                    if l in self.registers:
-                        B = [(Signal(), Signal(W)) for _ in range(len(A))]
-                        s = regLayers.get(l,None)
-                        v_b, e_b = zip(*B)
-                        v_a, e_a = zip(*A)
-
-                        if s == None:
-                            regLayers[l] = e_a, v_a, e_b, v_b
-                        else:
-                            aE, aV, bE, bV = s
-                            regLayers[l] = aE+e_a, aV+v_a, bE+e_b, bV+v_b
-                        A = B
-                return A, l
-            else:
-                k = cnt//2
-                B = [(Signal(), Signal(W)) for _ in range(len(A))]
-                LA, Ll = bSort(A[:k], 1, l)
-                RA, Rl = bSort(A[k:], 0, l)
-                m.d.comb += sum(([bv.eq(av), bi.eq(ai)] for (bv, bi), (av, ai) in zip(B, LA + RA)), start=[])
-                return bMerge(B, d, max(Ll, Rl))
-    
-        def bMerge(A, d, l=0):
-            cnt = len(A)
-            if cnt > 1:
-                k = cnt//2
-                B = [(Signal(), Signal(W)) for _ in range(len(A))]
-                for i in range(0, k):
-                    S = swap2(A[i], A[i+k], d)
-                    m.d.comb += [
-                    B[i][0].eq(S[0][0]),
-                    B[i][1].eq(S[0][1]),
-                    B[i+k][0].eq(S[1][0]),
-                    B[i+k][1].eq(S[1][1])]
-                l += 1
-                if l in self.registers:
-                        C = [(Signal(), Signal(W)) for _ in range(len(B))]
-                        s = regLayers.get(l,None)
-
-                        v_b, e_b = zip(*C)
-                        v_a, e_a = zip(*B)
-
-                        if s == None:
-                            regLayers[l] = e_a, v_a, e_b, v_b
-                        else:
-                            aE, aV, bE, bV = s
-                            regLayers[l] = aE+e_a, aV+v_a, bE+e_b, bV+v_b
-                        B = C
-                LB, Ll = bMerge(B[:k], d, l)
-                RB, Rl = bMerge(B[k:], d, l)
-                return LB+RB, max(Ll, Rl)
-            return A, l
-
         if self.stable and self.index_in:
             cw = cl2(self.N)
             I = [(v, Cat(self.indexes_in[i], Const(i, cw))) for i,v in enumerate(self.valid_i)]
         else:
             I = [(v, self.indexes_in[i]) for i,v in enumerate(self.valid_i)]
         
-        diff = (1 << cl2(self.N, min1=False)) - self.N
-
-        if self.N > max(perfectSortings.keys()):
-            I.extend((Const(0, 1), Const(0, W)) for _ in range(diff))
-
-        res, layers = bSort(I, self.dir)
+        diff = self.diff
+        I.extend((Const(0, 1), Const(0, W)) for _ in range(diff))
+
+        res = I
+        for l, layer in enumerate(self.network.layers, 1):
+            for i0, i1, d in layer:
+                res[i0], res[i1] = swap2(res[i0], res[i1], d)
+            if l in self.registers:
+                B = [(Signal(), Signal(W)) for _ in range(len(res))]
+                v_b, e_b = zip(*B)
+                v_a, e_a = zip(*res)
+                regLayers[l] = e_a, v_a, e_b, v_b
+                res = B
 
         if len(self.registers) > 0:
 
@@ -267,18 +235,20 @@ class StreamCompaction(Elaboratable):
         self.input_stream = BasicStreamInterface(payload_width=self.N*self.W, valid_width=self.N)
         self.output_stream = BasicStreamInterface(payload_width=self.N*self.W, valid_width=self.N)
 
+    def ports(self):
+        return [self.input_stream[f] for f in self.input_stream.fields] + [self.output_stream[f] for f in self.output_stream.fields]
+
+    def pureIdentifier(self):
+        return (type(self),self.N, self.W)
+
+    def pipelineTiming(self):
+        return StageTiming(0, 1, 1)
+
+    @pure()
     def elaborate(self, platform):
 
         m = Module()
 
-        if m.setPureIdentifier(type(self),self.N, self.W):
-            m.submodules += Instance("dummy",
-            i_inputstream_valid=self.input_stream.valid, i_inputstream_payload=self.input_stream.payload, i_outputstream_ready=self.output_stream.ready,
-            o_outputstream_valid=self.output_stream.valid, o_outputstream_payload=self.output_stream.payload, o_inputstream_ready=self.input_stream.ready)
-            return m
-        
-        print("Elaborating ", self.__class__.__name__, self)
-
         m.submodules.indx = indx = CompactionIndexes(self.N, 0, False)
         m.d.comb += [
             self.input_stream.ready.eq(self.output_stream.ready),
@@ -290,3 +260,55 @@ class StreamCompaction(Elaboratable):
 
         return m
 
+
+class CompactionTest(FHDLTestCase):
+    def test_golden_model(self):
+        import numpy as np
+        from GoldenModels import evaluateCompaction
+
+        N = 6
+        valid = np.array([[(v >> i) & 1 for i in range(N)] for v in range(1 << N)], dtype=bool)
+        for dir in [0, 1]:
+            for stable in [False, True]:
+                ev, ei = evaluateCompaction(N, dir, valid, stable)
+                dut = CompactionIndexes(N, dir, index_in=stable, stable=stable)
+                sim = Simulator(dut)
+
+                def process():
+                    if stable:
+                        for i in range(N):
+                            yield dut.indexes_in[i].eq(i)
+                    for row in range(len(valid)):
+                        yield dut.valid_i.eq(sum(int(v) << i for i, v in enumerate(valid[row])))
+                        yield Settle()
+                        v = yield dut.valid_o
+                        self.assertEqual([(v >> i) & 1 for i in range(N)], list(ev[row]))
+                        for i in range(N):
+                            if ev[row][i]:
+                                self.assertEqual((yield dut.indexes[i]), ei[row][i])
+
+                sim.add_process(process)
+                sim.run()
+
+    def test_stream(self):
+        import numpy as np
+        from GoldenModels import evaluateCompaction
+
+        N, W = 4, 8
+        valid = np.array([[(v >> i) & 1 for i in range(N)] for v in range(1 << N)], dtype=bool)
+        ev, ei = evaluateCompaction(N, 0, valid)
+        dut = StreamCompaction(N, W)
+        sim = Simulator(dut)
+
+        def process():
+            yield dut.input_stream.payload.eq(sum((0x10 + i) << (W*i) for i in range(N)))
+            for row in range(len(valid)):
+                yield dut.input_stream.valid.eq(sum(int(v) << i for i, v in enumerate(valid[row])))
+                yield Settle()
+                payload = yield dut.output_stream.payload
+                for i in range(N):
+                    if ev[row][i]:
+                        self.assertEqual((payload >> (W*i)) & 0xff, 0x10 + ei[row][i])
+
+        sim.add_process(process)
+        sim.run()
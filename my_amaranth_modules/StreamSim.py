@@ -0,0 +1,241 @@
+import random
+
+from amaranth import *
+from amaranth.sim import Simulator, Settle, Passive
+from fhdl import FHDLTestCase
+
+from Stream import BasicStreamInterface, ArrayStreamInterface
+
+
+# Handshake patterns for the valid of a StreamSource and the ready of a StreamSink, one bool per cycle:
+#   always: every cycle.
+#   random: every cycle with probability rate.
+#   bursty: runs of on and off cycles, on for rate of the time on average, the runs burst cycles long on average.
+#   duty:   on for the first round(rate*period) cycles of every period.
+def handshakePattern(kind="always", rate=1.0, burst=8, period=4, seed=0):
+    rng = random.Random(seed)
+    if kind == "always":
+        while True:
+            yield True
+    elif kind == "random":
+        while True:
+            yield rng.random() < rate
+    elif kind == "bursty":
+        on = rng.random() < rate
+        while True:
+            yield on
+            # Leaving a state after burst cycles on average, weighted so that on is rate of the time
+            leave = 1/(burst*rate) if on else 1/(burst*(1 - rate)) if rate < 1 else 0
+            if rng.random() < leave:
+                on = not on
+    elif kind == "duty":
+        high = round(rate*period)
+        while True:
+            for i in range(period):
+                yield i < high
+    else:
+        raise ValueError(f"Unknown pattern {kind!r}, expected one of ['always', 'random', 'bursty', 'duty']")
+
+
+# An ArrayStreamInterface is told by its fields, so that streams of a Stream module imported under another name work as well
+def _isArray(stream):
+    return "payload" not in stream.fields
+
+
+# The payload fields of a stream, one per lane of an ArrayStreamInterface
+def _payloadFields(stream):
+    if _isArray(stream):
+        return [f"payload{i}" for i in range(len(stream.valid))]
+    return ["payload"]
+
+
+class StreamSource:
+    """Drives a ``BasicStreamInterface`` or ``ArrayStreamInterface`` from Python beats in a pysim testbench.
+
+    A beat is a payload (an int for a BasicStreamInterface, a sequence of lane values for an
+    ArrayStreamInterface, so a 1D or 2D NumPy array drives one beat per element or row), a
+    ``(valid, payload)`` tuple for partially valid beats or a dict of field values. Beats without
+    a valid have all lanes valid.
+
+    Attributes
+    ----------
+    sent : list of (cycle, beat), the cycle of every transfer.
+
+    Usage::
+
+        source = StreamSource(dut.si, np.arange(100), pattern="random", rate=0.5)
+        sink = StreamSink(dut.so, pattern="bursty", rate=0.8, count=100)
+        runStreams(dut, source, sink)
+        self.assertEqual(sink.beats, list(range(100)))
+        print(sink.throughput(), latencies(source, sink))
+    """
+    def __init__(self, stream, beats, pattern="always", rate=1.0, burst=8, period=4, seed=0):
+        self.stream = stream
+        self.beats = beats
+        self.pattern = handshakePattern(pattern, rate, burst, period, seed)
+        self.sent = []
+
+    def fields(self, beat):
+        stream = self.stream
+        full = (1 << len(stream.valid)) - 1
+        if isinstance(beat, dict):
+            values = dict(beat)
+            values.setdefault("valid", full)
+        elif isinstance(beat, tuple) and len(beat) == 2:
+            values = {"valid": beat[0], "payload": beat[1]}
+        else:
+            values = {"valid": full, "payload": beat}
+        if _isArray(stream) and "payload" in values:
+            values.update(zip(_payloadFields(stream), values.pop("payload")))
+        return {f: int(v) for f, v in values.items()}
+
+    def process(self):
+        cycle = 0
+        for beat in self.beats:
+            values = self.fields(beat)
+            while True:
+                offer = next(self.pattern)
+                for f in self.stream.fields:
+                    if f != "ready":
+                        yield self.stream[f].eq(values.get(f, 0) if offer else 0)
+                yield Settle()
+                transfer = offer and (yield self.stream.ready)
+                yield
+                cycle += 1
+                if transfer:
+                    self.sent.append((cycle - 1, beat))
+                    break
+        for f in self.stream.fields:
+            if f != "ready":
+                yield self.stream[f].eq(0)
+
+
+class StreamSink:
+    """Takes the beats of a ``BasicStreamInterface`` or ``ArrayStreamInterface`` in a pysim testbench.
+
+    ``ready`` follows ``handshakePattern(pattern, rate, burst, period, seed)``. The sink stops after
+    ``count`` beats, without a count it runs for as long as the other processes do.
+
+    Attributes
+    ----------
+    received : list of (cycle, beat), the cycle of every transfer.
+    beats : the beats alone, in the form StreamSource takes them. A beat is the payload, with the
+        lanes of an ArrayStreamInterface as a tuple, or ``(valid, payload)`` when not all lanes are
+        valid. With ``fields`` it is a dict of those fields instead.
+    """
+    def __init__(self, stream, pattern="always", rate=1.0, burst=8, period=4, seed=1, count=None, fields=None):
+        self.stream = stream
+        self.pattern = handshakePattern(pattern, rate, burst, period, seed)
+        self.count = count
+        self.fields = fields
+        self.received = []
+
+    @property
+    def beats(self):
+        return [beat for _, beat in self.received]
+
+    def read(self):
+        stream = self.stream
+        if self.fields is not None:
+            beat = {}
+            for f in self.fields:
+                beat[f] = yield stream[f]
+            return beat
+        valid = yield stream.valid
+        payload = []
+        for f in _payloadFields(stream):
+            payload.append((yield stream[f]))
+        payload = tuple(payload) if _isArray(stream) else payload[0]
+        return payload if valid == (1 << len(stream.valid)) - 1 else (valid, payload)
+
+    def process(self):
+        if self.count is None:
+            yield Passive()
+        cycle = 0
+        while self.count is None or len(self.received) < self.count:
+            yield self.stream.ready.eq(next(self.pattern))
+            yield Settle()
+            if (yield self.stream.valid) and (yield self.stream.ready):
+                self.received.append((cycle, (yield from self.read())))
+            yield
+            cycle += 1
+        yield self.stream.ready.eq(0)
+
+    def throughput(self):
+        """Beats per cycle from the first transfer to the last one."""
+        if len(self.received) < 2:
+            return float(len(self.received))
+        return len(self.received)/(self.received[-1][0] - self.received[0][0] + 1)
+
+
+def latencies(source, sink):
+    """Cycles from every transfer into the source to the matching one out of the sink, for modules that keep every beat in order."""
+    return [r - s for (s, _), (r, _) in zip(source.sent, sink.received)]
+
+
+def runStreams(dut, *components, clock=1e-6, deadline=None):
+    """Simulates dut with the processes of the StreamSources and StreamSinks, until the sources
+    are done and the sinks with a count have them all, or for deadline cycles. The components are
+    clocked by sync, which is added for combinational modules."""
+    m = Module()
+    m.domains.sync = ClockDomain()
+    m.submodules.dut = dut
+    sim = Simulator(m)
+    sim.add_clock(clock)
+    for c in components:
+        sim.add_sync_process(c.process)
+    if deadline is None:
+        sim.run()
+    else:
+        sim.run_until(deadline*clock, run_passive=True)
+
+
+class StreamSimTest(FHDLTestCase):
+    def test_patterns(self):
+        import itertools
+        for kind, rate in [("always", 1.0), ("random", 0.3), ("bursty", 0.7), ("duty", 0.75)]:
+            bits = list(itertools.islice(handshakePattern(kind, rate, burst=6, period=4, seed=3), 20000))
+            self.assertAlmostEqual(sum(bits)/len(bits), rate, delta=0.03)
+        self.assertEqual(list(itertools.islice(handshakePattern("duty", 0.5, period=4), 8)), [True, True, False, False]*2)
+        bits = list(itertools.islice(handshakePattern("bursty", 0.5, burst=10, seed=3), 20000))
+        runs = [len(list(g)) for _, g in itertools.groupby(bits)]
+        self.assertGreater(sum(runs)/len(runs), 5)
+
+    def test_fifo(self):
+        import numpy as np
+        from Stream import StreamFifo
+        data = np.arange(4*200).reshape(200, 4) % 256
+        for fwft, pattern, rate in [(False, "always", 1.0), (True, "random", 0.5), (True, "duty", 0.25)]:
+            dut = StreamFifo(ArrayStreamInterface, 8, 4, depth=16, fwft=fwft)
+            source = StreamSource(dut.si, data)
+            sink = StreamSink(dut.so, pattern=pattern, rate=rate, count=len(data))
+            runStreams(dut, source, sink)
+            self.assertEqual(sink.beats, [tuple(row) for row in data.tolist()])
+            # The sink sets the pace, and no beat is faster than the latency of the FIFO, which the
+            # first one into the empty FIFO takes when the sink is always ready
+            self.assertAlmostEqual(sink.throughput(), rate, delta=0.05)
+            self.assertGreaterEqual(min(latencies(source, sink)), dut.latency)
+            if pattern == "always":
+                self.assertEqual(latencies(source, sink)[0], dut.latency)
+
+    def test_slices(self):
+        from Stream import StreamReg
+        for slice_type in ["forward", "backward", "full", "skid"]:
+            dut = StreamReg(BasicStreamInterface, 8, slice_type=slice_type)
+            source = StreamSource(dut.si, range(100))
+            sink = StreamSink(dut.so, count=100)
+            runStreams(dut, source, sink)
+            self.assertEqual(sink.beats, list(range(100)))
+            self.assertEqual(sink.throughput(), 1.0)
+            self.assertEqual(set(latencies(source, sink)), {dut.pipelineTiming().latency})
+
+    def test_partial(self):
+        from StreamCompaction import StreamCompaction
+        # Partially valid beats and a sink that only looks at some fields
+        dut = StreamCompaction(3, 8)
+        beats = [(0b101, 0x030201), (0b010, 0x060504), (0b111, 0x090807)]
+        source = StreamSource(dut.input_stream, beats, pattern="bursty", rate=0.5, burst=3)
+        sink = StreamSink(dut.output_stream, pattern="random", rate=0.5, count=3, fields=["valid"])
+        runStreams(dut, source, sink)
+        self.assertEqual(sink.beats, [{"valid": 0b011}, {"valid": 0b001}, {"valid": 0b111}])
+        self.assertEqual(set(latencies(source, sink)), {0})
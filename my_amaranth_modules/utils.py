@@ -113,6 +113,20 @@ def constMult(x, c):
 def filter_dict(remove, d):
     return dict(filter(lambda p: p[0] not in remove, d.items()))
 
+from typing import NamedTuple
+# What a stream stage tells the pipeline builder: the cycles from si to so without back pressure, the combinational levels
+# the valid and the ready path pick up when passing through it (0 when the stage registers that path) and its storage bits.
+class StageTiming(NamedTuple):
+    latency: int
+    valid_depth: int
+    ready_depth: int
+    register_bits: int = 0
+    buffer_bits: int = 0
+
+# Bits of one beat of a stream, everything but ready
+def streamBits(stream):
+    return sum(len(stream[f]) for f in stream.fields if f != "ready")
+
 from amaranth import *
 #RoundRobin. Deprecated in amaranth.lib
 class RoundRobin(Elaboratable):